@@ -1,22 +1,51 @@
 import os
 import json
 import re
+import time
+import importlib
+import hashlib
 import difflib
-from typing import Dict, Any, List, Tuple, Optional
+import functools
+import sqlite3
+import threading
+import collections
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional, Callable, Iterator
 
 import streamlit as st
-import requests
 
-# optional libs
-try:
-    import trafilatura
-except Exception:
-    trafilatura = None
+_SCRIPT_T0 = time.perf_counter()
 
-try:
-    import pdfplumber
-except Exception:
-    pdfplumber = None
+
+# ============================================================
+# optional libs (지연 로딩)
+# - trafilatura/pdfplumber/tiktoken/openai 등 무거운 모듈은 처음 쓸 때 import
+# - 결과(실패 포함)와 걸린 시간은 프로세스 단위로 기억 → 재실행마다 다시 시도하지 않음
+# - 첫 화면을 그린 뒤 백그라운드 스레드가 미리 import 해 둠 (start_background_warmup)
+# ============================================================
+WARMUP_MODULES = ["openai", "httpx", "pdfplumber", "trafilatura", "tiktoken", "numpy"]
+
+
+@st.cache_resource(show_spinner=False)
+def _lazy_module_registry() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "modules": {}, "import_s": {}}
+
+
+def lazy_import(name: str):
+    """모듈 또는 None(설치 안 됨/깨짐)."""
+    reg = _lazy_module_registry()
+    if name in reg["modules"]:
+        return reg["modules"][name]
+    with reg["lock"]:
+        if name not in reg["modules"]:
+            t0 = time.perf_counter()
+            try:
+                mod = importlib.import_module(name)
+            except Exception:
+                mod = None
+            reg["import_s"][name] = time.perf_counter() - t0
+            reg["modules"][name] = mod
+    return reg["modules"][name]
 
 
 # ============================================================
@@ -31,10 +60,10 @@ st.set_page_config(
 # ============================================================
 # CSS: "하얀 바" 원인 제거를 위해 HTML 카드 래핑을 없애고
 # st.container(border=True)만 카드로 스타일링
+# - Streamlit은 재실행 때 다시 그리지 않은 요소를 지우므로 <style>은 매번 보내야 함
+#   → 대신 주석/공백을 걷어낸 압축본을 프로세스당 한 번만 만들어 재사용
 # ============================================================
-st.markdown(
-    """
-<style>
+APP_CSS = """
 :root{
   --bg: #F5F6FA;
   --panel: rgba(255,255,255,.88);
@@ -140,10 +169,22 @@ small, .muted { color: var(--muted); }
 div[data-testid="stTabs"] button{
   border-radius: 999px !important;
 }
-</style>
-""",
-    unsafe_allow_html=True
-)
+"""
+
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*[\s\S]*?\*/", "", css)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+@st.cache_resource(show_spinner=False)
+def app_css_html() -> str:
+    return f"<style>{minify_css(APP_CSS)}</style>"
+
+
+st.markdown(app_css_html(), unsafe_allow_html=True)
 
 # ============================================================
 # Constants (너 기존 그대로)
@@ -183,6 +224,255 @@ STRUCTURE_TEMPLATES = {
     "대본": "오프닝 → 전개 → 포인트 → 마무리"
 }
 
+# ============================================================
+# Local storage (SQLite)
+# - 세션/프로세스가 바뀌어도 남아야 하는 데이터는 로컬 SQLite 하나에 기능별 테이블로 저장
+# - 연결은 작업 단위로 열고 닫음(스레드 안전, WAL 모드)
+# ============================================================
+DATA_DIR = os.environ.get(
+    "REPURPOSE_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".repurpose")
+)
+DB_PATH = os.path.join(DATA_DIR, "repurpose.db")
+
+_DB_SCHEMA = [
+    # LLM 응답 캐시: key = sha256(model, temperature, system, user)
+    """
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        raw TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        last_hit REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit)",
+    # 레퍼런스 라이브러리: 템플릿은 별도 테이블(목록 조회 때 안 읽음)
+    # 본문은 text_blobs에 내용 해시로 한 번만 저장(zlib 압축), text_z는 예전 방식 본문(이관 후 빈 값)
+    """
+    CREATE TABLE IF NOT EXISTS library_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        major TEXT NOT NULL,
+        minor TEXT,
+        meta TEXT,
+        text_z BLOB NOT NULL,
+        text_len INTEGER NOT NULL,
+        created REAL NOT NULL,
+        text_hash TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS text_blobs (
+        hash TEXT PRIMARY KEY,
+        text_z BLOB NOT NULL,
+        text_len INTEGER NOT NULL
+    )
+    """,
+    # 근사 중복 탐지: MinHash 서명 + LSH 밴드 버킷
+    """
+    CREATE TABLE IF NOT EXISTS library_minhash (
+        item_id INTEGER PRIMARY KEY,
+        sig BLOB NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS library_lsh (
+        band INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        PRIMARY KEY (band, bucket, item_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_library_lsh_item ON library_lsh(item_id)",
+    "CREATE INDEX IF NOT EXISTS idx_library_major_minor ON library_items(major, minor)",
+    "CREATE INDEX IF NOT EXISTS idx_library_name ON library_items(name)",
+    """
+    CREATE TABLE IF NOT EXISTS library_templates (
+        item_id INTEGER PRIMARY KEY,
+        template TEXT NOT NULL
+    )
+    """,
+    # 실행 히스토리: append-only, 목록은 가벼운 컬럼만 페이지 단위로 읽음
+    # owner = 'shared'(공용, 기본) 또는 기록 이름의 해시 (history_owner 참고, 인덱스는 _db_migrate에서)
+    """
+    CREATE TABLE IF NOT EXISTS run_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner TEXT NOT NULL DEFAULT 'shared',
+        ts TEXT NOT NULL,
+        major TEXT,
+        minor TEXT,
+        mode TEXT,
+        model TEXT,
+        temperature REAL,
+        original TEXT,
+        rewritten TEXT,
+        data TEXT,
+        context TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_run_history_filter ON run_history(major, minor, model)",
+    # URL 레퍼런스 캐시: 추출 텍스트 + 조건부 GET용 ETag/Last-Modified
+    """
+    CREATE TABLE IF NOT EXISTS url_cache (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        text TEXT NOT NULL,
+        meta TEXT,
+        fetched REAL NOT NULL
+    )
+    """,
+    # 템플릿 저장소: (정규화한 레퍼런스 해시, 모델) → LLM이 뽑은 템플릿
+    """
+    CREATE TABLE IF NOT EXISTS template_store (
+        ref_hash TEXT NOT NULL,
+        model TEXT NOT NULL,
+        template TEXT NOT NULL,
+        created REAL NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (ref_hash, model)
+    )
+    """,
+    # PDF 페이지 캐시: (파일 해시, 페이지 번호) → 추출 텍스트
+    """
+    CREATE TABLE IF NOT EXISTS pdf_files (
+        file_hash TEXT PRIMARY KEY,
+        n_pages INTEGER NOT NULL,
+        created REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pdf_pages (
+        file_hash TEXT NOT NULL,
+        page_idx INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (file_hash, page_idx)
+    )
+    """,
+    # 라이브러리 유사도 색인(BM25 역색인): term → (item_id, tf), 문서 길이, term별 문서 빈도
+    """
+    CREATE TABLE IF NOT EXISTS sim_docs (
+        item_id INTEGER PRIMARY KEY,
+        major TEXT NOT NULL,
+        length INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sim_docs_major ON sim_docs(major)",
+    """
+    CREATE TABLE IF NOT EXISTS sim_postings (
+        term TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        tf INTEGER NOT NULL,
+        PRIMARY KEY (term, item_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sim_postings_item ON sim_postings(item_id)",
+    """
+    CREATE TABLE IF NOT EXISTS sim_terms (
+        term TEXT PRIMARY KEY,
+        df INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+]
+
+# SQLite 빌드에 따라 없을 수 있는 기능(FTS5 trigram 등). 실패해도 앱은 동작해야 함
+_DB_OPTIONAL_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS run_history_fts USING fts5(
+        original, rewritten, content='run_history', content_rowid='id', tokenize='trigram'
+    )
+    """,
+]
+
+
+@st.cache_resource(show_spinner=False)
+def _db_ready() -> bool:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for stmt in _DB_SCHEMA:
+            conn.execute(stmt)
+        for stmt in _DB_OPTIONAL_SCHEMA:
+            try:
+                conn.execute(stmt)
+            except sqlite3.OperationalError:
+                pass
+        _db_migrate(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+
+def _db_migrate(conn):
+    """예전 DB 보정: library_items.text_hash 추가 + 본문을 text_blobs로 이관, run_history.owner 추가/공용 이관."""
+    import zlib
+
+    if "owner" not in {r[1] for r in conn.execute("PRAGMA table_info(run_history)")}:
+        conn.execute("ALTER TABLE run_history ADD COLUMN owner TEXT NOT NULL DEFAULT 'shared'")  # 예전 기록은 공용으로
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_run_history_owner ON run_history(owner, id)")
+    # owner가 비었거나 세션마다 새로 만든 임의 id(32자, 이름 해시는 'k:' 접두사)인 기록은 다시 찾을 수 없음 → 공용으로
+    conn.execute(
+        "UPDATE run_history SET owner = 'shared' WHERE owner IS NULL OR (length(owner) = 32 AND owner NOT LIKE 'k:%')"
+    )
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(library_items)")}
+    if "text_hash" not in cols:
+        conn.execute("ALTER TABLE library_items ADD COLUMN text_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_library_text_hash ON library_items(text_hash)")
+    for item_id, text_z in conn.execute("SELECT id, text_z FROM library_items WHERE text_hash IS NULL").fetchall():
+        text = zlib.decompress(text_z).decode("utf-8") if text_z else ""
+        h = _text_blob_put(conn, text)
+        conn.execute("UPDATE library_items SET text_hash = ?, text_z = x'' WHERE id = ?", (h, item_id))
+
+
+def text_blob_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def _text_blob_put(conn, text: str) -> str:
+    """
+    본문을 내용 해시로 저장(이미 있으면 그대로). 해시 반환.
+    확인+삽입을 한 문장으로 해서 쓰기 트랜잭션 안에서 처리 (따로 SELECT하면 그 사이 삭제와 경합).
+    """
+    import zlib
+
+    h = text_blob_hash(text)
+    conn.execute(
+        "INSERT OR IGNORE INTO text_blobs (hash, text_z, text_len) VALUES (?, ?, ?)",
+        (h, zlib.compress((text or "").encode("utf-8"), 6), len(text or "")),
+    )
+    return h
+
+
+def _text_blob_release(conn, h: Optional[str]):
+    """더 이상 참조하는 항목이 없으면 본문 삭제."""
+    if h:
+        conn.execute(
+            "DELETE FROM text_blobs WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM library_items WHERE text_hash = ?)",
+            (h, h),
+        )
+
+
+@st.cache_resource(show_spinner=False)
+def db_has_table(name: str) -> bool:
+    with db_conn() as conn:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+@contextmanager
+def db_conn():
+    _db_ready()
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
 # ============================================================
 # Session State (필수)
 # ============================================================
@@ -194,7 +484,7 @@ ss_init("show_sidebar", True)
 ss_init("reference_text", "")
 ss_init("reference_meta", {})
 ss_init("reference_template", {})
-ss_init("reference_library", [])
+ss_init("reference_corpus_profile", {})
 ss_init("company_target", "")
 ss_init("role_target", "")
 
@@ -203,10 +493,16 @@ ss_init("last_original", "")
 ss_init("last_run_context", {})  # 어디서 돌렸는지(major/minor/mode) 기록용(설명/디버그)
 ss_init("last_data", {})
 ss_init("last_rewritten", "")
-ss_init("history", []) # 최근 실행 10개 저장
 ss_init("pending_restore", None)
-ss_init("history_pick", 0)      # UI에서 선택된 항목 인덱스
+ss_init("history_pick", 0)      # UI에서 선택된 항목 인덱스(현재 페이지 기준)
+ss_init("history_page", 1)
+ss_init("history_key", st.query_params.get("hist", ""))  # 기록 이름(비면 공용). 주소 ?hist=…로 새로고침 후에도 유지
 ss_init("original_text", "")
+ss_init("use_llm_cache", True)
+ss_init("structured_output", False)
+ss_init("speculative_prefetch", False)
+ss_init("prefetch_keys", {})  # "대목적|소목적" → 미리 실행한 응답의 캐시 키
+ss_init("last_token_report", {})
 # ============================================================
 # ✅ Restore apply (MUST run before ANY widget is created)
 # ============================================================
@@ -221,17 +517,364 @@ if st.session_state.get("pending_restore"):
     st.session_state["last_rewritten"] = chosen.get("rewritten", "")
     st.session_state["last_data"] = chosen.get("data", {}) or {}
     st.session_state["last_run_context"] = chosen.get("context", {}) or {}
+# ============================================================
+# Metrics & tracing
+# - span("단계"): 소요 시간을 단계별로 프로세스 전역 집계 (횟수/합계/최대/최근 분포)
+# - LLM 호출은 모델별로 호출 수/캐시 적중/토큰/지연/오류 카운터
+# - 내보내기: JSONL 트레이스(REPURPOSE_TRACE_FILE 또는 사이드바 토글),
+#   Prometheus 텍스트 엔드포인트(REPURPOSE_METRICS_PORT, 기본 127.0.0.1 — REPURPOSE_METRICS_HOST), 사이드바 디버그 패널
+# - 워커 스레드에서도 호출되므로 st.* 없이 잠금만 사용
+# ============================================================
+METRICS_RECENT = 256  # 단계별로 분위수 계산에 쓰는 최근 샘플 수
+TRACE_PATH_ENV = os.environ.get("REPURPOSE_TRACE_FILE") or None
+TRACE_PATH_DEFAULT = TRACE_PATH_ENV or os.path.join(DATA_DIR, "traces.jsonl")
+METRICS_PORT = int(os.environ.get("REPURPOSE_METRICS_PORT") or 0)
+METRICS_HOST = os.environ.get("REPURPOSE_METRICS_HOST") or "127.0.0.1"  # 외부 공개는 명시적으로만
+
+_span_local = threading.local()
+
+
+@st.cache_resource(show_spinner=False)
+def _metrics_registry() -> Dict[str, Any]:
+    return {
+        "lock": threading.Lock(),
+        "trace_lock": threading.Lock(),
+        "spans": {},
+        "models": {},
+        "trace_path": TRACE_PATH_ENV,
+        "started": time.time(),
+    }
+
+
+def _trace_write(path: str, record: Dict[str, Any]):
+    reg = _metrics_registry()
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    try:
+        with reg["trace_lock"]:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError:
+        pass
+
+
+def _record_span(name: str, dur: float, parent: Optional[str], attrs: Dict[str, Any], error: Optional[str]):
+    reg = _metrics_registry()
+    with reg["lock"]:
+        agg = reg["spans"].get(name)
+        if agg is None:
+            agg = reg["spans"][name] = {
+                "count": 0, "errors": 0, "total_s": 0.0, "max_s": 0.0,
+                "recent": collections.deque(maxlen=METRICS_RECENT),
+            }
+        agg["count"] += 1
+        agg["total_s"] += dur
+        agg["max_s"] = max(agg["max_s"], dur)
+        agg["recent"].append(dur)
+        if error:
+            agg["errors"] += 1
+        path = reg["trace_path"]
+    if path:
+        _trace_write(path, {
+            "ts": time.time(), "span": name, "parent": parent, "ms": round(dur * 1000, 3),
+            "thread": threading.current_thread().name, "error": error, **attrs,
+        })
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    단계 타이밍. with span("transform.llm", model=m) as sp: ... sp["cache"] = "hit" 처럼
+    트레이스에 남길 속성을 안에서 추가할 수 있다. 중첩되면 바깥 span 이름을 parent로 기록.
+    """
+    stack = getattr(_span_local, "stack", None)
+    if stack is None:
+        stack = _span_local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    error = None
+    t0 = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        _record_span(name, time.perf_counter() - t0, parent, attrs, error)
+
+
+def record_llm_call(
+    model: str,
+    latency_s: float = 0.0,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    cached: bool = False,
+    error: bool = False,
+):
+    reg = _metrics_registry()
+    with reg["lock"]:
+        m = reg["models"].setdefault(model, {
+            "calls": 0, "cache_hits": 0, "errors": 0, "input_tokens": 0, "output_tokens": 0, "latency_s": 0.0,
+        })
+        m["calls"] += 1
+        m["cache_hits"] += int(cached)
+        m["errors"] += int(error)
+        m["input_tokens"] += int(input_tokens or 0)
+        m["output_tokens"] += int(output_tokens or 0)
+        m["latency_s"] += latency_s
+
+
+def _usage_tokens(resp) -> Tuple[int, int]:
+    usage = getattr(resp, "usage", None)
+    return (getattr(usage, "input_tokens", 0) or 0, getattr(usage, "output_tokens", 0) or 0)
+
+
+def _quantile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+def metrics_snapshot() -> Dict[str, Any]:
+    """단계별 {count, errors, avg_ms, p50_ms, p95_ms, max_ms} + 모델별 카운터."""
+    reg = _metrics_registry()
+    with reg["lock"]:
+        spans = {k: dict(v, recent=sorted(v["recent"])) for k, v in reg["spans"].items()}
+        models = {k: dict(v) for k, v in reg["models"].items()}
+    stages = {}
+    for name, v in sorted(spans.items()):
+        stages[name] = {
+            "count": v["count"],
+            "errors": v["errors"],
+            "avg_ms": round(v["total_s"] / max(1, v["count"]) * 1000, 2),
+            "p50_ms": round(_quantile(v["recent"], 0.5) * 1000, 2),
+            "p95_ms": round(_quantile(v["recent"], 0.95) * 1000, 2),
+            "max_ms": round(v["max_s"] * 1000, 2),
+            "total_s": v["total_s"],
+        }
+    return {"stages": stages, "models": models, "uptime_s": time.time() - reg["started"]}
+
+
+def metrics_reset():
+    reg = _metrics_registry()
+    with reg["lock"]:
+        reg["spans"].clear()
+        reg["models"].clear()
+
+
+def render_prometheus() -> str:
+    snap = metrics_snapshot()
+    out = [
+        "# HELP repurpose_stage_seconds Time spent per stage.",
+        "# TYPE repurpose_stage_seconds summary",
+    ]
+    for name, v in snap["stages"].items():
+        out.append(f'repurpose_stage_seconds{{stage="{name}",quantile="0.5"}} {v["p50_ms"] / 1000:.6f}')
+        out.append(f'repurpose_stage_seconds{{stage="{name}",quantile="0.95"}} {v["p95_ms"] / 1000:.6f}')
+        out.append(f'repurpose_stage_seconds_sum{{stage="{name}"}} {v["total_s"]:.6f}')
+        out.append(f'repurpose_stage_seconds_count{{stage="{name}"}} {v["count"]}')
+    out.append("# TYPE repurpose_stage_errors_total counter")
+    for name, v in snap["stages"].items():
+        out.append(f'repurpose_stage_errors_total{{stage="{name}"}} {v["errors"]}')
+    out.append("# TYPE repurpose_llm_calls_total counter")
+    for model, m in snap["models"].items():
+        out.append(f'repurpose_llm_calls_total{{model="{model}",cache="hit"}} {m["cache_hits"]}')
+        out.append(f'repurpose_llm_calls_total{{model="{model}",cache="miss"}} {m["calls"] - m["cache_hits"]}')
+    out.append("# TYPE repurpose_llm_errors_total counter")
+    for model, m in snap["models"].items():
+        out.append(f'repurpose_llm_errors_total{{model="{model}"}} {m["errors"]}')
+    out.append("# TYPE repurpose_llm_tokens_total counter")
+    for model, m in snap["models"].items():
+        out.append(f'repurpose_llm_tokens_total{{model="{model}",direction="input"}} {m["input_tokens"]}')
+        out.append(f'repurpose_llm_tokens_total{{model="{model}",direction="output"}} {m["output_tokens"]}')
+    out.append("# TYPE repurpose_llm_latency_seconds_total counter")
+    for model, m in snap["models"].items():
+        out.append(f'repurpose_llm_latency_seconds_total{{model="{model}"}} {m["latency_s"]:.6f}')
+    return "\n".join(out) + "\n"
+
+
+def set_trace_enabled(enabled: bool):
+    """트레이스 기록 켜기/끄기 (프로세스 전역). 켜면 REPURPOSE_TRACE_FILE, 없으면 기본 경로."""
+    reg = _metrics_registry()
+    with reg["lock"]:
+        reg["trace_path"] = TRACE_PATH_DEFAULT if enabled else None
+
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server(port: int) -> bool:
+    """GET /metrics (Prometheus 텍스트). 프로세스당 한 번, 데몬 스레드."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        srv = ThreadingHTTPServer((METRICS_HOST, port), _Handler)
+    except OSError:
+        return False
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    return True
+
+
+if METRICS_PORT:
+    start_metrics_server(METRICS_PORT)
+
+
 # ============================================================
 # Helpers (diff / json)
 # ============================================================
 def tokenize(text):
     return re.findall(r"\w+|[^\w\s]", text)
 
+# ------------------------------------------------------------
+# Diff engine
+# - 문단 단위로 먼저 정렬 → 안 바뀐 문단은 토큰 diff 생략
+# - 바뀐 구간만 patience diff(양쪽에 한 번씩만 나오는 토큰을 앵커로 LIS)
+# - 앵커가 없는 작은 구간만 difflib로 마무리, 너무 큰 구간은 통째로 replace
+# - 결과 HTML은 st.cache_data로 (원문, 결과) 내용 기준 메모이즈 → rerun 때 재계산 없음
+# ------------------------------------------------------------
+DIFF_FALLBACK_MAX = 1500  # 앵커 없는 구간에서 difflib를 돌릴 최대 토큰 수(한쪽 기준)
+
+
+def _patience_matches(a: List[str], b: List[str]) -> List[Tuple[int, int]]:
+    import bisect
+
+    matches: List[Tuple[int, int]] = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # 공통 접두/접미
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo >= ahi or blo >= bhi:
+            continue
+
+        # 양쪽에서 유일한 토큰 → 앵커 후보
+        count_a: Dict[str, int] = {}
+        for i in range(alo, ahi):
+            count_a[a[i]] = count_a.get(a[i], 0) + 1
+        count_b: Dict[str, int] = {}
+        pos_b: Dict[str, int] = {}
+        for j in range(blo, bhi):
+            count_b[b[j]] = count_b.get(b[j], 0) + 1
+            pos_b[b[j]] = j
+        pairs = [(i, pos_b[a[i]]) for i in range(alo, ahi) if count_a[a[i]] == 1 and count_b.get(a[i]) == 1]
+
+        if not pairs:
+            if ahi - alo <= DIFF_FALLBACK_MAX and bhi - blo <= DIFF_FALLBACK_MAX:
+                sm = difflib.SequenceMatcher(a=a[alo:ahi], b=b[blo:bhi], autojunk=False)
+                for bi, bj, size in sm.get_matching_blocks():
+                    for k in range(size):
+                        matches.append((alo + bi + k, blo + bj + k))
+            continue
+
+        # j 기준 최장 증가 부분수열(patience sorting)
+        tails: List[int] = []
+        tails_idx: List[int] = []
+        prev = [-1] * len(pairs)
+        for k, (_, j) in enumerate(pairs):
+            t = bisect.bisect_left(tails, j)
+            if t == len(tails):
+                tails.append(j)
+                tails_idx.append(k)
+            else:
+                tails[t] = j
+                tails_idx[t] = k
+            prev[k] = tails_idx[t - 1] if t > 0 else -1
+        anchors = []
+        k = tails_idx[-1] if tails_idx else -1
+        while k >= 0:
+            anchors.append(pairs[k])
+            k = prev[k]
+        anchors.reverse()
+
+        last_i, last_j = alo, blo
+        for i, j in anchors:
+            stack.append((last_i, i, last_j, j))
+            matches.append((i, j))
+            last_i, last_j = i + 1, j + 1
+        stack.append((last_i, ahi, last_j, bhi))
+
+    matches.sort()
+    return matches
+
+
+def diff_opcodes(a: List[str], b: List[str]) -> List[Tuple[str, int, int, int, int]]:
+    """difflib.SequenceMatcher.get_opcodes()와 같은 형식의 opcode를 patience diff로 계산."""
+    ops: List[Tuple[str, int, int, int, int]] = []
+    i = j = 0
+    for mi, mj in _patience_matches(a, b) + [(len(a), len(b))]:
+        if i < mi and j < mj:
+            ops.append(("replace", i, mi, j, mj))
+        elif i < mi:
+            ops.append(("delete", i, mi, j, j))
+        elif j < mj:
+            ops.append(("insert", i, i, j, mj))
+        if mi < len(a) or mj < len(b):
+            if ops and ops[-1][0] == "equal" and ops[-1][2] == mi and ops[-1][4] == mj:
+                tag, i1, _, j1, _ = ops.pop()
+                ops.append(("equal", i1, mi + 1, j1, mj + 1))
+            else:
+                ops.append(("equal", mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return ops
+
+
+def aligned_diff_opcodes(original: str, revised: str) -> Tuple[List[str], List[str], List[Tuple[str, int, int, int, int]]]:
+    """
+    문단 해시로 먼저 정렬하고, 달라진 문단 구간만 토큰 diff.
+    반환: (원문 토큰, 결과 토큰, 전체 토큰 기준 opcode)
+    """
+    paras_a = split_paragraphs(original) or [original]
+    paras_b = split_paragraphs(revised) or [revised]
+    toks_a = [tokenize(p) for p in paras_a]
+    toks_b = [tokenize(p) for p in paras_b]
+    offs_a, offs_b = [0], [0]
+    for t in toks_a:
+        offs_a.append(offs_a[-1] + len(t))
+    for t in toks_b:
+        offs_b.append(offs_b[-1] + len(t))
+    a = [tok for t in toks_a for tok in t]
+    b = [tok for t in toks_b for tok in t]
+
+    keys_a = [hashlib.md5(p.encode("utf-8")).digest() for p in paras_a]
+    keys_b = [hashlib.md5(p.encode("utf-8")).digest() for p in paras_b]
+    ops: List[Tuple[str, int, int, int, int]] = []
+    for tag, p1, p2, q1, q2 in difflib.SequenceMatcher(a=keys_a, b=keys_b, autojunk=False).get_opcodes():
+        i1, i2, j1, j2 = offs_a[p1], offs_a[p2], offs_b[q1], offs_b[q2]
+        if tag == "equal":
+            ops.append(("equal", i1, i2, j1, j2))
+            continue
+        for sub_tag, si1, si2, sj1, sj2 in diff_opcodes(a[i1:i2], b[j1:j2]):
+            ops.append((sub_tag, i1 + si1, i1 + si2, j1 + sj1, j1 + sj2))
+    return a, b, ops
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
 def render_diff_html(original, revised):
-    a, b = tokenize(original), tokenize(revised)
-    sm = difflib.SequenceMatcher(a=a, b=b)
+    a, b, opcodes = aligned_diff_opcodes(original, revised)
     out = []
-    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+    for tag, i1, i2, j1, j2 in opcodes:
+        if i1 == i2 and j1 == j2:
+            continue
         if tag == "equal":
             out.append(" ".join(b[j1:j2]))
         elif tag == "insert":
@@ -245,12 +888,202 @@ def render_diff_html(original, revised):
             )
     return f"<div style='line-height:1.85; font-size: 0.98rem'>{' '.join(out)}</div>"
 
+# ------------------------------------------------------------
+# JSON 추출기 (점진식)
+# - 조각(chunk)을 받는 대로 이어서 스캔하고, 첫 번째로 완성된 최상위 객체를 돌려줌
+# - 문자열 안/밖을 구분해 괄호를 세므로 앞뒤 설명문·코드펜스(```json)·중괄호가 섞여도 안전
+# - 흔한 LLM 결함 보정: 끝에 남은 쉼표, 문자열 안 날 줄바꿈(strict=False), 잘린 출력(괄호 닫기)
+# - 글자 단위가 아니라 정규식으로 다음 의미 있는 문자까지 건너뜀
+# ------------------------------------------------------------
+_JSON_OUTSIDE_RE = re.compile(r'[{}\[\]",]')
+_JSON_INSIDE_RE = re.compile(r'["\\]')
+_JSON_CLOSERS = {"{": "}", "[": "]"}
+
+
+def json_extractor_new() -> Dict[str, Any]:
+    return {"text": "", "pos": 0, "start": -1, "stack": [], "in_str": False, "last_comma": -1, "drop": [], "result": None}
+
+
+def _json_try_load(text: str, drop: List[int]) -> Optional[Dict[str, Any]]:
+    if drop:
+        parts, prev = [], 0
+        for d in drop:
+            parts.append(text[prev:d])
+            prev = d + 1
+        parts.append(text[prev:])
+        text = "".join(parts)
+    try:
+        obj = json.loads(text, strict=False)
+    except ValueError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def json_extractor_feed(state: Dict[str, Any], chunk: str) -> Optional[Dict[str, Any]]:
+    """chunk를 이어 붙여 스캔. 최상위 객체가 완성되면 그 dict, 아직이면 None."""
+    if state["result"] is not None:
+        return state["result"]
+    state["text"] += chunk or ""
+    text = state["text"]
+    i, n = state["pos"], len(text)
+    stack = state["stack"]
+    while i < n:
+        if state["in_str"]:
+            m = _JSON_INSIDE_RE.search(text, i)
+            if not m:
+                i = n
+                break
+            j = m.start()
+            if text[j] == "\\":
+                if j + 1 >= n:
+                    i = j  # 이스케이프가 잘린 채로 도착: 다음 조각에서 다시
+                    break
+                i = j + 2
+                continue
+            state["in_str"] = False
+            state["last_comma"] = -1
+            i = j + 1
+            continue
+
+        m = _JSON_OUTSIDE_RE.search(text, i)
+        if not m:
+            i = n
+            break
+        j = m.start()
+        c = text[j]
+        i = j + 1
+        if not stack:
+            # 객체 밖(설명문 등)은 '{'만 본다
+            if c == "{":
+                stack.append(c)
+                state["start"], state["drop"], state["last_comma"] = j, [], -1
+            continue
+        if c == '"':
+            state["in_str"] = True
+        elif c in "{[":
+            stack.append(c)
+            state["last_comma"] = -1
+        elif c == ",":
+            state["last_comma"] = j
+        else:
+            lc = state["last_comma"]
+            if lc >= 0 and not text[lc + 1:j].strip():
+                state["drop"].append(lc)  # 닫는 괄호 앞 쉼표
+            state["last_comma"] = -1
+            stack.pop()
+            if not stack:
+                start = state["start"]
+                obj = _json_try_load(text[start:j + 1], [d - start for d in state["drop"]])
+                if obj is not None:
+                    state["result"], state["pos"] = obj, i
+                    return obj
+                # 파싱 실패(설명문 속 중괄호 등): 이 '{' 바로 다음부터 다시 찾음
+                i, state["start"] = start + 1, -1
+    state["pos"] = i
+    return None
+
+
+def _json_close_truncated(state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """출력이 중간에 끊긴 경우: 열린 문자열/괄호를 닫아 복구 시도."""
+    start = state["start"]
+    text = state["text"][start:]
+    if state["in_str"]:
+        if text.endswith("\\"):
+            text = text[:-1]
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    closers = "".join(_JSON_CLOSERS[c] for c in reversed(state["stack"]))
+    return _json_try_load(text + closers, [d - start for d in state["drop"] if d - start < len(text)])
+
+
+def json_extractor_finish(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    스트림이 끝났을 때 최종 결과. 완성된 객체가 없으면 잘린 객체 복구 → 다음 '{'부터 재시도 → {}.
+    (복구한 결과인지는 구분하지 않음: 캐시 저장 여부는 원문으로 json_is_complete가 판단)
+    """
+    while state["result"] is None and state["stack"]:
+        repaired = _json_close_truncated(state)
+        if repaired is not None:
+            return repaired
+        rest = state["text"][state["start"] + 1:]
+        state = json_extractor_new()
+        json_extractor_feed(state, rest)
+    return state["result"] or {}
+
+
+def extract_json_object(text: str) -> Dict[str, Any]:
+    state = json_extractor_new()
+    json_extractor_feed(state, text or "")
+    return json_extractor_finish(state)
+
+
+def json_is_complete(text: str) -> bool:
+    """잘린 출력 복구 없이 완성된 JSON 객체를 꺼낼 수 있는지. (캐시에 넣어도 되는 응답인지)"""
+    try:
+        if isinstance(json.loads(text), dict):
+            return True
+    except (TypeError, ValueError):
+        pass
+    state = json_extractor_new()
+    return json_extractor_feed(state, text or "") is not None
+
+
 def safe_json(text):
     try:
         return json.loads(text)
-    except:
-        m = re.search(r"\{.*\}", text, re.S)
-        return json.loads(m.group()) if m else {}
+    except (TypeError, ValueError):
+        return extract_json_object(text)
+
+_JSON_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def partial_json_string_field(buf: str, field: str) -> str:
+    """
+    아직 다 오지 않은 JSON 문자열(스트리밍 중)에서 "field": "..." 값을 지금까지 온 만큼만 디코딩.
+    값이 문자열이 아니거나 키가 아직 없으면 "".
+    """
+    m = re.search(r'"%s"\s*:\s*"' % re.escape(field), buf or "")
+    if not m:
+        return ""
+    out = []
+    i, n = m.end(), len(buf)
+    while i < n:
+        c = buf[i]
+        if c == '"':
+            break
+        if c != "\\":
+            out.append(c)
+            i += 1
+            continue
+        if i + 1 >= n:
+            break  # 이스케이프가 잘린 채로 도착
+        esc = buf[i + 1]
+        if esc != "u":
+            out.append(_JSON_SIMPLE_ESCAPES.get(esc, esc))
+            i += 2
+            continue
+        hexs = buf[i + 2:i + 6]
+        if len(hexs) < 4:
+            break
+        try:
+            cp = int(hexs, 16)
+        except ValueError:
+            break
+        i += 6
+        if 0xD800 <= cp < 0xDC00:
+            # 서로게이트 페어(이모지 등): 뒷부분까지 와야 합칠 수 있음
+            if buf[i:i + 2] != "\\u" or len(buf[i + 2:i + 6]) < 4:
+                break
+            try:
+                low = int(buf[i + 2:i + 6], 16)
+            except ValueError:
+                break
+            cp = 0x10000 + ((cp - 0xD800) << 10) + (low - 0xDC00)
+            i += 6
+        out.append(chr(cp))
+    return "".join(out)
 
 def normalize_rewritten(value) -> str:
     if value is None:
@@ -310,10 +1143,28 @@ def derive_repurpose_suggestions(major, minor):
                 break
     return suggestions
 
-def render_result_panel(original_text: str, rewritten: str, data: Dict[str, Any], major: str, minor: str):
+def _apply_repurpose_suggestion(major: str, minor: str):
+    st.session_state.purpose_major = major
+    st.session_state.purpose_minor = minor
+    st.session_state.suggest_run = True
+
+
+@st.fragment
+def render_result_panel(
+    original_text: str,
+    rewritten: str,
+    data: Dict[str, Any],
+    major: str,
+    minor: str,
+    key_prefix: str = "panel",
+    tokens: Optional[Dict[str, Any]] = None,
+    suggest_actions: bool = False,
+):
     """
     작성 탭/레퍼런스 탭 어디서든 동일한 결과 UI를 재사용하기 위한 패널 렌더러.
     (기존 작성 탭 UI 구성 그대로 재사용)
+    fragment라서 패널 안 상호작용은 앱 전체가 아니라 이 패널만 다시 그린다.
+    suggest_actions=True면 재활용 추천을 버튼으로 (누르면 그 목적으로 바로 변환, 미리 실행된 건 ⚡)
     """
     original_text = (original_text or "").strip()
     rewritten = (rewritten or "").strip()
@@ -323,8 +1174,11 @@ def render_result_panel(original_text: str, rewritten: str, data: Dict[str, Any]
         st.caption("변환 실행 후 결과가 표시됩니다.")
         return
 
+    render_token_report(tokens)
     st.markdown("**하이라이트(변경점 표시)**")
-    st.markdown(render_diff_html(original_text, rewritten), unsafe_allow_html=True)
+    with span("render.diff", chars=len(original_text) + len(rewritten)):
+        diff_html = render_diff_html(original_text, rewritten)
+    st.markdown(diff_html, unsafe_allow_html=True)
 
     st.divider()
 
@@ -355,11 +1209,25 @@ def render_result_panel(original_text: str, rewritten: str, data: Dict[str, Any]
     with col1:
         st.markdown("**💡 재활용 추천**")
         suggested = data.get("suggested_repurposes") or derive_repurpose_suggestions(major, minor)
-        for r in suggested:
-            if isinstance(r, dict):
-                st.write(f"{r.get('major_purpose','기타')} → {r.get('minor_purpose','기타')}")
-            else:
-                st.write(r)
+        if suggest_actions:
+            prefetched = st.session_state.get("prefetch_keys") or {}
+            for i, r in enumerate(repurpose_targets(data, major, minor)):
+                mj, mn = r["major_purpose"], r["minor_purpose"]
+                ready = prefetch_status(prefetched.get(f"{mj}|{mn}")) == "ready"
+                if st.button(
+                    f"{mj} → {mn}" + (" ⚡" if ready else ""),
+                    key=f"{key_prefix}_repurpose_{i}",
+                    on_click=_apply_repurpose_suggestion,
+                    args=(mj, mn),
+                    help="미리 실행된 결과라 바로 나옵니다." if ready else "이 목적으로 다시 변환합니다.",
+                ):
+                    st.rerun()  # fragment 밖(사이드바/작성 탭)까지 다시 그려야 함
+        else:
+            for r in suggested:
+                if isinstance(r, dict):
+                    st.write(f"{r.get('major_purpose','기타')} → {r.get('minor_purpose','기타')}")
+                else:
+                    st.write(r)
 
     with col2:
         st.markdown("**📈 품질 점수**")
@@ -371,9 +1239,9 @@ def render_result_panel(original_text: str, rewritten: str, data: Dict[str, Any]
 
     d1, d2 = st.columns(2)
     with d1:
-        st.download_button("TXT 다운로드", rewritten, file_name="result.txt")
+        st.download_button("TXT 다운로드", rewritten, file_name="result.txt", on_click="ignore", key=f"{key_prefix}_dl_txt")
     with d2:
-        st.download_button("MD 다운로드", rewritten, file_name="result.md")
+        st.download_button("MD 다운로드", rewritten, file_name="result.md", on_click="ignore", key=f"{key_prefix}_dl_md")
 
 def render_template_preview(tpl: Dict[str, Any]):
     tpl = tpl or {}
@@ -413,23 +1281,85 @@ def render_template_preview(tpl: Dict[str, Any]):
 # ============================================================
 # Reference fetchers (유지)
 # ============================================================
-@st.cache_data(show_spinner=False, ttl=3600)
-def fetch_url_text(url: str, timeout: int = 12) -> Tuple[str, Dict[str, Any]]:
-    meta = {"url": url}
+URL_FETCH_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome Safari"
+URL_MAX_CONCURRENCY = 6
+URL_MAX_BYTES = 3 * 1024 * 1024      # 응답 본문은 스트리밍으로 받다가 이 크기에서 끊음
+URL_TEXT_MAX_CHARS = 20000
+URL_CACHE_FRESH_S = 3600             # 이 시간 안에 받은 건 네트워크 없이 재사용
+URL_CACHE_MAX_AGE_S = 30 * 24 * 3600  # 그 이후엔 조건부 GET(304면 캐시 사용)
+
+
+@st.cache_resource(show_spinner=False)
+def _url_fetch_runtime() -> Dict[str, Any]:
+    """
+    URL 수집 전용 이벤트 루프(백그라운드 스레드) + 공유 AsyncClient(keep-alive 풀).
+    """
+    import asyncio
+    import httpx
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="url-fetch-loop", daemon=True).start()
+
+    async def _make_client():
+        return httpx.AsyncClient(
+            headers={"User-Agent": URL_FETCH_UA},
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=URL_MAX_CONCURRENCY * 2, max_keepalive_connections=URL_MAX_CONCURRENCY),
+        )
+
+    client = asyncio.run_coroutine_threadsafe(_make_client(), loop).result()
+    return {"loop": loop, "client": client}
+
+
+async def _fetch_url_body(client, url: str, cached: Optional[Dict[str, Any]], timeout: float, sem) -> Dict[str, Any]:
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
     try:
-        r = requests.get(url, timeout=timeout, headers={
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome Safari"
-        })
-        meta["status_code"] = r.status_code
-        html = r.text
+        async with sem:
+            async with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+                res = {
+                    "status_code": r.status_code,
+                    "etag": r.headers.get("etag"),
+                    "last_modified": r.headers.get("last-modified"),
+                    "charset": r.charset_encoding,
+                    "truncated": False,
+                }
+                if r.status_code == 304:
+                    return res
+                buf = bytearray()
+                async for chunk in r.aiter_bytes():
+                    buf += chunk
+                    if len(buf) >= URL_MAX_BYTES:
+                        res["truncated"] = True
+                        break
+                res["body"] = bytes(buf[:URL_MAX_BYTES])
+                return res
     except Exception as e:
-        return "", {"url": url, "error": str(e)}
+        return {"error": str(e)}
+
+
+def _decode_html(body: bytes, charset: Optional[str]) -> str:
+    if not charset:
+        # 헤더에 charset이 없으면 <meta charset> 확인 (국내 사이트 euc-kr 대응)
+        m = re.search(rb"<meta[^>]+charset=[\"']?([\w-]+)", body[:4096], re.I)
+        charset = m.group(1).decode("ascii", "ignore") if m else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
 
+def html_to_text(html: str, meta: Dict[str, Any]) -> str:
+    trafilatura = lazy_import("trafilatura")
     if trafilatura:
         try:
             downloaded = trafilatura.extract(html, include_comments=False, include_tables=False)
             if downloaded and len(downloaded.strip()) > 200:
-                return downloaded.strip(), meta
+                return downloaded.strip()
         except Exception as e:
             meta["trafilatura_error"] = str(e)
 
@@ -437,25 +1367,465 @@ def fetch_url_text(url: str, timeout: int = 12) -> Tuple[str, Dict[str, Any]]:
     text = re.sub(r"<style[\s\S]*?</style>", " ", text)
     text = re.sub(r"<[^>]+>", " ", text)
     text = re.sub(r"\s+", " ", text).strip()
-    if len(text) > 2000:
-        text = text[:20000]
+    if len(text) > URL_TEXT_MAX_CHARS:
+        text = text[:URL_TEXT_MAX_CHARS]
         meta["truncated"] = True
-    return text, meta
+    return text
+
+
+def _url_cache_rows(urls: List[str]) -> Dict[str, Dict[str, Any]]:
+    if not urls:
+        return {}
+    with db_conn() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM url_cache WHERE url IN ({','.join('?' * len(urls))})", urls
+        ).fetchall()
+    return {r["url"]: dict(r) for r in rows}
+
+
+def fetch_urls_text(urls: List[str], timeout: int = 12) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    URL 여러 개를 동시에 가져와 본문 텍스트 추출. 입력 순서대로 (text, meta) 반환.
+    - 최근에 받은 URL은 캐시 그대로, 오래된 건 ETag/Last-Modified로 조건부 GET
+    """
+    import asyncio
+
+    urls = [u.strip() for u in urls]
+    now = time.time()
+    cached = _url_cache_rows([u for u in urls if u])
+    results: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    to_fetch = []
+    for u in dict.fromkeys(urls):
+        if not u:
+            results[u] = ("", {"url": u, "error": "empty url"})
+            continue
+        row = cached.get(u)
+        if row and now - row["fetched"] < URL_CACHE_FRESH_S:
+            results[u] = (row["text"], dict(json.loads(row["meta"] or "{}"), cache="fresh"))
+        else:
+            to_fetch.append(u)
+
+    if to_fetch:
+        rt = _url_fetch_runtime()
+        sem_holder = {}
+
+        async def _run_all():
+            sem_holder["sem"] = asyncio.Semaphore(URL_MAX_CONCURRENCY)
+            usable = {u: cached[u] for u in to_fetch if u in cached and now - cached[u]["fetched"] < URL_CACHE_MAX_AGE_S}
+            return await asyncio.gather(*[
+                _fetch_url_body(rt["client"], u, usable.get(u), timeout, sem_holder["sem"]) for u in to_fetch
+            ])
+
+        with span("url.fetch", urls=len(to_fetch)):
+            fetched = asyncio.run_coroutine_threadsafe(_run_all(), rt["loop"]).result()
+
+        with db_conn() as conn:
+            for u, res in zip(to_fetch, fetched):
+                if res.get("error"):
+                    results[u] = ("", {"url": u, "error": res["error"]})
+                    continue
+                meta = {"url": u, "status_code": res["status_code"]}
+                if res["status_code"] == 304 and u in cached:
+                    conn.execute("UPDATE url_cache SET fetched = ? WHERE url = ?", (time.time(), u))
+                    results[u] = (cached[u]["text"], dict(json.loads(cached[u]["meta"] or "{}"), cache="revalidated"))
+                    continue
+                if res.get("truncated"):
+                    meta["body_truncated"] = True
+                with span("url.parse"):
+                    text = html_to_text(_decode_html(res.get("body") or b"", res.get("charset")), meta)
+                results[u] = (text, meta)
+                if res["status_code"] < 400 and text.strip():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO url_cache (url, etag, last_modified, text, meta, fetched) VALUES (?, ?, ?, ?, ?, ?)",
+                        (u, res.get("etag"), res.get("last_modified"), text, json.dumps(meta, ensure_ascii=False), time.time()),
+                    )
+
+    return [results[u] for u in urls]
+
+
+def fetch_url_text(url: str, timeout: int = 12) -> Tuple[str, Dict[str, Any]]:
+    return fetch_urls_text([url], timeout=timeout)[0]
+
+
+def ingest_reference_urls(raw: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    줄바꿈/공백으로 구분된 URL 목록을 한 번에 가져와 하나의 레퍼런스로 합침.
+    URL이 하나면 fetch_url_text와 같은 (text, meta).
+    """
+    urls = list(dict.fromkeys(u for u in re.split(r"\s+", raw or "") if u))
+    if len(urls) <= 1:
+        return fetch_url_text(urls[0] if urls else "")
+    pairs = fetch_urls_text(urls)
+    texts = [t.strip() for t, _ in pairs if t.strip()]
+    meta = {"urls": urls, "sources": [m for _, m in pairs], "ok": len(texts), "failed": len(urls) - len(texts)}
+    return "\n\n---\n\n".join(texts), meta
+
+# ------------------------------------------------------------
+# PDF extraction
+# - 페이지를 묶음(chunk) 단위로 프로세스 풀에 분산 → 끝나는 대로 UI로 흘려보냄
+# - (파일 해시, 페이지) 단위로 캐시 → 같은 PDF를 다시 올리면 바로 반환
+# - 서버는 이미 여러 스레드가 도는 중이라 fork는 위험 → forkserver(없으면 spawn) 프로세스 풀
+#   Streamlit은 app.py를 __file__ 있는 __main__으로 실행 → 그대로 두면 자식이 시작하면서 app.py 전체를
+#   __mp_main__으로 다시 실행함(페이지 설정, DB 초기화, 위젯, 워밍업). 워커를 띄우는 동안만 __main__을 빈 모듈로 바꿈
+#   워커 함수는 부작용 없는 pdf_worker.py에 있음, 풀은 프로세스당 하나를 재사용
+# - 임시 PDF 파일은 호출마다 고유 이름 (같은 PDF를 동시에 올린 세션끼리 지우지 않도록)
+# ------------------------------------------------------------
+PDF_DEFAULT_MAX_PAGES = 200
+PDF_CHUNK_PAGES = 4
+PDF_MAX_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PDF_TMP_DIR = os.path.join(DATA_DIR, "pdf_tmp")
+
+
+def parse_page_range(spec: Optional[str], n_pages: int, max_pages: int = PDF_DEFAULT_MAX_PAGES) -> List[int]:
+    """
+    "1-12, 15, 20-" 같은 1부터 시작하는 범위를 0-based 페이지 인덱스로. 비어 있으면 전체.
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return list(range(min(n_pages, max_pages)))
+    pages = []
+    for part in re.split(r"[,\s]+", spec):
+        m = re.fullmatch(r"(\d*)\s*-\s*(\d*)|(\d+)", part)
+        if not m:
+            continue
+        if m.group(3):
+            lo = hi = int(m.group(3))
+        else:
+            lo = int(m.group(1) or 1)
+            hi = int(m.group(2) or n_pages)
+        for p in range(max(1, lo), min(hi, n_pages) + 1):
+            pages.append(p - 1)
+    return list(dict.fromkeys(pages))[:max_pages]
+
+
+@st.cache_resource(show_spinner=False)
+def _pdf_executor():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=PDF_MAX_WORKERS, mp_context=ctx)
+
+
+@st.cache_resource(show_spinner=False)
+def _pdf_spawn_lock() -> threading.Lock:
+    return threading.Lock()
+
+
+@contextmanager
+def _pdf_spawn_guard():
+    """풀이 워커를 띄울 수 있는 구간(submit) 동안 __main__을 __file__ 없는 빈 모듈로 바꿔 둠."""
+    import sys
+    import types
+
+    with _pdf_spawn_lock():
+        main = sys.modules.get("__main__")
+        stub = sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            if sys.modules.get("__main__") is stub:  # 그 사이 다른 세션 rerun이 바꿨으면 그대로 둠
+                sys.modules["__main__"] = main
+
+
+def _pdf_tmp_write(file_bytes: bytes) -> str:
+    import tempfile
+
+    os.makedirs(PDF_TMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=PDF_TMP_DIR)
+    with os.fdopen(fd, "wb") as f:
+        f.write(file_bytes)
+    return path
+
+
+def iter_pdf_pages(
+    file_bytes: bytes,
+    page_range: Optional[str] = None,
+    max_pages: int = PDF_DEFAULT_MAX_PAGES,
+) -> Iterator[Tuple[int, str, int]]:
+    """
+    선택한 페이지를 (page_idx, text, 선택 페이지 수)로 yield. 캐시된 페이지가 먼저, 나머지는 완료 순서대로.
+    """
+    from concurrent.futures import as_completed
+
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    with db_conn() as conn:
+        row = conn.execute("SELECT n_pages FROM pdf_files WHERE file_hash = ?", (file_hash,)).fetchone()
+    n_pages = row["n_pages"] if row else None
+
+    path = None
+    try:
+        if n_pages is None:
+            path = _pdf_tmp_write(file_bytes)
+            with lazy_import("pdfplumber").open(path) as pdf:
+                n_pages = len(pdf.pages)
+            with db_conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO pdf_files (file_hash, n_pages, created) VALUES (?, ?, ?)",
+                    (file_hash, n_pages, time.time()),
+                )
 
-def extract_pdf_text(file_bytes: bytes, max_pages: int = 12) -> str:
-    if not pdfplumber:
+        pages = parse_page_range(page_range, n_pages, max_pages)
+        total = len(pages)
+        with db_conn() as conn:
+            cached = {
+                r["page_idx"]: r["text"]
+                for r in conn.execute("SELECT page_idx, text FROM pdf_pages WHERE file_hash = ?", (file_hash,))
+            }
+        for i in pages:
+            if i in cached:
+                yield i, cached[i], total
+
+        missing = [i for i in pages if i not in cached]
+        if not missing:
+            return
+        if path is None:
+            path = _pdf_tmp_write(file_bytes)
+
+        from concurrent.futures.process import BrokenProcessPool
+        from pdf_worker import extract_chunk
+
+        chunks = [missing[k:k + PDF_CHUNK_PAGES] for k in range(0, len(missing), PDF_CHUNK_PAGES)]
+        with _pdf_spawn_guard():  # 워커는 submit 안에서 필요할 때 시작됨
+            futures = [_pdf_executor().submit(extract_chunk, path, chunk) for chunk in chunks]
+        try:
+            for fut in as_completed(futures):
+                try:
+                    results = fut.result()
+                except BrokenProcessPool:
+                    _pdf_executor.clear()  # 워커가 죽은 풀은 버리고 다음 호출에서 새로 만듦
+                    raise
+                with db_conn() as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO pdf_pages (file_hash, page_idx, text) VALUES (?, ?, ?)",
+                        [(file_hash, i, txt) for i, txt in results],
+                    )
+                for i, txt in results:
+                    yield i, txt, total
+        finally:
+            for fut in futures:
+                fut.cancel()  # 중간에 멈춘 경우(위젯 rerun 등) 아직 시작 안 한 묶음은 취소
+    finally:
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def extract_pdf_text(
+    file_bytes: bytes,
+    max_pages: int = 12,
+    page_range: Optional[str] = None,
+    on_page: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """
+    선택 페이지 텍스트를 페이지 순서대로 합쳐 반환. on_page(완료 수, 전체 수)로 진행 상황 전달.
+    """
+    if not lazy_import("pdfplumber"):
         return "PDF 텍스트 추출을 위해 pdfplumber 설치가 필요합니다. (pip install pdfplumber)"
-    out = []
+    got: Dict[int, str] = {}
     try:
-        import io
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            for page in pdf.pages[:max_pages]:
-                txt = page.extract_text() or ""
-                if txt.strip():
-                    out.append(txt.strip())
+        with span("pdf.extract") as sp:
+            for i, txt, total in iter_pdf_pages(file_bytes, page_range=page_range, max_pages=max_pages):
+                got[i] = txt
+                if on_page:
+                    on_page(len(got), total)
+            sp["pages"] = len(got)
     except Exception as e:
         return f"PDF 추출 실패: {e}"
-    return "\n\n".join(out).strip()
+    return "\n\n".join(got[i] for i in sorted(got) if got[i].strip()).strip()
+
+
+def render_pdf_extract(pdf, key: str) -> str:
+    """PDF 추출 + 진행 바. 자소서/논문 탭 공용."""
+    prog = st.progress(0.0, text="PDF 추출 중...")
+
+    def _on_page(done: int, total: int):
+        prog.progress(done / max(1, total), text=f"PDF 추출 중... {done}/{total} 페이지")
+
+    txt = extract_pdf_text(
+        pdf.getvalue(),
+        max_pages=PDF_DEFAULT_MAX_PAGES,
+        page_range=st.session_state.get(key, ""),
+        on_page=_on_page,
+    )
+    prog.empty()
+    return txt
+# ============================================================
+# Token Budget
+# - 프롬프트 길이를 글자 수가 아니라 토큰으로 계산 (tiktoken 있으면 사용, 없으면 근사치)
+# - 레퍼런스가 예산을 넘으면 정보량 높은 문단부터 골라 원래 순서대로 이어 붙임
+# ============================================================
+MODEL_CONTEXT_TOKENS = {"gpt-4o-mini": 128_000, "gpt-4.1-mini": 1_047_576}
+MODEL_INPUT_USD_PER_MTOK = {"gpt-4o-mini": 0.15, "gpt-4.1-mini": 0.40}
+OUTPUT_TOKEN_RESERVE = 4_000  # 응답(JSON)용으로 남겨두는 몫
+
+# 레퍼런스에 쓰는 기본 토큰 예산 (사이드바에서 조정)
+# 글자 수로 환산되는 양은 글에 따라 다름: 흔한 한글 문장은 토큰당 한 글자 남짓이지만,
+# 드문 음절·한자·이모지는 한 글자가 2~3토큰(바이트 단위 BPE라 최대 UTF-8 바이트 수)까지 들 수 있음
+# → 그런 글에서는 예전 글자 수 자르기(레퍼런스 6000자 등)보다 적게 남을 수 있다. 모자라면 사이드바에서 늘릴 것
+REF_TOKEN_BUDGET_DEFAULT = 6_000
+REF_TOKEN_BUDGET_MAX = 16_000
+# 빌더별 비율: 템플릿 추출은 구조 파악용이라 더 길게, SNS는 캡션 위주라 약간 짧게
+REF_BUDGET_SCALE = {"reference": 1.0, "template": 1.35, "sns": 1.1}
+
+_WORD_RE = re.compile(r"\w+")
+_OMIT_MARK = "(…중략…)"
+
+
+@st.cache_resource(show_spinner=False)
+def _tiktoken_encoding(model: str):
+    """인코딩은 첫 사용 때 BPE 파일을 받아오므로 재실행 간 공유. 실패(오프라인 등)도 None으로 기억."""
+    tiktoken = lazy_import("tiktoken")
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """토큰 수. tiktoken이 없으면 ASCII 4자당 1토큰, 그 외(한글 등) 1자당 0.8토큰으로 근사."""
+    text = text or ""
+    enc = _tiktoken_encoding(model)
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    n_ascii = len(text.encode("ascii", errors="ignore"))
+    return int(n_ascii / 4 + (len(text) - n_ascii) * 0.8) + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o-mini") -> str:
+    """앞에서부터 max_tokens 만큼만 남김."""
+    text = text or ""
+    if max_tokens <= 0:
+        return ""
+    enc = _tiktoken_encoding(model)
+    if enc is not None:
+        ids = enc.encode(text, disallowed_special=())
+        return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+    n = count_tokens(text, model)
+    if n <= max_tokens:
+        return text
+    cut = int(len(text) * max_tokens / n)
+    while cut > 0 and count_tokens(text[:cut], model) > max_tokens:
+        cut = int(cut * 0.95)
+    return text[:cut]
+
+
+def _paragraph_scores(paras: List[str], n_tokens: List[int]) -> List[float]:
+    """문단 정보량: 드문 단어(문단 빈도 역수) 합 / √토큰 + 헤딩·수치·처음/끝 보정."""
+    import math
+
+    words = [set(_WORD_RE.findall(p.lower())) for p in paras]
+    df: Dict[str, int] = {}
+    for ws in words:
+        for w in ws:
+            df[w] = df.get(w, 0) + 1
+    n = len(paras)
+    scores = []
+    for i, (p, ws, nt) in enumerate(zip(paras, words, n_tokens)):
+        s = sum(math.log(1 + n / df[w]) for w in ws) / math.sqrt(max(1, nt))
+        first = p.lstrip()[:1]
+        if first in "#-•*" or re.match(r"\s*(\d+[.)]|[①-⑩])", p):
+            s *= 1.3  # 헤딩/불릿은 구조 모사에 중요
+        if any(ch.isdigit() for ch in p):
+            s *= 1.1
+        if i == 0 or i == n - 1:
+            s *= 1.5  # 도입/마무리는 글의 틀
+        scores.append(s)
+    return scores
+
+
+@functools.lru_cache(maxsize=32)
+def fit_reference(text: str, budget_tokens: int, model: str = "gpt-4o-mini") -> Tuple[str, Dict[str, int]]:
+    """
+    레퍼런스를 토큰 예산에 맞춤.
+    - 예산 안이면 그대로
+    - 넘으면 문단별 정보량/토큰 비율이 높은 순으로 채운 뒤 원래 순서로 복원,
+      빠진 구간에는 중략 표시
+    반환: (본문, {"tokens", "original_tokens", "paragraphs", "kept"})
+    (빌더와 실행기가 같은 인자로 다시 부르므로 실행 중에는 메모이즈)
+    """
+    text = (text or "").strip()
+    total = count_tokens(text, model)
+    paras = split_paragraphs(text)
+    if total <= budget_tokens:
+        return text, {"tokens": total, "original_tokens": total, "paragraphs": len(paras), "kept": len(paras)}
+
+    n_tokens = [count_tokens(p, model) for p in paras]
+    scores = _paragraph_scores(paras, n_tokens)
+    mark_cost = count_tokens(_OMIT_MARK, model) + 2
+    order = sorted(range(len(paras)), key=lambda i: scores[i] / max(1, n_tokens[i]) ** 0.25, reverse=True)
+
+    picked: Dict[int, str] = {}
+    used = 0
+    for i in order:
+        cost = n_tokens[i] + mark_cost
+        if used + cost <= budget_tokens:
+            picked[i] = paras[i]
+            used += cost
+        elif not picked:
+            # 첫 후보 하나도 안 들어가면 잘라서라도 넣음
+            picked[i] = truncate_to_tokens(paras[i], budget_tokens - mark_cost, model)
+            used = budget_tokens
+            break
+
+    out: List[str] = []
+    prev = -1
+    for i in sorted(picked):
+        if i != prev + 1:
+            out.append(_OMIT_MARK)
+        out.append(picked[i])
+        prev = i
+    if prev != len(paras) - 1:
+        out.append(_OMIT_MARK)
+    body = "\n\n".join(out)
+    return body, {"tokens": count_tokens(body, model), "original_tokens": total, "paragraphs": len(paras), "kept": len(picked)}
+
+
+def ref_token_budget(kind: str = "reference") -> int:
+    """사이드바 설정(prompt_ref_tokens) × 빌더별 비율. 스크립트 스레드 밖에서는 기본값."""
+    try:
+        base = int(st.session_state.get("prompt_ref_tokens", REF_TOKEN_BUDGET_DEFAULT))
+    except Exception:
+        base = REF_TOKEN_BUDGET_DEFAULT
+    return int(base * REF_BUDGET_SCALE.get(kind, 1.0))
+
+
+def prompt_token_report(system: str, user: str, model: str, ref_stats: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """실행 1회의 입력 토큰/컨텍스트 여유/예상 비용."""
+    n = count_tokens(system, model) + count_tokens(user, model)
+    ctx = MODEL_CONTEXT_TOKENS.get(model, 128_000)
+    price = MODEL_INPUT_USD_PER_MTOK.get(model, 0.0)
+    report = {
+        "model": model,
+        "input_tokens": n,
+        "context_left": ctx - n - OUTPUT_TOKEN_RESERVE,
+        "input_usd": round(n * price / 1_000_000, 6),
+        "exact": _tiktoken_encoding(model) is not None,
+    }
+    if ref_stats:
+        report["reference"] = ref_stats
+    return report
+
+
+def render_token_report(report: Optional[Dict[str, Any]]):
+    if not report:
+        return
+    ref = report.get("reference") or {}
+    ref_part = ""
+    if ref:
+        ref_part = f" · 레퍼런스 {ref['tokens']}/{ref['original_tokens']} 토큰 (문단 {ref['kept']}/{ref['paragraphs']})"
+    approx = "" if report.get("exact") else " (근사)"
+    st.caption(f"🧮 입력 {report['input_tokens']} 토큰{approx} · ≈${report['input_usd']:.4f}{ref_part}")
+
+
 # ============================================================
 # SNS Marketing Helpers (NEW)
 # - 레퍼런스 텍스트에서 캡션/대본 스타일 특징 분석
@@ -466,55 +1836,78 @@ def clamp_text(t: str, max_chars: int = 12000) -> str:
     t = (t or "").strip()
     return t[:max_chars]
 
+_PARA_SPLIT_RE = re.compile(r"\n\s*\n")
+# 공백을 한 칸으로 정규화한 뒤에 쓰므로 "문장부호 뒤 공백 한 칸"만 보면 됨
+# (기존 "[다요죠]." 뒤 분리는 "." 뒤 분리에 포함되고, 줄바꿈은 정규화 때 사라짐)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?。]) ")
+
+
 def split_paragraphs(text: str) -> List[str]:
-    paras = re.split(r"\n\s*\n", (text or "").strip())
+    paras = _PARA_SPLIT_RE.split((text or "").strip())
     return [p.strip() for p in paras if p.strip()]
 
 def rough_sentence_split(text: str) -> List[str]:
     # 한국어/영어 혼합 대응: 문장부호 + 줄바꿈 기반
-    t = re.sub(r"\s+", " ", (text or "").strip())
+    t = " ".join((text or "").split())
     if not t:
         return []
-    parts = re.split(r"(?<=[\.\!\?\。])\s+|(?<=[다요죠]\.)\s+|\n+", t)
-    parts = [p.strip() for p in parts if p.strip()]
-    return parts
+    return [p for p in _SENTENCE_SPLIT_RE.split(t) if p]
+
+# ------------------------------------------------------------
+# SNS 스타일 분석기
+# - 키워드(CTA/정보/후기/톤/플랫폼)는 중복 없이 한 표로 모아 키워드당 한 번만 포함 여부 확인
+#   (str 포함 검사는 C 수준 + 첫 발견 시 종료라서 파이썬으로 만든 자동자보다 빠름)
+# - 이모지/해시태그/문장/문단 정규식은 모듈 로드 때 한 번만 컴파일
+# - 결과는 텍스트 해시 기준으로 메모이즈
+# ------------------------------------------------------------
+# CTA 추정 (한국/인스타/블로그 공통) — 순서가 cta_phrases 출력 순서
+SNS_CTA_KEYWORDS = [
+    "저장", "공유", "팔로우", "댓글", "DM", "문의", "링크", "프로필", "예약",
+    "지금", "바로", "확인", "참고", "추천", "방문", "체험"
+]
+SNS_INFO_KEYWORDS = ["가격", "메뉴", "위치", "영업", "주차", "웨이팅", "예약", "시간"]
+SNS_REVIEW_KEYWORDS = ["맛", "식감", "분위기", "서비스", "재방문", "추천"]
+SNS_TONE_KEYWORDS = ["해요", "했어요", "입니다", "합니다", "주세요"]
+SNS_FIRM_KEYWORDS = ["무조건", "필수"]
+SNS_PLATFORM_KEYWORDS = ["릴스", "스토리"]
+SNS_ALL_KEYWORDS = list(dict.fromkeys(
+    SNS_CTA_KEYWORDS + SNS_INFO_KEYWORDS + SNS_REVIEW_KEYWORDS
+    + SNS_TONE_KEYWORDS + SNS_FIRM_KEYWORDS + SNS_PLATFORM_KEYWORDS
+))
+
+_EMOJI_RE = re.compile(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]")
+_HASHTAG_RE = re.compile(r"#\w+")
+
+
+def present_keywords(text: str, keywords: List[str] = SNS_ALL_KEYWORDS) -> set:
+    return {k for k in keywords if k in text}
+
+
+def _empty_sns_profile() -> Dict[str, Any]:
+    return {
+        "hashtag_count": 0,
+        "emoji_density": 0.0,
+        "avg_sentence_len": 0,
+        "avg_paragraph_len": 0,
+        "cta_phrases": [],
+        "structure_guess": [],
+        "tone_guess": "보통",
+        "platform_hint": "unknown"
+    }
 
-def analyze_sns_style(reference_text: str) -> Dict[str, Any]:
-    """
-    레퍼런스에서 SNS 톤/구조 특징을 뽑아내는 간단한 휴리스틱 분석기
-    """
-    ref = (reference_text or "").strip()
-    if not ref:
-        return {
-            "hashtag_count": 0,
-            "emoji_density": 0.0,
-            "avg_sentence_len": 0,
-            "avg_paragraph_len": 0,
-            "cta_phrases": [],
-            "structure_guess": [],
-            "tone_guess": "보통",
-            "platform_hint": "unknown"
-        }
 
-    emojis = re.findall(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]", ref)
-    hashtag = re.findall(r"#\w+", ref)
+def _analyze_sns_style_uncached(ref: str) -> Dict[str, Any]:
+    n_emoji = len(_EMOJI_RE.findall(ref))
+    n_hashtag = len(_HASHTAG_RE.findall(ref))
+    found = present_keywords(ref)
     sentences = rough_sentence_split(ref)
     paras = split_paragraphs(ref)
 
     avg_sentence_len = int(sum(len(s) for s in sentences) / max(1, len(sentences)))
     avg_paragraph_len = int(sum(len(p) for p in paras) / max(1, len(paras)))
-    emoji_density = round(len(emojis) / max(1, len(ref)), 4)
+    emoji_density = round(n_emoji / max(1, len(ref)), 4)
 
-    # CTA 추정 (한국/인스타/블로그 공통)
-    cta_candidates = [
-        "저장", "공유", "팔로우", "댓글", "DM", "문의", "링크", "프로필", "예약",
-        "지금", "바로", "확인", "참고", "추천", "방문", "체험"
-    ]
-    found_cta = []
-    for c in cta_candidates:
-        if c in ref:
-            found_cta.append(c)
-    found_cta = list(dict.fromkeys(found_cta))[:8]
+    found_cta = [c for c in SNS_CTA_KEYWORDS if c in found][:8]
 
     # 구조 추정: 후킹/정보/후기/CTA/해시태그
     structure = []
@@ -523,28 +1916,28 @@ def analyze_sns_style(reference_text: str) -> Dict[str, Any]:
         first = sentences[0]
         if len(first) <= 40 or "?" in first or "!" in first:
             structure.append("후킹(짧은 첫 문장/질문/감탄)")
-    if any(k in ref for k in ["가격", "메뉴", "위치", "영업", "주차", "웨이팅", "예약", "시간"]):
+    if any(k in found for k in SNS_INFO_KEYWORDS):
         structure.append("정보(가격/위치/운영/팁)")
-    if any(k in ref for k in ["맛", "식감", "분위기", "서비스", "재방문", "추천"]):
+    if any(k in found for k in SNS_REVIEW_KEYWORDS):
         structure.append("후기(경험 기반 평가)")
     if found_cta:
         structure.append("CTA(저장/팔로우/문의 등)")
-    if hashtag:
+    if n_hashtag:
         structure.append("해시태그")
 
     # 톤 추정
     # 존댓말/친근/단호 대충 분류
     tone_guess = "보통"
-    if re.search(r"(해요|했어요|입니다|합니다|주세요)", ref):
-        tone_guess = "친근한" if "해요" in ref or "했어요" in ref else "격식체"
-    if "무조건" in ref or "필수" in ref:
+    if any(k in found for k in SNS_TONE_KEYWORDS):
+        tone_guess = "친근한" if "해요" in found or "했어요" in found else "격식체"
+    if any(k in found for k in SNS_FIRM_KEYWORDS):
         tone_guess = "단호한"
 
     # 플랫폼 힌트
-    platform_hint = "instagram" if len(hashtag) >= 3 or "릴스" in ref or "스토리" in ref else "blog"
+    platform_hint = "instagram" if n_hashtag >= 3 or any(k in found for k in SNS_PLATFORM_KEYWORDS) else "blog"
 
     return {
-        "hashtag_count": len(hashtag),
+        "hashtag_count": n_hashtag,
         "emoji_density": emoji_density,
         "avg_sentence_len": avg_sentence_len,
         "avg_paragraph_len": avg_paragraph_len,
@@ -554,25 +1947,149 @@ def analyze_sns_style(reference_text: str) -> Dict[str, Any]:
         "platform_hint": platform_hint
     }
 
-def build_sns_generate_prompt(
-    api_payload: Dict[str, Any],
-    reference_text: str,
-    style_profile: Dict[str, Any],
-    platform: str,
-    niche: str,
-    goal: str,
-    output_type: str,
-    constraints: Dict[str, Any],
-) -> Tuple[str, str]:
-    """
-    SNS 전용 생성 프롬프트 (캡션/대본)
-    - reference_text: 레퍼런스(블로그 글/인스타 캡션/대본)
-    - style_profile: analyze_sns_style 결과
-    """
-    ref = clamp_text(reference_text, 6500)
-    sp = style_profile or {}
 
-    # 사용자가 입력한 핵심 정보 (맛집/홍보에 유용한 필드)
+@st.cache_data(show_spinner=False, max_entries=2048)
+def _analyze_sns_style_cached(text_hash: str, _ref: str) -> Dict[str, Any]:
+    # _ref는 해시 대상에서 제외(키는 text_hash만)
+    return _analyze_sns_style_uncached(_ref)
+
+
+def analyze_sns_style(reference_text: str) -> Dict[str, Any]:
+    """
+    레퍼런스에서 SNS 톤/구조 특징을 뽑아내는 간단한 휴리스틱 분석기
+    """
+    ref = (reference_text or "").strip()
+    if not ref:
+        return _empty_sns_profile()
+    return _analyze_sns_style_cached(hashlib.sha1(ref.encode("utf-8")).hexdigest(), ref)
+
+# ------------------------------------------------------------
+# 코퍼스(여러 레퍼런스) 스타일 프로파일
+# - 문서들을 한 문자열로 이어 붙여 정규식은 한 번씩만 돌리고,
+#   매치 위치 → 문서 번호는 np.searchsorted로 한꺼번에 매핑
+# - 문서별 지표는 NumPy 배열로 모아 분위수(p10/p50/p90) 분포로 요약
+# ------------------------------------------------------------
+CORPUS_DOC_SEP = "\n"  # 공백 정규화 후에는 문서 안에 줄바꿈이 남지 않음
+
+
+def split_corpus_text(raw: str) -> List[str]:
+    """붙여넣은 코퍼스: '---' 한 줄로 문서를 구분."""
+    return [d.strip() for d in re.split(r"(?m)^\s*-{3,}\s*$", raw or "") if d.strip()]
+
+
+def _dist(arr) -> Dict[str, float]:
+    import numpy as np
+
+    if arr.size == 0:
+        return {"p10": 0.0, "p50": 0.0, "p90": 0.0, "mean": 0.0}
+    p10, p50, p90 = np.percentile(arr, [10, 50, 90])
+    return {"p10": round(float(p10), 2), "p50": round(float(p50), 2), "p90": round(float(p90), 2), "mean": round(float(arr.mean()), 2)}
+
+
+def analyze_sns_corpus(texts: List[str]) -> Dict[str, Any]:
+    """
+    여러 캡션/블로그 글의 스타일 분포. build_sns_generate_prompt(corpus_profile=...)에 그대로 넣는다.
+    """
+    import numpy as np
+
+    docs = [" ".join((t or "").split()) for t in texts]
+    docs = [d for d in docs if d]
+    n = len(docs)
+    if not n:
+        return {"n_docs": 0}
+
+    lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=n)
+    starts = np.concatenate(([0], np.cumsum(lengths + len(CORPUS_DOC_SEP))[:-1]))
+    joined = CORPUS_DOC_SEP.join(docs)
+
+    def per_doc_counts(pattern) -> "np.ndarray":
+        pos = np.fromiter((m.start() for m in pattern.finditer(joined)), dtype=np.int64)
+        return np.bincount(np.searchsorted(starts, pos, side="right") - 1, minlength=n)
+
+    emoji = per_doc_counts(_EMOJI_RE)
+    hashtags = per_doc_counts(_HASHTAG_RE)
+
+    # 문장: 구분자(문장 분리 공백/문서 구분 줄바꿈)가 모두 1글자라 조각 길이 누적합으로 시작 위치 복원
+    parts = re.split(r"(?<=[.!?。]) |" + re.escape(CORPUS_DOC_SEP), joined)
+    part_len = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    part_start = np.concatenate(([0], np.cumsum(part_len + 1)[:-1]))
+    keep = part_len > 0
+    sent_len = part_len[keep]
+    sent_doc = np.searchsorted(starts, part_start[keep], side="right") - 1
+    sent_count = np.bincount(sent_doc, minlength=n)
+    avg_sent_per_doc = np.bincount(sent_doc, weights=sent_len, minlength=n) / np.maximum(1, sent_count)
+
+    # CTA: 키워드별 문서 포함 여부 행렬 (n_docs × n_cta)
+    cta_hits = np.array([[k in d for k in SNS_CTA_KEYWORDS] for d in docs], dtype=bool)
+    cta_rate = cta_hits.mean(axis=0)
+    top_cta = [
+        {"phrase": SNS_CTA_KEYWORDS[i], "doc_rate": round(float(cta_rate[i]), 3)}
+        for i in np.argsort(-cta_rate)[:8] if cta_rate[i] > 0
+    ]
+
+    paras = np.fromiter((len(split_paragraphs(t)) for t in texts if (t or "").strip()), dtype=np.int64, count=n)
+    platform_ig = (hashtags >= 3) | np.array([any(k in d for k in SNS_PLATFORM_KEYWORDS) for d in docs], dtype=bool)
+
+    return {
+        "n_docs": n,
+        "length": _dist(lengths),
+        "sentence_len": _dist(sent_len),
+        "avg_sentence_len_per_doc": _dist(avg_sent_per_doc),
+        "sentences_per_doc": _dist(sent_count),
+        "paragraphs_per_doc": _dist(paras),
+        "hashtag_count": _dist(hashtags),
+        "emoji_per_100": _dist(emoji * 100 / np.maximum(1, lengths)),
+        "cta_per_doc": _dist(cta_hits.sum(axis=1)),
+        "top_cta": top_cta,
+        "instagram_share": round(float(platform_ig.mean()), 3),
+    }
+
+
+def render_corpus_profile_block(cp: Dict[str, Any]) -> str:
+    """프롬프트에 넣을 코퍼스 분포 요약."""
+    if not cp or not cp.get("n_docs"):
+        return ""
+
+    def d(key):
+        v = cp.get(key) or {}
+        return f"p10={v.get('p10')} / p50={v.get('p50')} / p90={v.get('p90')}"
+
+    top = ", ".join(f"{c['phrase']}({int(c['doc_rate'] * 100)}%)" for c in cp.get("top_cta") or []) or "-"
+    return f"""
+[레퍼런스 코퍼스 분포 (문서 {cp['n_docs']}개)]
+- 글 길이(자): {d('length')}
+- 문장 길이(자): {d('sentence_len')}
+- 문단 수: {d('paragraphs_per_doc')}
+- 해시태그 수: {d('hashtag_count')}
+- 이모지(100자당): {d('emoji_per_100')}
+- CTA 사용(문서 비율): {top}
+- 인스타형 비율: {cp.get('instagram_share')}
+- 결과물의 길이/문장 길이/해시태그 수는 p50 근처, p10~p90 범위 안에 들도록 맞춰라.
+"""
+
+
+def build_sns_generate_prompt(
+    api_payload: Dict[str, Any],
+    reference_text: str,
+    style_profile: Dict[str, Any],
+    platform: str,
+    niche: str,
+    goal: str,
+    output_type: str,
+    constraints: Dict[str, Any],
+    corpus_profile: Optional[Dict[str, Any]] = None,
+    model: str = "gpt-4o-mini",
+) -> Tuple[str, str]:
+    """
+    SNS 전용 생성 프롬프트 (캡션/대본)
+    - reference_text: 레퍼런스(블로그 글/인스타 캡션/대본)
+    - style_profile: analyze_sns_style 결과
+    - corpus_profile: analyze_sns_corpus 결과(있으면 분포 기준으로 맞춤)
+    """
+    ref, _ = fit_reference(clamp_text(reference_text, 60000), ref_token_budget("sns"), model)
+    sp = style_profile or {}
+
+    # 사용자가 입력한 핵심 정보 (맛집/홍보에 유용한 필드)
     # api_payload["text"] = 사용자가 '원본'에 넣은 내용 (가게 소개/후기/메모 등)
     base_text = (api_payload.get("text") or "").strip()
 
@@ -619,7 +2136,7 @@ def build_sns_generate_prompt(
 - hashtag_count: {sp.get("hashtag_count")}
 - cta_phrases: {sp.get("cta_phrases")}
 - platform_hint: {sp.get("platform_hint")}
-
+{render_corpus_profile_block(corpus_profile)}
 [작성 규칙]
 - 플랫폼별 최적화:
   - instagram: 첫 2줄 후킹 강하게, 짧은 문장, 줄바꿈 적극, CTA 1개, 해시태그 포함 가능
@@ -657,19 +2174,29 @@ def run_sns_generation(
     SNS 생성 실행: 레퍼런스 + 스타일 분석 기반
     """
     ref_text = (st.session_state.reference_text or "").strip()
-    style_profile = analyze_sns_style(ref_text) if ref_text else {}
-    system, user = build_sns_generate_prompt(
-        api_payload=base_payload,
-        reference_text=ref_text,
-        style_profile=style_profile,
-        platform=platform,
-        niche=niche,
-        goal=goal,
-        output_type=output_type,
-        constraints=constraints,
-    )
-    raw = call_openai(api_key, model, system, user, temperature)
-    data = safe_json(raw)
+    with span("sns.analyze", ref_chars=len(ref_text)):
+        style_profile = analyze_sns_style(ref_text) if ref_text else {}
+    with span("sns.prompt"):
+        system, user = build_sns_generate_prompt(
+            api_payload=base_payload,
+            reference_text=ref_text,
+            style_profile=style_profile,
+            platform=platform,
+            niche=niche,
+            goal=goal,
+            output_type=output_type,
+            constraints=constraints,
+            corpus_profile=st.session_state.get("reference_corpus_profile") or None,
+            model=model,
+        )
+        ref_stats = fit_reference(clamp_text(ref_text, 60000), ref_token_budget("sns"), model)[1] if ref_text else None
+    st.session_state.last_token_report = prompt_token_report(system, user, model, ref_stats)
+    with span("sns.llm", model=model):
+        data, _ = call_openai_rewrite(
+            api_key, model, system, user, temperature,
+            use_cache=st.session_state.get("use_llm_cache", True),
+            structured=bool(st.session_state.get("structured_output", False)),
+        )
     return data
 
 # ============================================================
@@ -679,72 +2206,322 @@ def run_sns_generation(
 # - 라이브러리 저장/불러오기
 # ============================================================
 
-def simple_structure_guess(text: str) -> Dict[str, Any]:
-    t = (text or "").strip()
-    if not t:
-        return {"type": "unknown", "sections": [], "style_rules": {}}
+# ------------------------------------------------------------
+# Local template extractor
+# - API 호출 없이 LLM 템플릿과 같은 JSON 모양을 만든다 (수 ms)
+# - 헤딩: 마크다운/번호(1. 1) (1) ① 가. Ⅰ. 제1장)/괄호([ ] 【 】)/기호(■ ▶)/굵게/짧은 단독 줄
+# - 문단 역할: 유형별 단서 어휘 가중치 + 위치(앞/뒤) 적합도의 선형 점수 → argmax
+# - 스타일: 헤딩·불릿 표기, 문장 길이/문단당 문장 수(리듬), 어미로 톤, 반복되는 시작/끝 표현
+# - confidence: 헤딩이 뚜렷하고 역할/유형 단서가 많을수록 높음 → 자동 모드에서 LLM 대신 쓸지 판단
+# ------------------------------------------------------------
+LOCAL_TEMPLATE_MIN_CONFIDENCE = 0.6
+LOCAL_TEMPLATE_MAX_SECTIONS = 8
+TEMPLATE_EXTRACTORS = {
+    "auto": "자동 (로컬 우선, 애매하면 LLM)",
+    "local": "로컬만 (API 호출 없음)",
+    "llm": "LLM",
+}
+
+# 유형별 역할: slot → (기본 헤딩, guidance, 단서 어휘). 순서 = 글에서 기대되는 위치 순서
+TEMPLATE_ROLE_MODEL: Dict[str, Dict[str, Tuple[str, str, List[str]]]] = {
+    "resume": {
+        "motivation": ("지원 동기", "회사/직무를 선택한 계기와 이유", ["지원", "동기", "계기", "관심을", "매력", "선택한", "비전", "가치관"]),
+        "situation": ("상황", "문제/맥락을 2~3문장으로", ["당시", "상황", "문제", "어려움", "과제", "배경", "처음", "부족"]),
+        "action": ("행동", "내 역할/행동/의사결정/협업", ["제가", "저는", "담당", "주도", "제안", "설계", "구현", "협업", "분석", "도입", "진행", "맡아"]),
+        "result": ("성과", "수치/결과/임팩트 (없으면 정성적 효과)", ["결과", "성과", "달성", "증가", "감소", "상승", "단축", "절감", "수상", "%"]),
+        "learning": ("배운 점", "인사이트/원리/재현성", ["배웠", "깨달", "교훈", "느꼈", "성장", "경험을 통해", "중요성"]),
+        "fit": ("직무 연결", "지원 직무/회사에 기여 연결", ["입사", "기여", "직무", "앞으로", "되겠습니다", "싶습니다", "목표", "포부"]),
+    },
+    "paper": {
+        "background": ("배경", "주제의 맥락과 중요성", ["최근", "배경", "중요", "증가하고", "주목", "관심이", "introduction"]),
+        "problem": ("문제/한계", "기존 접근의 한계", ["한계", "문제", "어렵", "부족", "기존 연구", "기존의", "limitation"]),
+        "gap": ("연구 공백", "왜 아직 해결되지 않았는지", ["공백", "아직", "미흡", "다루지", "밝혀지지", "gap"]),
+        "purpose": ("목적/기여", "무엇을 제안/검증하는지", ["본 연구", "본 논문", "목적", "제안한다", "기여", "검증", "purpose"]),
+        "method": ("방법", "데이터/절차/분석 방법", ["방법", "데이터", "실험", "분석", "표본", "모형", "측정", "method"]),
+        "result": ("결과", "핵심 발견과 수치", ["결과", "나타났", "유의", "확인되었", "보였", "%", "results"]),
+        "implication": ("시사점", "의의/적용/향후 연구", ["시사", "의의", "향후", "결론", "제언", "한계점", "conclusion"]),
+    },
+    "generic": {
+        "intro": ("도입", "핵심 메시지", ["오늘", "소개", "안녕하세요", "이번", "요약"]),
+        "body": ("핵심 내용", "논리 전개", ["첫째", "둘째", "또한", "그리고", "특히", "이유"]),
+        "example": ("사례", "구체적인 예/경험", ["예를 들어", "예시", "사례", "실제로", "경우"]),
+        "close": ("마무리", "요약 + 다음 행동", ["마무리", "정리", "결론", "감사", "저장", "팔로우", "댓글", "링크"]),
+    },
+}
+_TYPE_CUES = {
+    "resume": ["지원동기", "지원 동기", "직무", "역량", "입사", "프로젝트", "협업", "성과", "자기소개"],
+    "paper": ["본 연구", "본 논문", "연구 목적", "선행 연구", "abstract", "introduction", "method", "results", "conclusion", "서론", "결론", "참고문헌"],
+    "generic": ["소개해요", "추천", "팔로우", "구독", "#"],
+}
+_DEFAULT_SKELETON_SLOTS = {
+    "paper": ["background", "problem", "gap", "purpose", "implication"],
+    "resume": ["situation", "action", "result", "learning", "fit"],
+    "generic": ["intro", "body", "close"],
+}
 
-    lines = [ln.strip() for ln in t.splitlines() if ln.strip()]
-    headings = []
+_MD_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*$")
+_BOLD_HEADING_RE = re.compile(r"^\*\*(.+?)\*\*\s*:?$")
+_CHAPTER_HEADING_RE = re.compile(r"^(제\s*\d+\s*[장절항부]|[IVX]{1,4}\.|[ⅠⅡⅢⅣⅤⅥⅦⅧⅨⅩ]\.?)\s*(.*)$")
+_NUM_HEADING_RE = re.compile(r"^(\d{1,2}(?:\.\d{1,2})*[\.\)]|\(\d{1,2}\)|[①-⑳]|[가-하][\.\)])\s*(.+)$")
+_BRACKET_HEADING_RE = re.compile(r"^[\[【〈《<]\s*(.+?)\s*[\]】〉》>]\s*:?$")
+_SYMBOL_HEADING_RE = re.compile(r"^([■□◆◇▶▷●◎★☆])\s*(.+)$")
+_BULLET_LINE_RE = re.compile(r"^([-–*•·▪◦○✔✓])\s+")
+_NUM_ITEM_LINE_RE = re.compile(r"^(\d{1,2}[\.\)]|[①-⑳])\s+")
+_SENT_SPLIT_RE = re.compile(r"(?<=[\.\!\?。…])\s+|(?<=[다요죠])\.?\s+(?=[가-힣A-Za-z\"'“‘(])")
+_SENTENCE_END_RE = re.compile(r"([다요죠까음함됨임][\.\!\?]?|[\.\!\?…])[\"'”’)]*$")
+
+
+def _line_heading(line: str, next_line: str) -> Optional[Tuple[str, str]]:
+    """헤딩이면 (표기 방식, 제목). 번호 줄은 짧고 문장으로 끝나지 않을 때만 헤딩(아니면 번호 목록)."""
+    m = _MD_HEADING_RE.match(line)
+    if m:
+        return "#" * len(m.group(1)), m.group(2).strip()
+    m = _BOLD_HEADING_RE.match(line)
+    if m:
+        return "bold", m.group(1).strip()
+    m = _BRACKET_HEADING_RE.match(line)
+    if m and len(m.group(1)) <= 40:
+        return "bracket", m.group(1).strip()
+    for rx, style in ((_CHAPTER_HEADING_RE, "numbering"), (_NUM_HEADING_RE, "numbering"), (_SYMBOL_HEADING_RE, "symbol")):
+        m = rx.match(line)
+        if m:
+            title = (m.group(2) or m.group(1)).strip()
+            if len(title) <= 40 and not _SENTENCE_END_RE.search(title):
+                return style, title
+            return None
+    # 표기 없는 짧은 단독 줄 + 다음 줄이 본문
+    if (
+        len(line) <= 25
+        and not _SENTENCE_END_RE.search(line)
+        and not _BULLET_LINE_RE.match(line)
+        and "#" not in line
+        and len(next_line) > 40
+    ):
+        return "plain", line.rstrip(":：")
+    return None
+
+
+def _split_sentences(text: str) -> List[str]:
+    return [x.strip() for x in _SENT_SPLIT_RE.split(text or "") if len(x.strip()) > 1]
+
+
+def _cue_score(text: str, cues: List[str]) -> float:
+    low = text.lower()
+    return float(sum(low.count(c) for c in cues))
+
+
+def _classify_role(text: str, heading: str, position: float, roles: Dict[str, Tuple[str, str, List[str]]]) -> Tuple[str, float]:
+    """(slot, 단서 점수). 점수 = 본문 단서 + 헤딩 단서×3 - 기대 위치와의 거리."""
+    best, best_score, best_cue = "", -1e9, 0.0
+    n = len(roles)
+    for k, (slot, (label, _, cues)) in enumerate(roles.items()):
+        cue = min(_cue_score(text, cues), 4.0) + 3.0 * (_cue_score(heading, cues + [label]) > 0)
+        expected = k / max(1, n - 1)
+        score = cue - 1.5 * abs(position - expected)
+        if score > best_score:
+            best, best_score, best_cue = slot, score, cue
+    return best, best_cue
+
+
+def _classify_type(text: str, headings: List[str]) -> Tuple[str, float]:
+    """(type, 확신도 0~1)."""
+    head_text = " ".join(headings)
+    scores = {}
+    for tpe, cues in _TYPE_CUES.items():
+        role_cues = [c for _, _, cs in TEMPLATE_ROLE_MODEL[tpe].values() for c in cs]
+        scores[tpe] = (
+            2.0 * _cue_score(text[:20000], cues)
+            + 0.3 * min(_cue_score(text[:20000], role_cues), 30.0)
+            + 4.0 * _cue_score(head_text, cues + [lbl for lbl, _, _ in TEMPLATE_ROLE_MODEL[tpe].values()])
+        )
+    endings = re.findall(r"(습니다|합니다|한다|이다|였다|했다|해요|어요|에요)[\.\!\?]", text[:20000])
+    plain = sum(e in ("한다", "이다", "였다", "했다") for e in endings)
+    polite = sum(e in ("습니다", "합니다") for e in endings)
+    casual = len(endings) - plain - polite
+    scores["paper"] += 0.5 * plain
+    scores["resume"] += 0.3 * polite
+    scores["generic"] += 0.5 * casual
+    ranked = sorted(scores.items(), key=lambda kv: -kv[1])
+    top, second = ranked[0][1], ranked[1][1]
+    if top < 2.0:
+        return "generic", 0.2
+    return ranked[0][0], min(1.0, (top - second) / (top + 1.0) * 2)
+
+
+def _style_from_text(blocks: List[Dict[str, Any]], lines: List[str], text: str, tpe: str) -> Dict[str, Any]:
+    heading_styles = collections.Counter(b["style"] for b in blocks if b.get("style"))
+    if heading_styles:
+        style = heading_styles.most_common(1)[0][0]
+        heading_style = {"bold": "**굵게**", "bracket": "[괄호]", "symbol": "기호(■/▶)", "plain": "none"}.get(style, style)
+    else:
+        heading_style = "none"
+
+    bullets = collections.Counter()
     for ln in lines:
-        if re.match(r"^(#{1,4}\s+)", ln) or re.match(r"^(\d+[\.\)]\s+)", ln) or re.match(r"^(\(\d+\)\s+)", ln):
-            headings.append(ln)
-
-    lower = t.lower()
-    is_paperish = any(k in lower for k in ["abstract", "introduction", "method", "results", "conclusion"]) or any(k in t for k in ["본 연구", "본 논문", "연구 목적"])
-    is_resumeish = any(k in t for k in ["지원동기", "직무", "역량", "경험", "성과", "프로젝트", "팀", "협업", "문제", "해결"])
-
-    if headings:
-        sections = [{"heading": h.replace("#", "").strip(), "slot": f"sec_{i+1}", "guidance": ""} for i, h in enumerate(headings[:8])]
-        return {
-            "type": "paper" if is_paperish else ("resume" if is_resumeish else "generic"),
-            "sections": sections,
-            "style_rules": {
-                "heading_style": "use_detected_headings",
-                "bullet_style": "dash",
-                "tone_hint": "match_reference",
-                "signature_patterns": []
-            }
-        }
+        m = _BULLET_LINE_RE.match(ln)
+        if m:
+            bullets["dash" if m.group(1) in "-–*" else ("check" if m.group(1) in "✔✓" else "dot")] += 1
+        elif _NUM_ITEM_LINE_RE.match(ln) and _SENTENCE_END_RE.search(ln):
+            bullets["numbered"] += 1
+    bullet_style = bullets.most_common(1)[0][0] if sum(bullets.values()) >= 2 else "none"
+
+    sentences = _split_sentences(re.sub(r"\s+", " ", text))
+    lens = [len(x) for x in sentences] or [0]
+    avg = sum(lens) / len(lens)
+    paras = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+    per_para = len(sentences) / max(1, len(paras))
+    label = "짧게" if avg < 25 else ("보통" if avg < 50 else "길게")
+    rhythm = f"{label} (문장 평균 {avg:.0f}자, 문단당 {per_para:.1f}문장)"
+
+    endings = collections.Counter(re.findall(r"(습니다|합니다|한다|이다|였다|했다|해요|어요|에요|죠)[\.\!\?]", text))
+    emoji = len(re.findall(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]", text))
+    polite = endings["습니다"] + endings["합니다"]
+    plain = endings["한다"] + endings["이다"] + endings["였다"] + endings["했다"]
+    casual = endings["해요"] + endings["어요"] + endings["에요"] + endings["죠"] + text.count("!") // 2 + emoji
+    if plain > max(polite, casual) or tpe == "paper" and plain >= polite:
+        tone = "academic"
+    elif casual > polite:
+        tone = "friendly"
+    else:
+        tone = "professional"
+
+    # 반복되는 문장 시작(첫 어절)과 끝맺음(마지막 4글자)
+    patterns = []
+    openers = collections.Counter(x.split()[0] for x in sentences if x.split())
+    for w, c in openers.most_common(6):
+        if c >= 2 and len(w) >= 2 and not re.match(r"^[\d\W]", w):
+            patterns.append(f"'{w} ~'로 시작 ({c}회)")
+    closers = collections.Counter(re.sub(r"[\.\!\?…\"'”’)\s]+$", "", x)[-4:] for x in sentences)
+    for w, c in closers.most_common(4):
+        if c >= 3 and len(w) >= 3:
+            patterns.append(f"'~{w}'로 끝맺음 ({c}회)")
+    hashtags = re.findall(r"#[^\s#]+", text)
+    if len(hashtags) >= 3:
+        patterns.append(f"끝에 해시태그 {len(hashtags)}개")
+    return {
+        "heading_style": heading_style,
+        "bullet_style": bullet_style,
+        "sentence_rhythm": rhythm,
+        "tone_hint": tone,
+        "signature_patterns": patterns[:5],
+    }
 
-    if is_paperish:
-        return {
-            "type": "paper",
-            "sections": [
-                {"heading": "배경", "slot": "background", "guidance": "주제의 맥락과 중요성"},
-                {"heading": "문제/한계", "slot": "problem", "guidance": "기존 접근의 한계"},
-                {"heading": "연구 공백", "slot": "gap", "guidance": "왜 아직 해결되지 않았는지"},
-                {"heading": "목적/기여", "slot": "purpose", "guidance": "무엇을 제안/검증하는지"},
-                {"heading": "시사점", "slot": "implication", "guidance": "의의/적용/향후 연구"},
-            ],
-            "style_rules": {"heading_style": "###", "bullet_style": "none", "tone_hint": "academic", "signature_patterns": []}
-        }
 
-    if is_resumeish:
-        return {
-            "type": "resume",
-            "sections": [
-                {"heading": "상황", "slot": "situation", "guidance": "문제/맥락을 2~3문장으로"},
-                {"heading": "행동", "slot": "action", "guidance": "내 역할/행동/의사결정/협업"},
-                {"heading": "성과", "slot": "result", "guidance": "수치/결과/임팩트 (없으면 정성적 효과)"},
-                {"heading": "배운 점", "slot": "learning", "guidance": "인사이트/원리/재현성"},
-                {"heading": "직무 연결", "slot": "fit", "guidance": "지원 직무/회사에 기여 연결"},
-            ],
-            "style_rules": {"heading_style": "###", "bullet_style": "dash", "tone_hint": "professional", "signature_patterns": []}
-        }
+def _section_guidance(base: str, body: str) -> str:
+    hints = [base]
+    if re.search(r"\d+(\.\d+)?\s*(%|배|명|건|개|원|시간|일|주|개월|년|p)", body):
+        hints.append("구체적 수치 포함")
+    n_bullets = sum(1 for ln in body.splitlines() if _BULLET_LINE_RE.match(ln.strip()) or _NUM_ITEM_LINE_RE.match(ln.strip()))
+    if n_bullets >= 2:
+        hints.append(f"불릿 {n_bullets}개 내외")
+    n_sent = len(_split_sentences(body))
+    if n_sent:
+        hints.append(f"{n_sent}문장 안팎")
+    return " / ".join(hints)
 
-    return {
-        "type": "generic",
-        "sections": [
-            {"heading": "도입", "slot": "intro", "guidance": "핵심 메시지"},
-            {"heading": "핵심 내용", "slot": "body", "guidance": "논리 전개"},
-            {"heading": "마무리", "slot": "close", "guidance": "요약 + 다음 행동"},
-        ],
-        "style_rules": {"heading_style": "###", "bullet_style": "none", "tone_hint": "match_reference", "signature_patterns": []}
+
+def local_template_extract(text: str) -> Tuple[Dict[str, Any], float]:
+    """
+    레퍼런스 → (템플릿, confidence 0~1). LLM 템플릿과 같은 모양:
+    {"type", "sections": [{"heading","slot","guidance"}], "style_rules": {...}}
+    """
+    t = (text or "").strip()
+    if not t:
+        return {"type": "unknown", "sections": [], "style_rules": {}}, 0.0
+
+    raw_lines = [ln.strip() for ln in t.splitlines()]
+    lines = [ln for ln in raw_lines if ln]
+    # 1) 헤딩 기준으로 블록 나누기
+    blocks: List[Dict[str, Any]] = [{"heading": "", "style": None, "body": []}]
+    for i, ln in enumerate(lines):
+        nxt = lines[i + 1] if i + 1 < len(lines) else ""
+        hd = _line_heading(ln, nxt)
+        if hd:
+            blocks.append({"heading": hd[1], "style": hd[0], "body": []})
+        else:
+            blocks[-1]["body"].append(ln)
+    explicit = [b for b in blocks[1:] if b["style"] != "plain"]
+    if not blocks[0]["body"]:
+        blocks.pop(0)
+    elif len(" ".join(blocks[0]["body"])) < 40 and len(blocks) > 1:
+        blocks[1]["body"] = blocks[0]["body"] + blocks[1]["body"]
+        blocks.pop(0)
+
+    # 헤딩이 없으면 빈 줄 문단(없으면 3문장 묶음)을 블록으로
+    if len(blocks) < 2:
+        paras = [p.strip() for p in re.split(r"\n\s*\n", t) if p.strip()]
+        if len(paras) < 2:
+            sents = _split_sentences(re.sub(r"\s+", " ", t))
+            paras = [" ".join(sents[k:k + 3]) for k in range(0, len(sents), 3)]
+        blocks = [{"heading": "", "style": None, "body": [p]} for p in paras]
+
+    headings = [b["heading"] for b in blocks if b["heading"]]
+    tpe, type_conf = _classify_type(t, headings)
+    roles = TEMPLATE_ROLE_MODEL[tpe]
+
+    # 2) 블록 역할 분류 → 같은 역할이 이어지는 헤딩 없는 블록은 합침
+    sections: List[Dict[str, Any]] = []
+    cue_hits = 0
+    n = len(blocks)
+    for k, b in enumerate(blocks):
+        body = "\n".join(b["body"])
+        slot, cue = _classify_role(body, b["heading"], k / max(1, n - 1), roles)
+        cue_hits += cue > 0
+        if not b["heading"] and sections and sections[-1]["slot"] == slot and not sections[-1]["_explicit"]:
+            sections[-1]["_body"] += "\n" + body
+            continue
+        sections.append({
+            "heading": b["heading"] or roles[slot][0],
+            "slot": slot,
+            "_body": body,
+            "_explicit": bool(b["heading"]),
+        })
+    if len(sections) > LOCAL_TEMPLATE_MAX_SECTIONS:
+        keep = sections[:LOCAL_TEMPLATE_MAX_SECTIONS - 1]
+        rest = sections[LOCAL_TEMPLATE_MAX_SECTIONS - 1:]
+        keep.append(dict(rest[0], _body="\n".join(x["_body"] for x in rest)))
+        sections = keep
+
+    # 너무 짧아 구조가 안 보이면 유형 기본 골격
+    if len(sections) < 2 and len(t) < 300:
+        slots = _DEFAULT_SKELETON_SLOTS[tpe]
+        sections = [{"heading": roles[sl][0], "slot": sl, "_body": "", "_explicit": False} for sl in slots]
+
+    seen: Dict[str, int] = {}
+    out_sections = []
+    for sec in sections:
+        slot = sec["slot"]
+        seen[slot] = seen.get(slot, 0) + 1
+        if seen[slot] > 1:
+            slot = f"{slot}_{seen[slot]}"
+        out_sections.append({
+            "heading": sec["heading"],
+            "slot": slot,
+            "guidance": _section_guidance(roles[sec["slot"]][1], sec["_body"]) if sec["_body"] else roles[sec["slot"]][1],
+        })
+
+    template = {
+        "type": tpe,
+        "sections": out_sections,
+        "style_rules": _style_from_text(blocks, lines, t, tpe),
     }
+    structure = 1.0 if len(explicit) >= 2 else (0.7 if len(headings) >= 2 else (0.45 if n >= 3 else 0.15))
+    role_conf = cue_hits / max(1, n)
+    confidence = round(0.5 * structure + 0.3 * role_conf + 0.2 * type_conf, 3)
+    return template, confidence
+
+
+def simple_structure_guess(text: str) -> Dict[str, Any]:
+    """LLM 없이 쓰는 템플릿 (local_template_extract의 템플릿만)."""
+    return local_template_extract(text)[0]
 
 
-def build_template_prompt(reference_text: str) -> Tuple[str, str]:
+def build_template_prompt(
+    reference_text: str, model: str = "gpt-4o-mini", budget_tokens: Optional[int] = None
+) -> Tuple[str, str]:
+    """budget_tokens: 워커 스레드에서 부를 때는 메인 스레드에서 잡아둔 예산을 넘김 (session_state 없음)."""
+    budget = budget_tokens if budget_tokens is not None else ref_token_budget("template")
+    ref, _ = fit_reference((reference_text or "").strip(), budget, model)
     system = (
         "너는 글 구조 분석가다. 입력된 레퍼런스 텍스트의 구조를 템플릿(JSON)으로 추출하라. "
         "헤딩/문단 역할/불릿 패턴/문장 리듬/톤 규칙을 간결하게 정의한다. "
@@ -752,7 +2529,7 @@ def build_template_prompt(reference_text: str) -> Tuple[str, str]:
     )
     user = f"""
 [레퍼런스 텍스트]
-{(reference_text or '')[:8000]}
+{ref}
 
 [출력 JSON 스키마]
 {{
@@ -776,24 +2553,175 @@ def build_template_prompt(reference_text: str) -> Tuple[str, str]:
     return system, user
 
 
-def extract_template(api_key: str, model: str, reference_text: str) -> Dict[str, Any]:
-    ref = (reference_text or "").strip()
-    if not ref:
-        return {"type": "unknown", "sections": [], "style_rules": {}}
+# ------------------------------------------------------------
+# 템플릿 저장소
+# - 같은 레퍼런스(공백 정규화 후 동일)는 모델별로 한 번만 LLM 분석
+# - 자소서/논문/라이브러리/A·B 어디서든 같은 저장소를 조회
+# - 라이브러리에 저장할 때 아직 분석 전이면 백그라운드로 미리 분석
+# ------------------------------------------------------------
+TEMPLATE_PRECOMPUTE_WORKERS = 2
 
-    if not api_key.strip():
-        return simple_structure_guess(ref)
 
+def template_ref_hash(reference_text: str) -> str:
+    norm = " ".join((reference_text or "").split())
+    return hashlib.sha256(norm.encode("utf-8")).hexdigest()
+
+
+def template_store_get(reference_text: str, model: Optional[str] = None) -> Dict[str, Any]:
+    """model이 없으면 아무 모델이든 가장 최근 것."""
+    h = template_ref_hash(reference_text)
+    with db_conn() as conn:
+        if model:
+            row = conn.execute("SELECT model, template FROM template_store WHERE ref_hash = ? AND model = ?", (h, model)).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT model, template FROM template_store WHERE ref_hash = ? ORDER BY last_used DESC LIMIT 1", (h,)
+            ).fetchone()
+        if row is None:
+            return {}
+        conn.execute("UPDATE template_store SET last_used = ? WHERE ref_hash = ? AND model = ?", (time.time(), h, row["model"]))
+    return json.loads(row["template"])
+
+
+def template_store_put(reference_text: str, model: str, template: Dict[str, Any]):
+    now = time.time()
+    with db_conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO template_store (ref_hash, model, template, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (template_ref_hash(reference_text), model, json.dumps(template, ensure_ascii=False), now, now),
+        )
+
+
+def template_store_invalidate(reference_text: Optional[str] = None, model: Optional[str] = None) -> int:
+    """레퍼런스(와 모델) 단위로 삭제. 둘 다 없으면 전체 삭제."""
+    with db_conn() as conn:
+        if reference_text is None:
+            cur = conn.execute("DELETE FROM template_store")
+        elif model:
+            cur = conn.execute("DELETE FROM template_store WHERE ref_hash = ? AND model = ?", (template_ref_hash(reference_text), model))
+        else:
+            cur = conn.execute("DELETE FROM template_store WHERE ref_hash = ?", (template_ref_hash(reference_text),))
+    return cur.rowcount
+
+
+def template_store_count() -> int:
+    with db_conn() as conn:
+        return conn.execute("SELECT COUNT(*) FROM template_store").fetchone()[0]
+
+
+def _extract_template_llm(
+    api_key: str, model: str, ref: str, use_cache: bool, budget_tokens: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    LLM 템플릿 추출(성공 시 저장소에 기록). 워커 스레드에서는 budget_tokens를 넘겨야
+    포그라운드와 같은 프롬프트(= 같은 캐시 키)가 된다.
+    """
     try:
-        system, user = build_template_prompt(ref)
-        raw = call_openai(api_key, model, system, user, temperature=0.2)
+        system, user = build_template_prompt(ref, model, budget_tokens)
+        raw = call_openai(api_key, model, system, user, temperature=0.2, use_cache=use_cache)
         tpl = safe_json(raw)
         if isinstance(tpl, dict) and tpl.get("sections"):
+            template_store_put(ref, model, tpl)
             return tpl
     except Exception:
         pass
+    return {}
+
+
+def extract_template(api_key: str, model: str, reference_text: str, refresh: bool = False) -> Dict[str, Any]:
+    """
+    저장소 → (자동/로컬 모드) 로컬 추출 → LLM 분석 후 저장. refresh=True면 저장본과 자동 모드의 로컬 결과를 건너뛰고 LLM으로 다시 분석.
+    """
+    ref = (reference_text or "").strip()
+    if not ref:
+        return {"type": "unknown", "sections": [], "style_rules": {}}
+
+    with span("template.extract", model=model) as sp:
+        if not refresh:
+            stored = template_store_get(ref, model)
+            if stored:
+                sp["source"] = "store"
+                return stored
+
+        # refresh(다시 분석)는 LLM으로 — 자동 모드의 로컬 지름길은 건너뜀 (로컬 전용/키 없음은 그대로 로컬)
+        mode = st.session_state.get("template_extractor", "auto")
+        if mode == "local" or not api_key.strip() or (mode == "auto" and not refresh):
+            local_tpl, conf = local_template_extract(ref)
+            sp["confidence"] = conf
+            if mode == "local" or not api_key.strip() or conf >= LOCAL_TEMPLATE_MIN_CONFIDENCE:
+                sp["source"] = "local"
+                return local_tpl
+
+        use_cache = st.session_state.get("use_llm_cache", True) and not refresh
+        tpl = _extract_template_llm(api_key, model, ref, use_cache)
+        sp["source"] = "llm" if tpl else "heuristic"
+        return tpl or simple_structure_guess(ref)
+
+
+def template_for_reference(reference_text: str, model: Optional[str] = None) -> Dict[str, Any]:
+    """LLM 호출 없이 쓸 템플릿: 저장소(해당 모델 → 아무 모델) → 휴리스틱."""
+    ref = (reference_text or "").strip()
+    if not ref:
+        return simple_structure_guess(ref)
+    return (model and template_store_get(ref, model)) or template_store_get(ref) or simple_structure_guess(ref)
+
 
-    return simple_structure_guess(ref)
+@st.cache_resource(show_spinner=False)
+def _template_jobs() -> Dict[str, Any]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    return {
+        "executor": ThreadPoolExecutor(max_workers=TEMPLATE_PRECOMPUTE_WORKERS, thread_name_prefix="tpl"),
+        "lock": threading.Lock(),
+        "pending": set(),
+    }
+
+
+def _precompute_library_template(
+    api_key: str, model: str, item_id: int, ref: str, saved_template_json: str, use_cache: bool, budget_tokens: int
+):
+    jobs = _template_jobs()
+    try:
+        tpl = _extract_template_llm(api_key, model, ref, use_cache, budget_tokens)
+        if tpl:
+            # 저장 당시의 (휴리스틱) 템플릿이 그대로일 때만 교체
+            with db_conn() as conn:
+                cur = conn.execute(
+                    "UPDATE library_templates SET template = ? WHERE item_id = ? AND template = ?",
+                    (json.dumps(tpl, ensure_ascii=False), item_id, saved_template_json),
+                )
+                row = conn.execute("SELECT major FROM library_items WHERE id = ?", (item_id,)).fetchone()
+                if cur.rowcount and row:
+                    sim_index_item(conn, item_id, row["major"], ref, tpl)
+            if cur.rowcount and row:
+                template_matrix_invalidate(row["major"])
+    finally:
+        with jobs["lock"]:
+            jobs["pending"].discard(item_id)
+
+
+def schedule_template_precompute(api_key: str, model: str, item_id: int, ref_text: str, saved_template_json: str):
+    """저장소에 아직 없는 레퍼런스면 백그라운드에서 LLM 템플릿을 미리 뽑아둔다."""
+    ref = (ref_text or "").strip()
+    if not (api_key.strip() and ref) or template_store_get(ref):
+        return
+    mode = st.session_state.get("template_extractor", "auto")
+    if mode == "local" or (mode == "auto" and local_template_extract(ref)[1] >= LOCAL_TEMPLATE_MIN_CONFIDENCE):
+        return
+    jobs = _template_jobs()
+    with jobs["lock"]:
+        if item_id in jobs["pending"]:
+            return
+        jobs["pending"].add(item_id)
+    use_cache = bool(st.session_state.get("use_llm_cache", True))
+    budget = ref_token_budget("template")  # 워커에는 session_state가 없으므로 여기서 잡아 넘김
+    jobs["executor"].submit(_precompute_library_template, api_key, model, item_id, ref, saved_template_json, use_cache, budget)
+
+
+def template_precompute_pending() -> int:
+    jobs = _template_jobs()
+    with jobs["lock"]:
+        return len(jobs["pending"])
 
 
 def build_prompt_template_fill(p: Dict[str, Any], template: Dict[str, Any]) -> Tuple[str, str]:
@@ -842,53 +2770,1425 @@ def build_prompt_template_fill(p: Dict[str, Any], template: Dict[str, Any]) -> T
 - signature_patterns가 있으면 리듬만 반영(과하게 복붙 금지)
 - 원문에 없는 수치/기간/주소/가격/링크를 지어내지 마라
 
-[출력 JSON]
-{{
- "rewritten_text": "",
- "change_points": [],
- "highlight_reasons": [],
- "detected_original_traits": [],
- "suggested_repurposes": []
-}}
-"""
-    return system, user
+[출력 JSON]
+{{
+ "rewritten_text": "",
+ "change_points": [],
+ "highlight_reasons": [],
+ "detected_original_traits": [],
+ "suggested_repurposes": []
+}}
+"""
+    return system, user
+
+
+# ------------------------------------------------------------
+# Near-duplicate detection (MinHash + LSH)
+# - 공백 정규화한 본문의 글자 5-gram 집합 → MinHash 서명(64개)
+# - 서명을 16밴드×4행으로 나눠 밴드 해시 버킷에 등록 → 같은 버킷에 걸린 후보만 서명으로 Jaccard 추정
+# - 정확히 같은 본문은 text_hash로 바로 잡힘(저장도 한 벌만)
+# ------------------------------------------------------------
+MINHASH_PERM = 64
+LSH_BANDS = 16  # 행 4개씩: Jaccard ~0.5부터 후보로 걸림
+LIBRARY_DUP_JACCARD = 0.7
+MINHASH_SHINGLE = 5
+MINHASH_MAX_CHARS = 60_000
+_MINHASH_PRIME = (1 << 61) - 1
+
+
+@functools.lru_cache(maxsize=1)
+def _minhash_params():
+    import numpy as np
+
+    rng = np.random.default_rng(20240501)  # 고정 seed: 서명이 DB에 저장되므로 바뀌면 안 됨
+    a = rng.integers(1, 1 << 32, size=MINHASH_PERM, dtype=np.uint64)
+    b = rng.integers(0, 1 << 32, size=MINHASH_PERM, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signature(text: str) -> bytes:
+    """MINHASH_PERM개 uint32 서명(bytes). 빈 본문은 b\"\"."""
+    import numpy as np
+
+    norm = " ".join((text or "").lower().split())[:MINHASH_MAX_CHARS]
+    if not norm:
+        return b""
+    codes = np.frombuffer(norm.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    k = min(MINHASH_SHINGLE, len(codes))
+    # 글자 k-gram 다항 해시(2^64 모듈러, 프로세스와 무관하게 안정적)
+    h = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    for i in range(k):
+        h = h * np.uint64(1_000_003) + codes[i:len(codes) - k + 1 + i]
+    x = np.unique((h ^ (h >> np.uint64(32))) & np.uint64(0xFFFFFFFF))
+    a, b = _minhash_params()
+    sig = np.full(MINHASH_PERM, 0xFFFFFFFF, dtype=np.uint64)
+    for start in range(0, len(x), 8192):
+        part = x[start:start + 8192]
+        hv = ((a[:, None] * part[None, :] + b[:, None]) % np.uint64(_MINHASH_PRIME)) & np.uint64(0xFFFFFFFF)
+        sig = np.minimum(sig, hv.min(axis=1))
+    return sig.astype(np.uint32).tobytes()
+
+
+def _lsh_buckets(sig: bytes) -> List[Tuple[int, int]]:
+    rows = len(sig) // LSH_BANDS
+    return [
+        (band, int.from_bytes(hashlib.blake2b(sig[band * rows:(band + 1) * rows], digest_size=8).digest(), "little", signed=True))
+        for band in range(LSH_BANDS)
+    ]
+
+
+def minhash_similarity(sig_a: bytes, sig_b: bytes) -> float:
+    import numpy as np
+
+    if not sig_a or len(sig_a) != len(sig_b):
+        return 0.0
+    return float(np.mean(np.frombuffer(sig_a, dtype=np.uint32) == np.frombuffer(sig_b, dtype=np.uint32)))
+
+
+def _minhash_index_item(conn, item_id: int, sig: bytes):
+    conn.execute("INSERT OR REPLACE INTO library_minhash (item_id, sig) VALUES (?, ?)", (item_id, sig))
+    if sig:
+        conn.executemany(
+            "INSERT OR IGNORE INTO library_lsh (band, bucket, item_id) VALUES (?, ?, ?)",
+            [(band, bucket, item_id) for band, bucket in _lsh_buckets(sig)],
+        )
+
+
+def _minhash_remove(conn, item_id: int):
+    conn.execute("DELETE FROM library_lsh WHERE item_id = ?", (item_id,))
+    conn.execute("DELETE FROM library_minhash WHERE item_id = ?", (item_id,))
+
+
+def library_minhash_sync() -> int:
+    """서명이 없는 항목(기능 추가 전 저장분)을 색인. 처리 수 반환."""
+    with db_conn() as conn:
+        missing = [r[0] for r in conn.execute(
+            "SELECT id FROM library_items WHERE id NOT IN (SELECT item_id FROM library_minhash)"
+        )]
+    for item_id in missing:
+        try:
+            sig = minhash_signature(library_get(item_id).get("text", ""))
+        except LookupError:
+            continue  # 본문이 사라진 항목은 색인하지 않음
+        with db_conn() as conn:
+            _minhash_index_item(conn, item_id, sig)
+    return len(missing)
+
+
+def library_near_duplicates(item_id: int, threshold: float = LIBRARY_DUP_JACCARD) -> List[Dict[str, Any]]:
+    """
+    item_id와 본문이 같거나 거의 같은 다른 항목(대목적 무관), 비슷한 순.
+    [{"id","name","major","minor","similarity","same_text"}]
+    """
+    with db_conn() as conn:
+        me = conn.execute(
+            "SELECT i.text_hash, m.sig FROM library_items i LEFT JOIN library_minhash m ON m.item_id = i.id WHERE i.id = ?",
+            (item_id,),
+        ).fetchone()
+        if me is None:
+            return []
+        sig = me["sig"] or b""
+        found: Dict[int, float] = {}
+        if me["text_hash"]:
+            for r in conn.execute(
+                "SELECT id FROM library_items WHERE text_hash = ? AND id != ?", (me["text_hash"], item_id)
+            ):
+                found[r["id"]] = 1.0
+        if sig:
+            buckets = _lsh_buckets(sig)
+            cand = {
+                r[0] for r in conn.execute(
+                    "SELECT DISTINCT item_id FROM library_lsh WHERE "
+                    + " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)),
+                    [v for bb in buckets for v in bb],
+                )
+            } - {item_id} - set(found)
+            if cand:
+                marks = ",".join("?" * len(cand))
+                for r in conn.execute(f"SELECT item_id, sig FROM library_minhash WHERE item_id IN ({marks})", list(cand)):
+                    sim = minhash_similarity(sig, r["sig"])
+                    if sim >= threshold:
+                        found[r["item_id"]] = sim
+        if not found:
+            return []
+        marks = ",".join("?" * len(found))
+        rows = conn.execute(
+            f"SELECT id, name, major, minor, text_hash FROM library_items WHERE id IN ({marks})", list(found)
+        ).fetchall()
+    out = [
+        {
+            "id": r["id"], "name": r["name"], "major": r["major"], "minor": r["minor"],
+            "similarity": round(found[r["id"]], 3), "same_text": bool(me["text_hash"]) and r["text_hash"] == me["text_hash"],
+        }
+        for r in rows
+    ]
+    return sorted(out, key=lambda d: -d["similarity"])
+
+
+def render_library_duplicates_notice(item_id: int):
+    """저장 직후: 같은/비슷한 레퍼런스가 이미 있으면 알려줌."""
+    dups = library_near_duplicates(item_id)
+    if not dups:
+        return
+    same = [d for d in dups if d["same_text"]]
+    near = [d for d in dups if not d["same_text"]]
+    if same:
+        st.info(
+            "같은 본문이 이미 저장돼 있어 본문은 공유 저장했습니다: "
+            + ", ".join(f"{d['name']} ({d['major']})" for d in same[:5])
+        )
+    if near:
+        st.warning(
+            "거의 같은 레퍼런스가 있습니다: "
+            + ", ".join(f"{d['name']} ({d['major']}, {d['similarity']:.0%})" for d in near[:5])
+        )
+
+
+def library_add(
+    name: str,
+    major: str,
+    minor: str,
+    ref_text: str,
+    ref_meta: Dict[str, Any],
+    template: Dict[str, Any],
+    api_key: str = "",
+    model: str = "",
+) -> int:
+    """
+    api_key/model을 주면, 저장소에 LLM 템플릿이 없는 레퍼런스는 백그라운드로 미리 분석해
+    라이브러리 템플릿을 교체한다. 같은 본문은 text_blobs 한 벌을 공유하고,
+    비슷한 기존 항목은 library_near_duplicates(item_id)로 확인한다.
+    """
+    text = ref_text or ""
+    template_json = json.dumps(template or {}, ensure_ascii=False)
+    library_minhash_sync()
+    sig = minhash_signature(text)
+    with db_conn() as conn:
+        text_hash = _text_blob_put(conn, text)
+        cur = conn.execute(
+            "INSERT INTO library_items (name, major, minor, meta, text_z, text_len, created, text_hash) "
+            "VALUES (?, ?, ?, ?, x'', ?, ?, ?)",
+            (
+                name,
+                major,
+                minor,
+                json.dumps(ref_meta or {}, ensure_ascii=False),
+                len(text),
+                time.time(),
+                text_hash,
+            ),
+        )
+        item_id = cur.lastrowid
+        conn.execute(
+            "INSERT INTO library_templates (item_id, template) VALUES (?, ?)",
+            (item_id, template_json),
+        )
+        _minhash_index_item(conn, item_id, sig)
+        sim_index_item(conn, item_id, major, text, template or {})
+    if api_key and model:
+        schedule_template_precompute(api_key, model, item_id, text, template_json)
+    template_matrix_invalidate(major)
+    return item_id
+
+
+def library_items_for_major(major: str) -> List[Dict[str, Any]]:
+    """
+    목록용 가벼운 항목만(본문/템플릿 제외). 본문은 library_get으로 필요할 때 읽는다.
+    """
+    with db_conn() as conn:
+        rows = conn.execute(
+            "SELECT id, name, major, minor, text_len, created FROM library_items WHERE major = ? ORDER BY created DESC, id DESC",
+            (major,),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def library_count(major: Optional[str] = None) -> int:
+    with db_conn() as conn:
+        if major is None:
+            return conn.execute("SELECT COUNT(*) FROM library_items").fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM library_items WHERE major = ?", (major,)).fetchone()[0]
+
+
+def library_get(item_id: int) -> Dict[str, Any]:
+    """항목 전체. 없으면 {}, 본문(text_blobs)이 사라졌으면 LookupError (빈 본문으로 조용히 넘기지 않음)."""
+    import zlib
+
+    with db_conn() as conn:
+        row = conn.execute(
+            "SELECT i.id, i.name, i.major, i.minor, i.meta, i.text_hash, b.hash AS blob_hash, "
+            "COALESCE(b.text_z, i.text_z) AS text_z, t.template "
+            "FROM library_items i LEFT JOIN library_templates t ON t.item_id = i.id "
+            "LEFT JOIN text_blobs b ON b.hash = i.text_hash WHERE i.id = ?",
+            (item_id,),
+        ).fetchone()
+    if row is None:
+        return {}
+    if row["text_hash"] and row["blob_hash"] is None:
+        raise LookupError(f"레퍼런스 본문이 없습니다 (id={item_id}, hash={row['text_hash'][:12]})")
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "major": row["major"],
+        "minor": row["minor"],
+        "text": zlib.decompress(row["text_z"]).decode("utf-8") if row["text_z"] else "",
+        "meta": json.loads(row["meta"] or "{}"),
+        "template": json.loads(row["template"] or "{}"),
+    }
+
+
+def library_get_template(item_id: int) -> Dict[str, Any]:
+    with db_conn() as conn:
+        row = conn.execute("SELECT template FROM library_templates WHERE item_id = ?", (item_id,)).fetchone()
+    return json.loads(row["template"]) if row else {}
+
+
+def library_delete(item_id: int):
+    with db_conn() as conn:
+        _sim_remove(conn, item_id)
+        _minhash_remove(conn, item_id)
+        row = conn.execute("SELECT text_hash, major FROM library_items WHERE id = ?", (item_id,)).fetchone()
+        conn.execute("DELETE FROM library_templates WHERE item_id = ?", (item_id,))
+        conn.execute("DELETE FROM library_items WHERE id = ?", (item_id,))
+        _text_blob_release(conn, row["text_hash"] if row else None)
+    template_matrix_invalidate(row["major"] if row else None)
+
+
+def render_library_label(it: Dict[str, Any]) -> str:
+    nm = it.get("name", "Untitled")
+    mn = it.get("minor", "")
+    return f"{nm}  ·  {mn}"
+
+# ------------------------------------------------------------
+# Library similarity index
+# - 본문 + 템플릿 헤딩/슬롯을 term으로 쪼개 SQLite 역색인(sim_postings)에 저장, BM25로 점수
+# - term: 한글은 글자 bigram(조사/어미가 붙어도 겹치게), 영문/숫자는 단어
+# - library_add/삭제/템플릿 교체 때 해당 항목만 갱신 → 조회는 질의 term의 posting만 읽음
+# - 질의는 idf 높은 term부터 SIM_QUERY_TERMS개, posting 합 SIM_MAX_POSTINGS까지만
+#   → 항목 수가 수만 개여도 흔한 term의 긴 posting을 읽지 않음
+# ------------------------------------------------------------
+SIM_QUERY_TERMS = 64
+SIM_MAX_POSTINGS = 60_000  # 질의 한 번에 읽는 posting 행 상한(df 합)
+SIM_TEMPLATE_WEIGHT = 2  # 템플릿 구조(헤딩/슬롯) term 가중치
+SIM_MAX_CHARS = 50_000
+SIM_TOP_K = 10
+SIM_BM25_K1 = 1.2
+SIM_BM25_B = 0.75
+_SIM_TOKEN_RE = re.compile(r"[a-z0-9]+|[가-힣]+")
+
+
+def sim_terms(text: str) -> Dict[str, int]:
+    counts: Dict[str, int] = collections.Counter()
+    for tok in _SIM_TOKEN_RE.findall((text or "")[:SIM_MAX_CHARS].lower()):
+        if "가" <= tok[0] <= "힣":
+            if len(tok) == 1:
+                continue
+            counts.update(tok[i:i + 2] for i in range(len(tok) - 1))
+        elif len(tok) >= 2:
+            counts[tok] += 1
+    return counts
+
+
+def _template_sim_text(template: Dict[str, Any]) -> str:
+    parts = []
+    for sec in (template or {}).get("sections") or []:
+        if isinstance(sec, dict):
+            parts += [str(sec.get("heading") or ""), str(sec.get("slot") or "")]
+    return "\n".join(parts)
+
+
+def sim_doc_terms(text: str, template: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    counts = sim_terms(text)
+    for term, n in sim_terms(_template_sim_text(template or {})).items():
+        counts[term] += n * SIM_TEMPLATE_WEIGHT
+    return counts
+
+
+def _sim_remove(conn, item_id: int):
+    terms = [r[0] for r in conn.execute("SELECT term FROM sim_postings WHERE item_id = ?", (item_id,))]
+    if terms:
+        conn.executemany("UPDATE sim_terms SET df = df - 1 WHERE term = ?", [(t,) for t in terms])
+        conn.execute("DELETE FROM sim_postings WHERE item_id = ?", (item_id,))
+    conn.execute("DELETE FROM sim_docs WHERE item_id = ?", (item_id,))
+
+
+def sim_index_item(conn, item_id: int, major: str, text: str, template: Dict[str, Any]):
+    """한 항목을 (재)색인. 호출하는 쪽의 트랜잭션 안에서 실행된다."""
+    _sim_remove(conn, item_id)
+    counts = sim_doc_terms(text, template)
+    if not counts:
+        return
+    conn.executemany(
+        "INSERT INTO sim_postings (term, item_id, tf) VALUES (?, ?, ?)",
+        [(t, item_id, n) for t, n in counts.items()],
+    )
+    conn.executemany(
+        "INSERT INTO sim_terms (term, df) VALUES (?, 1) ON CONFLICT(term) DO UPDATE SET df = df + 1",
+        [(t,) for t in counts],
+    )
+    conn.execute(
+        "INSERT INTO sim_docs (item_id, major, length) VALUES (?, ?, ?)",
+        (item_id, major, sum(counts.values())),
+    )
+
+
+def sim_index_sync() -> int:
+    """색인에 없는 라이브러리 항목(기능 추가 전 저장분)을 색인하고, 사라진 항목은 정리. 처리 수 반환."""
+    with db_conn() as conn:
+        missing = [r[0] for r in conn.execute(
+            "SELECT id FROM library_items WHERE id NOT IN (SELECT item_id FROM sim_docs)"
+        )]
+        stale = [r[0] for r in conn.execute(
+            "SELECT item_id FROM sim_docs WHERE item_id NOT IN (SELECT id FROM library_items)"
+        )]
+        for item_id in stale:
+            _sim_remove(conn, item_id)
+    for item_id in missing:
+        try:
+            it = library_get(item_id)
+        except LookupError:
+            continue
+        if it:
+            with db_conn() as conn:
+                sim_index_item(conn, item_id, it["major"], it["text"], it["template"])
+    return len(missing) + len(stale)
+
+
+@st.cache_resource(show_spinner=False)
+def sim_index_ready() -> int:
+    """프로세스당 한 번만 sim_index_sync (이후 추가/삭제는 library_add/delete가 색인을 직접 갱신)."""
+    return sim_index_sync()
+
+
+def sim_search(query_text: str, major: Optional[str] = None, k: int = SIM_TOP_K) -> List[Dict[str, Any]]:
+    """
+    query_text와 비슷한 라이브러리 항목 top-k. 질의에도 휴리스틱 구조를 붙여 템플릿 구조 유사도를 반영.
+    반환: [{"id", "name", "minor", "score"(0~1, 질의 자체 점수 대비)}]
+    """
+    import math
+
+    q = sim_doc_terms(query_text, simple_structure_guess(query_text))
+    if not q:
+        return []
+    with span("similarity.search", major=major) as sp, db_conn() as conn:
+        if major is None:
+            n_docs, avg_len = conn.execute("SELECT COUNT(*), AVG(length) FROM sim_docs").fetchone()
+        else:
+            n_docs, avg_len = conn.execute(
+                "SELECT COUNT(*), AVG(length) FROM sim_docs WHERE major = ?", (major,)
+            ).fetchone()
+        if not n_docs:
+            return []
+        # 질의 term의 df (SQLite 변수 개수 상한을 넘지 않게 나눠서)
+        terms = list(q)
+        df: Dict[str, int] = {}
+        for i in range(0, len(terms), 900):
+            chunk = terms[i:i + 900]
+            df.update(conn.execute(
+                f"SELECT term, df FROM sim_terms WHERE df > 0 AND term IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        total_docs = conn.execute("SELECT COUNT(*) FROM sim_docs").fetchone()[0]
+        idf = {t: math.log(1 + (total_docs - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+        weights = {t: idf[t] * (1 + math.log(q[t])) for t in idf}
+        picked, budget = [], SIM_MAX_POSTINGS
+        for t in sorted(weights, key=weights.get, reverse=True)[:SIM_QUERY_TERMS]:
+            if picked and df[t] > budget:
+                break
+            picked.append(t)
+            budget -= df[t]
+        if not picked:
+            return []
+
+        sql = (
+            # CROSS JOIN: posting(term 범위 검색)을 먼저 읽도록 조인 순서 고정 (major 인덱스로 전체 문서를 훑지 않게)
+            "SELECT p.item_id, p.term, p.tf, d.length FROM sim_postings p CROSS JOIN sim_docs d ON d.item_id = p.item_id "
+            f"WHERE p.term IN ({','.join('?' * len(picked))})"
+        )
+        params: List[Any] = list(picked)
+        if major is not None:
+            sql += " AND d.major = ?"
+            params.append(major)
+        scores: Dict[int, float] = collections.defaultdict(float)
+        k1, b = SIM_BM25_K1, SIM_BM25_B
+        for item_id, term, tf, length in conn.execute(sql, params):
+            norm = k1 * (1 - b + b * length / max(1.0, avg_len))
+            scores[item_id] += weights[term] * tf * (k1 + 1) / (tf + norm)
+        sp["candidates"] = len(scores)
+
+        top = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+        if not top:
+            return []
+        ceiling = sum(weights[t] * (k1 + 1) for t in picked)
+        rows = {
+            r["id"]: r for r in conn.execute(
+                f"SELECT id, name, minor FROM library_items WHERE id IN ({','.join('?' * len(top))})",
+                [i for i, _ in top],
+            )
+        }
+    return [
+        {"id": i, "name": rows[i]["name"], "minor": rows[i]["minor"], "score": round(min(1.0, sc / ceiling), 3)}
+        for i, sc in top if i in rows
+    ]
+# ------------------------------------------------------------
+# Template comparison
+# - 구조 거리 = 1 - (섹션 정렬 유사도·스타일 규칙 겹침·type 일치의 가중합), 0(같음) ~ 1(무관)
+# - 섹션 정렬: 갭 비용 0인 가중 LCS(섹션 쌍 유사도 = slot/헤딩 일치면 1, 아니면 헤딩 글자 bigram Jaccard)
+# - 한 템플릿 대 여러 템플릿을 numpy로 한꺼번에 계산 (섹션 bigram 행렬곱 + 쌍 축으로 벡터화한 DP)
+# - 대목적별 거리 행렬은 고유 템플릿(내용 해시) 단위로 캐시: 새 템플릿의 행/열만 계산하고
+#   DATA_DIR/template_matrix_*.npz에 저장 → 재시작 후에도 다시 계산하지 않음
+# - 항목 추가/삭제/템플릿 교체 때 버전만 올리고 백그라운드에서 다시 계산 → 화면은 최신 스냅샷만 읽음
+# - 용도: 거의 같은 템플릿 찾기(중복 정리), 서로 다른 구조의 A/B 조합 고르기 (LLM 호출 없음)
+# - "거의 같음" = 구조 거리 ≤ TEMPLATE_DUP_DIST 이면서 본문도 비슷(MinHash ≥ TEMPLATE_DUP_TEXT_SIM)
+#   (표준 헤딩을 공유하는 자소서 답변끼리는 구조만 같아서 중복이 아님)
+# ------------------------------------------------------------
+TEMPLATE_DIST_WEIGHTS = {"sections": 0.7, "style": 0.2, "type": 0.1}
+TEMPLATE_DUP_DIST = 0.08
+TEMPLATE_DUP_TEXT_SIM = 0.5
+TEMPLATE_DUP_MAX_PAIRS = 20
+TEMPLATE_MATRIX_MAX = 3000  # 대목적별 행렬에 넣는 최근 항목 수 상한
+TEMPLATE_MAX_SECTIONS = 12
+_TPL_HEADING_PREFIX_RE = re.compile(r"^(#{1,6}|\d+[\.\)]|\(\d+\)|[-*•])\s*")
+_TPL_POSITIONAL_SLOT_RE = re.compile(r"^(sec|section|s)_?\d+$")
+
+
+def template_hash(template: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(template or {}, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _template_sections(template: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """[(slot, 정규화 헤딩)]. sec_1 같은 위치형 slot은 의미가 없어 비움."""
+    out = []
+    for sec in ((template or {}).get("sections") or [])[:TEMPLATE_MAX_SECTIONS]:
+        if not isinstance(sec, dict):
+            continue
+        slot = str(sec.get("slot") or "").strip().lower()
+        if _TPL_POSITIONAL_SLOT_RE.match(slot):
+            slot = ""
+        heading = _TPL_HEADING_PREFIX_RE.sub("", str(sec.get("heading") or "").strip()).lower()
+        out.append((slot, re.sub(r"[\W_]+", "", heading)))
+    return out
+
+
+def _style_items(template: Dict[str, Any]) -> set:
+    items = set()
+    for k, v in ((template or {}).get("style_rules") or {}).items():
+        if isinstance(v, list):
+            items.update(f"{k}:{x}" for x in v if isinstance(x, (str, int, float, bool)))
+        elif isinstance(v, (str, int, float, bool)) and v != "":
+            items.add(f"{k}={v}")
+    return items
+
+
+def _template_features(templates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """거리 계산용 배열: 섹션 id(패딩 -1), 섹션별 slot/헤딩 id·bigram 행렬, 스타일 항목 행렬, type id."""
+    import numpy as np
+
+    sec_index: Dict[Tuple[str, str], int] = {}
+    seqs = []
+    for tpl in templates:
+        seqs.append([sec_index.setdefault(sec, len(sec_index)) for sec in _template_sections(tpl)])
+    secs = list(sec_index)
+    L = max([len(q) for q in seqs] + [1])
+    seq_ids = np.full((len(templates), L), -1, dtype=np.int64)
+    for i, q in enumerate(seqs):
+        seq_ids[i, :len(q)] = q
+
+    gram_index: Dict[str, int] = {}
+    rows, cols = [], []
+    for i, (_, heading) in enumerate(secs):
+        grams = {heading[k:k + 2] for k in range(len(heading) - 1)} or ({heading} if heading else set())
+        for g in grams:
+            rows.append(i)
+            cols.append(gram_index.setdefault(g, len(gram_index)))
+    grams_m = np.zeros((len(secs), max(1, len(gram_index))), dtype=np.float32)
+    grams_m[rows, cols] = 1.0
+
+    def _ids(values: List[str]) -> Any:
+        index: Dict[str, int] = {}
+        return np.array([index.setdefault(v, len(index)) if v else -1 for v in values], dtype=np.int64)
+
+    style_index: Dict[str, int] = {}
+    style_sets = [[style_index.setdefault(x, len(style_index)) for x in _style_items(t)] for t in templates]
+    style_m = np.zeros((len(templates), max(1, len(style_index))), dtype=np.float32)
+    for i, xs in enumerate(style_sets):
+        style_m[i, xs] = 1.0
+
+    return {
+        "seq_ids": seq_ids,
+        "seq_len": np.array([len(q) for q in seqs], dtype=np.int64),
+        "slot_ids": _ids([slot for slot, _ in secs]),
+        "heading_ids": _ids([heading for _, heading in secs]),
+        "grams": grams_m,
+        "style": style_m,
+        "type_ids": _ids([str((t or {}).get("type") or "generic") for t in templates]),
+    }
+
+
+def _template_distance_rows(f: Dict[str, Any], rows: List[int]) -> Any:
+    """features f 안에서 rows[r]번 템플릿과 모든 템플릿의 거리 (len(rows) × n)."""
+    import numpy as np
+
+    n = f["seq_ids"].shape[0]
+    out = np.zeros((len(rows), n), dtype=np.float32)
+    g = f["grams"]
+    g_size = g.sum(axis=1)
+    style_size = f["style"].sum(axis=1)
+    others = f["seq_ids"]
+    valid_o = others >= 0
+    safe_o = np.where(valid_o, others, 0)
+    w = TEMPLATE_DIST_WEIGHTS
+    for r, t in enumerate(rows):
+        mine = f["seq_ids"][t][: f["seq_len"][t]]
+        if len(mine):
+            # 내 섹션 × 전체 섹션 유사도 (m × k)
+            inter = g[mine] @ g.T
+            union = g_size[mine][:, None] + g_size[None, :] - inter
+            sim = np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+            for ids in (f["slot_ids"], f["heading_ids"]):
+                same = (ids[mine][:, None] == ids[None, :]) & (ids[mine][:, None] >= 0)
+                sim = np.where(same, 1.0, sim)
+            # 쌍 축(n)으로 벡터화한 가중 LCS: pair[i][:, j] = 내 i번 섹션 vs 각 템플릿 j번 섹션
+            pair = np.where(valid_o[None, :, :], sim[:, safe_o], 0.0)  # m × n × L
+            prev = np.zeros((n, others.shape[1] + 1), dtype=np.float32)
+            for i in range(len(mine)):
+                cur = np.zeros_like(prev)
+                for j in range(1, prev.shape[1]):
+                    cur[:, j] = np.maximum(np.maximum(prev[:, j], cur[:, j - 1]), prev[:, j - 1] + pair[i, :, j - 1])
+                prev = cur
+            denom = np.maximum(len(mine), f["seq_len"])
+            sec_sim = prev[:, -1] / denom
+        else:
+            sec_sim = np.zeros(n, dtype=np.float32)
+        sec_sim = np.where((f["seq_len"] == 0) & (len(mine) == 0), 1.0, sec_sim)
+
+        s_inter = f["style"] @ f["style"][t]
+        s_union = style_size + style_size[t] - s_inter
+        style_sim = np.where(s_union > 0, s_inter / np.maximum(s_union, 1e-9), 1.0)
+        type_sim = (f["type_ids"] == f["type_ids"][t]).astype(np.float32)
+        out[r] = 1.0 - (w["sections"] * sec_sim + w["style"] * style_sim + w["type"] * type_sim)
+    return np.round(np.clip(out, 0.0, 1.0), 4)
+
+
+def template_distance(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    return round(float(_template_distance_rows(_template_features([a, b]), [0])[0, 1]), 4)
+
+
+@st.cache_resource(show_spinner=False)
+def _template_matrix_registry() -> Dict[str, Any]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    return {
+        "lock": threading.Lock(),  # 짧게만 잡음: 버전/캐시 읽기와 결과 게시
+        "compute_lock": threading.Lock(),  # 행렬 계산·저장끼리만 겹치지 않게 (화면 스레드는 안 잡음)
+        "majors": {},  # 대목적 → 고유 템플릿 해시 단위 행렬 (증분 계산용)
+        "snap": {},  # 대목적 → {"version", "items", "D", "dups"} (화면용 최신 결과)
+        "version": {},  # 대목적 → 변경 횟수
+        "pending": set(),
+        "executor": ThreadPoolExecutor(max_workers=1, thread_name_prefix="tplmatrix"),
+    }
+
+
+def _template_matrix_snapshot(major: str) -> Optional[Dict[str, Any]]:
+    """현재 버전과 맞는 스냅샷, 없으면 None."""
+    reg = _template_matrix_registry()
+    with reg["lock"]:
+        snap = reg["snap"].get(major)
+        if snap and snap["version"] == reg["version"].get(major, 0):
+            return snap
+    return None
+
+
+def _template_matrix_job(major: str):
+    reg = _template_matrix_registry()
+    try:
+        for _ in range(3):  # 계산 중에 또 바뀌었으면 다시
+            template_distance_matrix(major)
+            template_near_duplicates(major)  # 화면에서 바로 읽도록 같이 계산해 둠
+            if _template_matrix_snapshot(major):
+                break
+    finally:
+        with reg["lock"]:
+            reg["pending"].discard(major)
+
+
+def schedule_template_matrix(major: str):
+    """대목적의 거리 행렬을 백그라운드에서 (다시) 계산."""
+    reg = _template_matrix_registry()
+    with reg["lock"]:
+        if major in reg["pending"]:
+            return
+        reg["pending"].add(major)
+    reg["executor"].submit(_template_matrix_job, major)
+
+
+def template_matrix_invalidate(major: Optional[str]):
+    """항목/템플릿이 바뀌었을 때: 버전을 올리고 백그라운드 재계산 예약."""
+    if not major:
+        return
+    reg = _template_matrix_registry()
+    with reg["lock"]:
+        reg["version"][major] = reg["version"].get(major, 0) + 1
+    schedule_template_matrix(major)
+
+
+def template_matrix_ready(major: str) -> bool:
+    """화면용: 최신 행렬이 있으면 True, 없으면 백그라운드 계산을 걸고 False (요청 스레드에서 계산하지 않음)."""
+    if _template_matrix_snapshot(major):
+        return True
+    schedule_template_matrix(major)
+    return False
+
+
+def _template_matrix_path(major: str) -> str:
+    return os.path.join(DATA_DIR, f"template_matrix_{hashlib.sha1(major.encode('utf-8')).hexdigest()[:12]}.npz")
+
+
+def _template_matrix_load(major: str) -> Optional[Dict[str, Any]]:
+    import numpy as np
+
+    try:
+        with np.load(_template_matrix_path(major), allow_pickle=False) as z:
+            return {"hashes": [str(h) for h in z["hashes"]], "matrix": z["matrix"]}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _template_matrix_save(major: str, hashes: List[str], matrix: Any):
+    import numpy as np
+
+    path = _template_matrix_path(major)
+    tmp = f"{path}.{threading.get_ident()}.tmp.npz"
+    try:
+        np.savez(tmp, hashes=np.array(hashes, dtype="U40"), matrix=matrix)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def template_distance_matrix(major: str) -> Tuple[List[Dict[str, Any]], Any]:
+    """
+    (items, D). items는 최근 순 [{"id","name","minor"}], D[i][j]는 items[i]/items[j] 템플릿 구조 거리(numpy).
+    같은 템플릿끼리는 거리 0, 캐시에 없는 템플릿의 행/열만 계산한다.
+    최신 스냅샷이 있으면 DB를 다시 읽지 않고 그대로 돌려준다.
+    """
+    import numpy as np
+
+    reg = _template_matrix_registry()
+    with reg["lock"]:
+        version = reg["version"].get(major, 0)
+        snap = reg["snap"].get(major)
+        if snap and snap["version"] == version:
+            return snap["items"], snap["D"]
+
+    with db_conn() as conn:
+        rows = conn.execute(
+            "SELECT i.id, i.name, i.minor, t.template FROM library_items i "
+            "JOIN library_templates t ON t.item_id = i.id WHERE i.major = ? "
+            "ORDER BY i.created DESC, i.id DESC LIMIT ?",
+            (major, TEMPLATE_MATRIX_MAX),
+        ).fetchall()
+    items = [{"id": r["id"], "name": r["name"], "minor": r["minor"]} for r in rows]
+    templates: Dict[str, Dict[str, Any]] = {}
+    item_hashes = []
+    for r in rows:
+        tpl = json.loads(r["template"] or "{}")
+        h = template_hash(tpl)
+        templates.setdefault(h, tpl)
+        item_hashes.append(h)
+    hashes = list(templates)
+    index = {h: i for i, h in enumerate(hashes)}
+
+    with span("template.matrix", major=major, n=len(hashes)) as sp, reg["compute_lock"]:
+        with reg["lock"]:
+            cached = reg["majors"].get(major)
+        cached = cached or _template_matrix_load(major) or {"hashes": [], "matrix": np.zeros((0, 0))}
+        old_index = {h: i for i, h in enumerate(cached["hashes"])}
+        U = np.zeros((len(hashes), len(hashes)), dtype=np.float32)
+        kept = [(i, old_index[h]) for i, h in enumerate(hashes) if h in old_index]
+        if kept:
+            new_pos, old_pos = map(list, zip(*kept))
+            U[np.ix_(new_pos, new_pos)] = cached["matrix"][np.ix_(old_pos, old_pos)]
+        new_rows = [index[h] for h in hashes if h not in old_index]
+        sp["computed"] = len(new_rows)
+        if new_rows:
+            feats = _template_features([templates[h] for h in hashes])
+            D = _template_distance_rows(feats, new_rows)
+            U[new_rows, :] = D
+            U[:, new_rows] = D.T
+            np.fill_diagonal(U, 0.0)
+        with reg["lock"]:
+            reg["majors"][major] = {"hashes": hashes, "matrix": U}
+        if new_rows or len(kept) != len(cached["hashes"]):
+            _template_matrix_save(major, hashes, U)
+
+    pos = [index[h] for h in item_hashes]
+    D_items = U[np.ix_(pos, pos)] if pos else np.zeros((0, 0), dtype=np.float32)
+    with reg["lock"]:
+        cur = reg["snap"].get(major)
+        if cur is None or cur["version"] <= version:
+            reg["snap"][major] = {"version": version, "items": items, "D": D_items, "dups": None}
+    return items, D_items
+
+
+def template_near_duplicates(
+    major: str, threshold: float = TEMPLATE_DUP_DIST, text_sim: float = TEMPLATE_DUP_TEXT_SIM
+) -> List[Dict[str, Any]]:
+    """
+    구조 거리 ≤ threshold이고 본문 MinHash 유사도 ≥ text_sim인 항목 쌍 (본문이 비슷한 순, 최대 TEMPLATE_DUP_MAX_PAIRS).
+    기본 인자 결과는 스냅샷에 같이 저장해 rerun마다 다시 계산하지 않는다.
+    """
+    import numpy as np
+
+    items, D = template_distance_matrix(major)
+    default_args = threshold == TEMPLATE_DUP_DIST and text_sim == TEMPLATE_DUP_TEXT_SIM
+    snap = _template_matrix_snapshot(major)
+    if default_args and snap and snap["items"] is items and snap["dups"] is not None:
+        return snap["dups"]
+    out: List[Dict[str, Any]] = []
+    if len(items) >= 2:
+        ii, jj = np.where(np.triu(D <= threshold, k=1))
+        pos = {it["id"]: k for k, it in enumerate(items)}
+        S = np.zeros((len(items), MINHASH_PERM), dtype=np.uint32)
+        has_sig = np.zeros(len(items), dtype=bool)
+        with db_conn() as conn:
+            for item_id, sig in conn.execute(
+                "SELECT m.item_id, m.sig FROM library_minhash m JOIN library_items i ON i.id = m.item_id WHERE i.major = ?",
+                (major,),
+            ):
+                k = pos.get(item_id)
+                if k is not None and sig and len(sig) == MINHASH_PERM * 4:
+                    S[k] = np.frombuffer(sig, dtype=np.uint32)
+                    has_sig[k] = True
+        keep = has_sig[ii] & has_sig[jj]
+        ii, jj = ii[keep], jj[keep]
+        sims = np.zeros(len(ii), dtype=np.float32)
+        for k in range(0, len(ii), 200_000):  # 후보가 많아도 메모리 일정하게
+            sims[k:k + 200_000] = (S[ii[k:k + 200_000]] == S[jj[k:k + 200_000]]).mean(axis=1)
+        hit = np.nonzero(sims >= text_sim)[0]
+        order = hit[np.lexsort((D[ii[hit], jj[hit]], -sims[hit]))][:TEMPLATE_DUP_MAX_PAIRS]
+        for k in order.tolist():
+            i, j = int(ii[k]), int(jj[k])
+            out.append({"a": items[i], "b": items[j], "dist": round(float(D[i, j]), 4), "text_sim": round(float(sims[k]), 2)})
+    if default_args and snap and snap["items"] is items:
+        with _template_matrix_registry()["lock"]:
+            snap["dups"] = out
+    return out
+
+
+def pick_diverse_templates(major: str, n: int = 2, pool_ids: Optional[List[int]] = None) -> List[int]:
+    """
+    구조가 서로 가장 다른 항목 n개(id). 가장 먼 쌍에서 시작해, 이미 고른 것과의 최소 거리가 큰 순으로 추가.
+    pool_ids가 있으면 그 안에서만 고른다.
+    """
+    import numpy as np
+
+    items, D = template_distance_matrix(major)
+    pool = set(pool_ids) if pool_ids is not None else None
+    idx = [i for i, it in enumerate(items) if pool is None or it["id"] in pool]
+    if len(idx) <= n:
+        return [items[i]["id"] for i in idx]
+    sub = D[np.ix_(idx, idx)]
+    a, b = np.unravel_index(int(np.argmax(sub)), sub.shape)
+    chosen = [int(a), int(b)][:n]
+    while len(chosen) < n:
+        nearest = sub[:, chosen].min(axis=1)
+        nearest[chosen] = -1.0
+        chosen.append(int(np.argmax(nearest)))
+    return [items[idx[c]]["id"] for c in chosen]
+
+
+# ============================================================
+# OpenAI client pool
+# - API Key별로 클라이언트(= keep-alive 커넥션 풀)를 하나만 만들어 재사용
+# - st.cache_resource라서 rerun/세션이 바뀌어도 프로세스 안에서 공유됨
+# - 재시도/백오프는 openai SDK(max_retries, 지수 백오프 + jitter)에 맡김
+# - 오래 안 쓰인 클라이언트는 다음 조회 때 닫고 정리
+# ============================================================
+OPENAI_TIMEOUT_S = float(os.environ.get("REPURPOSE_OPENAI_TIMEOUT", "90"))
+OPENAI_CONNECT_TIMEOUT_S = 10.0
+OPENAI_MAX_RETRIES = int(os.environ.get("REPURPOSE_OPENAI_MAX_RETRIES", "3"))
+OPENAI_POOL_MAX_CONNECTIONS = 16
+OPENAI_POOL_KEEPALIVE = 8
+OPENAI_KEEPALIVE_EXPIRY_S = 120.0
+OPENAI_CLIENT_IDLE_S = 1800.0
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client_registry() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "clients": {}}
+
+
+def _build_openai_client(api_key: str):
+    from openai import OpenAI
+
+    http_client = None
+    try:
+        import httpx
+        from openai import DefaultHttpxClient
+        http_client = DefaultHttpxClient(
+            timeout=httpx.Timeout(OPENAI_TIMEOUT_S, connect=OPENAI_CONNECT_TIMEOUT_S),
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_POOL_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_S,
+            ),
+        )
+    except Exception:
+        # 구버전 SDK 등: SDK 기본 http 클라이언트(자체 커넥션 풀) 사용
+        http_client = None
+
+    return OpenAI(
+        api_key=api_key,
+        timeout=OPENAI_TIMEOUT_S,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=http_client,
+    )
+
+
+def _evict_idle_clients(registry: Dict[str, Any], now: float):
+    clients = registry["clients"]
+    for key in [k for k, e in clients.items() if now - e["last_used"] > OPENAI_CLIENT_IDLE_S]:
+        entry = clients.pop(key)
+        try:
+            entry["client"].close()
+        except Exception:
+            pass
+
+
+def get_openai_client(api_key: str):
+    """
+    API Key별 공유 OpenAI 클라이언트. 키 원문 대신 해시를 레지스트리 키로 쓴다.
+    """
+    registry = _openai_client_registry()
+    key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    now = time.monotonic()
+    with registry["lock"]:
+        _evict_idle_clients(registry, now)
+        entry = registry["clients"].get(key)
+        if entry is None:
+            entry = {"client": _build_openai_client(api_key), "last_used": now}
+            registry["clients"][key] = entry
+        entry["last_used"] = now
+        return entry["client"]
+
+# ============================================================
+# LLM response cache
+# - (model, temperature, system, user)가 같으면 같은 응답으로 간주
+# - 모든 세션이 같은 로컬 DB를 공유, TTL/개수/용량 기준으로 정리
+# - 적중/미스 카운터는 프로세스 단위(사이드바에 표시)
+# ============================================================
+LLM_CACHE_TTL_S = float(os.environ.get("REPURPOSE_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def _llm_cache_counters() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def _llm_cache_count(name: str, n: int = 1):
+    counters = _llm_cache_counters()
+    with counters["lock"]:
+        counters[name] += n
+
+
+def llm_cache_key(model: str, temperature: float, system_prompt: str, user_prompt: str, text_format: Optional[Dict[str, Any]] = None) -> str:
+    parts = [model, round(float(temperature), 4), system_prompt, user_prompt]
+    if text_format:
+        parts.append(text_format)  # 구조화 출력은 다른 응답이므로 키 분리
+    blob = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def llm_cache_get(key: str) -> Optional[str]:
+    now = time.time()
+    with db_conn() as conn:
+        row = conn.execute("SELECT raw, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row["created"] > LLM_CACHE_TTL_S:
+            if row is not None:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            _llm_cache_count("misses")
+            return None
+        conn.execute("UPDATE llm_cache SET last_hit = ? WHERE key = ?", (now, key))
+    _llm_cache_count("hits")
+    return row["raw"]
+
+
+def llm_cache_has(key: str) -> bool:
+    """히트/미스 카운터를 건드리지 않고 유효한 캐시 항목이 있는지만 확인."""
+    with db_conn() as conn:
+        row = conn.execute("SELECT created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    return row is not None and time.time() - row["created"] <= LLM_CACHE_TTL_S
+
+
+def llm_cache_put(key: str, model: str, raw: str):
+    now = time.time()
+    size = len(raw.encode("utf-8"))
+    with db_conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, model, raw, size, created, last_hit) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, raw, size, now, now),
+        )
+        _llm_cache_evict(conn, now)
+    _llm_cache_count("stores")
+
+
+def _llm_cache_evict(conn: sqlite3.Connection, now: float):
+    evicted = conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - LLM_CACHE_TTL_S,)).rowcount
+    count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+    if count > LLM_CACHE_MAX_ENTRIES or total > LLM_CACHE_MAX_BYTES:
+        # 최근에 덜 쓰인 것부터 제거 (LRU)
+        freed_n, freed_b = 0, 0
+        victims = []
+        for row in conn.execute("SELECT key, size FROM llm_cache ORDER BY last_hit ASC"):
+            if count - freed_n <= LLM_CACHE_MAX_ENTRIES and total - freed_b <= LLM_CACHE_MAX_BYTES:
+                break
+            victims.append((row["key"],))
+            freed_n += 1
+            freed_b += row["size"]
+        conn.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+        evicted += len(victims)
+    if evicted:
+        _llm_cache_count("evictions", evicted)
+
+
+def llm_cache_clear():
+    with db_conn() as conn:
+        conn.execute("DELETE FROM llm_cache")
+
+
+def llm_cache_stats() -> Dict[str, Any]:
+    counters = _llm_cache_counters()
+    with counters["lock"]:
+        stats = {k: v for k, v in counters.items() if k != "lock"}
+    with db_conn() as conn:
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+    stats["entries"] = count
+    stats["bytes"] = total
+    return stats
+
+# ============================================================
+# OpenAI call (유지)
+# ============================================================
+def call_openai(
+    api_key,
+    model,
+    system_prompt,
+    user_prompt,
+    temperature,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    text_format: Optional[Dict[str, Any]] = None,
+):
+    """text_format: Responses API의 text 파라미터(예: structured_text_format())."""
+    with span("llm.call", model=model) as sp:
+        cache_key = llm_cache_key(model, temperature, system_prompt, user_prompt, text_format)
+        if use_cache:
+            cached = llm_cache_get(cache_key)
+            if cached is not None:
+                sp["cache"] = "hit"
+                record_llm_call(model, cached=True)
+                return cached
+
+        client = get_openai_client(api_key)
+        if timeout is not None:
+            client = client.with_options(timeout=timeout)
+        extra = {"text": text_format} if text_format else {}
+        t0 = time.perf_counter()
+        try:
+            resp = client.responses.create(
+                model=model,
+                temperature=temperature,
+                input=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                **extra,
+            )
+        except Exception:
+            record_llm_call(model, time.perf_counter() - t0, error=True)
+            raise
+        in_tok, out_tok = _usage_tokens(resp)
+        record_llm_call(model, time.perf_counter() - t0, in_tok, out_tok)
+        sp.update(cache="miss", input_tokens=in_tok, output_tokens=out_tok)
+        raw = resp.output_text
+        # 끝까지 받은 + 복구 없이 파싱되는 응답만 저장 (잘린 응답이 캐시에 고정되지 않도록)
+        if raw and getattr(resp, "status", "completed") in (None, "completed") and json_is_complete(raw):
+            llm_cache_put(cache_key, model, raw)
+        else:
+            sp["cache_skip"] = getattr(resp, "status", None) or "incomplete_json"
+        return raw
+
+# ============================================================
+# Structured output (JSON 스키마 모드)
+# - 켜면 Responses API text.format=json_schema(strict)로 응답 형태를 API가 보장
+# - 응답은 스키마에서 한 번 만든 검증 함수로 확인
+# - 어긋나면: 목록 필드 누락/문자열 등은 로컬 보정, rewritten_text가 없을 때만
+#   오류 목록을 붙여 최대 STRUCTURED_MAX_RETRIES번 재요청 (캐시 우회)
+# ============================================================
+STRUCTURED_MAX_RETRIES = 1
+REWRITE_LIST_FIELDS = ["change_points", "highlight_reasons", "detected_original_traits", "suggested_repurposes"]
+REPURPOSE_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {"major_purpose": {"type": "string"}, "minor_purpose": {"type": "string"}},
+    "required": ["major_purpose", "minor_purpose"],
+    "additionalProperties": False,
+}
+# API로 보내는 스키마 (strict 모드가 받지 않는 minLength 등은 넣지 않음)
+REWRITE_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rewritten_text": {"type": "string"},
+        **{
+            f: {"type": "array", "items": REPURPOSE_ITEM_SCHEMA if f == "suggested_repurposes" else {"type": "string"}}
+            for f in REWRITE_LIST_FIELDS
+        },
+    },
+    "required": ["rewritten_text"] + REWRITE_LIST_FIELDS,
+    "additionalProperties": False,
+}
+
+_SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+def compile_schema_validator(schema: Dict[str, Any], path: str = "$") -> Callable[[Any], List[str]]:
+    """
+    JSON 스키마(type/properties/required/additionalProperties/items/enum/minLength 부분집합)를
+    검증 함수로 한 번 변환. 반환 함수는 오류 메시지 목록(비어 있으면 통과)을 돌려준다.
+    """
+    checks: List[Callable[[Any], List[str]]] = []
+    typ = schema.get("type")
+    if typ:
+        py = _SCHEMA_TYPES[typ]
+
+        def check_type(v, py=py):
+            if isinstance(v, bool) and typ != "boolean":
+                return [f"{path}: {typ} 필요"]
+            return [] if isinstance(v, py) else [f"{path}: {typ} 필요"]
+
+        checks.append(check_type)
+    if "enum" in schema:
+        allowed = list(schema["enum"])
+        checks.append(lambda v: [] if v in allowed else [f"{path}: {allowed} 중 하나여야 함"])
+    if "minLength" in schema:
+        n = schema["minLength"]
+        checks.append(lambda v: [] if not isinstance(v, str) or len(v.strip()) >= n else [f"{path}: 비어 있음"])
+    if typ == "object":
+        props = {k: compile_schema_validator(sub, f"{path}.{k}") for k, sub in (schema.get("properties") or {}).items()}
+        required = list(schema.get("required") or [])
+        closed = schema.get("additionalProperties") is False
+
+        def check_object(v):
+            if not isinstance(v, dict):
+                return []
+            errs = [f"{path}.{k}: 누락" for k in required if k not in v]
+            for k, val in v.items():
+                if k in props:
+                    errs.extend(props[k](val))
+                elif closed:
+                    errs.append(f"{path}.{k}: 허용되지 않은 키")
+            return errs
+
+        checks.append(check_object)
+    if typ == "array" and "items" in schema:
+        item_check = compile_schema_validator(schema["items"], f"{path}[]")
+        checks.append(lambda v: [e for x in v for e in item_check(x)] if isinstance(v, list) else [])
+
+    def validate(value) -> List[str]:
+        errs: List[str] = []
+        for c in checks:
+            errs.extend(c(value))
+            if errs and c is checks[0] and typ:
+                break  # 타입부터 틀리면 하위 검사는 의미 없음
+        return errs
+
+    return validate
+
+
+# 로컬 검증은 빈 rewritten_text까지 걸러냄
+validate_rewrite_result = compile_schema_validator({
+    **REWRITE_RESULT_SCHEMA,
+    "properties": {**REWRITE_RESULT_SCHEMA["properties"], "rewritten_text": {"type": "string", "minLength": 1}},
+})
+
+
+def structured_text_format(schema: Dict[str, Any] = REWRITE_RESULT_SCHEMA, name: str = "rewrite_result") -> Dict[str, Any]:
+    return {"format": {"type": "json_schema", "name": name, "schema": schema, "strict": True}}
+
+
+@st.cache_resource(show_spinner=False)
+def _structured_counters() -> Dict[str, Any]:
+    return {"lock": threading.Lock(), "valid": 0, "coerced": 0, "retried": 0, "failed": 0}
+
+
+def _structured_count(field: str):
+    c = _structured_counters()
+    with c["lock"]:
+        c[field] += 1
+
+
+def structured_stats() -> Dict[str, int]:
+    c = _structured_counters()
+    with c["lock"]:
+        return {k: c[k] for k in ("valid", "coerced", "retried", "failed")}
+
+
+def coerce_rewrite_result(data: Any) -> Dict[str, Any]:
+    """LLM 재호출 없이 고칠 수 있는 것만 보정 (목록 누락/단일 문자열/여분 키)."""
+    data = data if isinstance(data, dict) else {}
+    out: Dict[str, Any] = {"rewritten_text": data.get("rewritten_text")}
+    if out["rewritten_text"] is not None and not isinstance(out["rewritten_text"], str):
+        out["rewritten_text"] = normalize_rewritten(out["rewritten_text"])
+    for f in REWRITE_LIST_FIELDS:
+        v = data.get(f)
+        if v is None:
+            v = []
+        elif not isinstance(v, list):
+            v = [v]
+        if f == "suggested_repurposes":
+            out[f] = [_coerce_repurpose_item(x) for x in v]
+            out[f] = [x for x in out[f] if x]
+        else:
+            out[f] = [x if isinstance(x, str) else json.dumps(x, ensure_ascii=False) for x in v]
+    return out
+
+
+def _coerce_repurpose_item(x: Any) -> Optional[Dict[str, str]]:
+    """{"major_purpose","minor_purpose"}로 맞춤. "대목적 → 소목적" 문자열도 받아줌, 못 맞추면 None."""
+    if isinstance(x, dict):
+        mj, mn = x.get("major_purpose"), x.get("minor_purpose")
+    elif isinstance(x, str) and re.search(r"→|->|>", x):
+        mj, mn = [t.strip() for t in re.split(r"→|->|>", x, maxsplit=1)]
+    else:
+        return None
+    if not (isinstance(mj, str) and isinstance(mn, str) and mj.strip() and mn.strip()):
+        return None
+    return {"major_purpose": mj.strip(), "minor_purpose": mn.strip()}
+
+
+def build_schema_repair_prompt(user_prompt: str, raw: str, errors: List[str]) -> str:
+    return (
+        f"{user_prompt}\n\n[이전 응답의 스키마 오류]\n"
+        + "\n".join(f"- {e}" for e in errors[:10])
+        + f"\n\n[이전 응답]\n{(raw or '')[:4000]}\n\n위 오류만 고쳐 같은 JSON 스키마로 다시 출력하라."
+    )
+
+
+def check_structured_result(
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    temperature: float,
+    raw: str,
+    data: Any,
+    timeout: Optional[float] = None,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    이미 받은 응답을 검증 → 로컬 보정 → (필요하면) 제한된 재요청. (data, raw) 반환.
+    고친 결과는 원래 요청의 캐시 항목에 덮어써서 다음 적중 때 다시 고치지 않게 함.
+    """
+    if not validate_rewrite_result(data):
+        _structured_count("valid")
+        return data, raw
+    cache_key = llm_cache_key(model, temperature, system_prompt, user_prompt, structured_text_format())
+    fixed = coerce_rewrite_result(data)
+    errors = validate_rewrite_result(fixed)
+    if not errors:
+        _structured_count("coerced")
+        if json_is_complete(raw):  # 잘린 응답을 보정한 결과는 저장하지 않음
+            llm_cache_put(cache_key, model, json.dumps(fixed, ensure_ascii=False))
+        return fixed, raw
+    for _ in range(STRUCTURED_MAX_RETRIES):
+        _structured_count("retried")
+        raw = call_openai(
+            api_key, model, system_prompt, build_schema_repair_prompt(user_prompt, raw, errors), temperature,
+            timeout=timeout, use_cache=False, text_format=structured_text_format(),
+        )
+        fixed = coerce_rewrite_result(safe_json(raw))
+        errors = validate_rewrite_result(fixed)
+        if not errors:
+            if json_is_complete(raw):
+                llm_cache_put(cache_key, model, json.dumps(fixed, ensure_ascii=False))
+            return fixed, raw
+    _structured_count("failed")
+    return fixed, raw
+
+
+def call_openai_rewrite(
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    temperature: float,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    structured: bool = False,
+) -> Tuple[Dict[str, Any], str]:
+    """리라이팅 결과(5키 JSON) 호출. structured면 스키마 모드 + 검증/보정/재요청. (data, raw) 반환."""
+    if not structured:
+        raw = call_openai(api_key, model, system_prompt, user_prompt, temperature, timeout=timeout, use_cache=use_cache)
+        with span("json.parse"):
+            return safe_json(raw), raw
+    raw = call_openai(
+        api_key, model, system_prompt, user_prompt, temperature,
+        timeout=timeout, use_cache=use_cache, text_format=structured_text_format(),
+    )
+    with span("json.parse"):
+        data = safe_json(raw)
+    with span("json.validate"):
+        return check_structured_result(api_key, model, system_prompt, user_prompt, temperature, raw, data, timeout)
+
+
+# ============================================================
+# Run history (디스크)
+# - 모든 실행 경로(작성/레퍼런스 탭/A·B/SNS/배치)가 같은 저장소에 append
+# - 목록은 페이지 단위(가벼운 컬럼만), 본문 검색은 FTS5(trigram) → 없으면 LIKE
+# - 복원할 때만 해당 항목 전체를 읽음
+# - 기록 이름(?hist=…)별로 나눠 보관, 이름이 없으면 공용('shared')
+# ============================================================
+HISTORY_PAGE_SIZE = 10
+HISTORY_SHARED_OWNER = "shared"  # 기록 이름 없이 실행한 기록 (run_history.owner 기본값과 같아야 함)
+HISTORY_LIGHT_COLS = "id, ts, major, minor, mode, model, temperature"
 
 
-def library_add(name: str, major: str, minor: str, ref_text: str, ref_meta: Dict[str, Any], template: Dict[str, Any]):
-    item = {
-        "name": name,
-        "major": major,
-        "minor": minor,
-        "text": ref_text,
-        "meta": ref_meta or {},
-        "template": template or {}
-    }
-    st.session_state.reference_library.append(item)
+def history_owner() -> str:
+    """현재 세션의 히스토리 소유자: 기록 이름이 없으면 공용, 있으면 이름 해시. (메인 스레드에서만)"""
+    key = (st.session_state.get("history_key") or "").strip()
+    if not key:
+        return HISTORY_SHARED_OWNER
+    return "k:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
 
 
-def library_items_for_major(major: str) -> List[Dict[str, Any]]:
-    return [it for it in (st.session_state.reference_library or []) if it.get("major") == major]
+def _history_key_changed():
+    # 주소에도 남겨서 새로고침/북마크로 같은 기록을 다시 열 수 있게
+    key = (st.session_state.get("history_key") or "").strip()
+    if key:
+        st.query_params["hist"] = key
+    else:
+        st.query_params.pop("hist", None)
+
+
+def history_add(item: Dict[str, Any], owner: Optional[str] = None) -> int:
+    ts = item.get("ts") or __import__("datetime").datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    original = item.get("original") or ""
+    rewritten = item.get("rewritten") or ""
+    with db_conn() as conn:
+        cur = conn.execute(
+            "INSERT INTO run_history (owner, ts, major, minor, mode, model, temperature, original, rewritten, data, context) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                owner or history_owner(),
+                ts,
+                item.get("major"),
+                item.get("minor"),
+                item.get("mode"),
+                item.get("model"),
+                item.get("temperature"),
+                original,
+                rewritten,
+                json.dumps(item.get("data") or {}, ensure_ascii=False),
+                json.dumps(item.get("context") or {}, ensure_ascii=False),
+            ),
+        )
+        hist_id = cur.lastrowid
+        if db_has_table("run_history_fts"):
+            conn.execute(
+                "INSERT INTO run_history_fts (rowid, original, rewritten) VALUES (?, ?, ?)",
+                (hist_id, original, rewritten),
+            )
+    return hist_id
+
+
+def _history_where(owner: str, query: str, major: Optional[str], minor: Optional[str], model: Optional[str]) -> Tuple[str, List[Any]]:
+    clauses, args = ["owner = ?"], [owner]
+    if major:
+        clauses.append("major = ?")
+        args.append(major)
+    if minor:
+        clauses.append("minor = ?")
+        args.append(minor)
+    if model:
+        clauses.append("model = ?")
+        args.append(model)
+    q = (query or "").strip()
+    if q:
+        # trigram은 3글자 이상만 색인 검색 가능 → 짧은 검색어는 LIKE
+        if len(q) >= 3 and db_has_table("run_history_fts"):
+            clauses.append("id IN (SELECT rowid FROM run_history_fts WHERE run_history_fts MATCH ?)")
+            args.append('"' + q.replace('"', '""') + '"')
+        else:
+            like = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            clauses.append("(original LIKE ? ESCAPE '\\' OR rewritten LIKE ? ESCAPE '\\')")
+            args.extend([like, like])
+    return " WHERE " + " AND ".join(clauses), args
+
+
+def history_page(
+    page: int = 1,
+    page_size: int = HISTORY_PAGE_SIZE,
+    query: str = "",
+    major: Optional[str] = None,
+    minor: Optional[str] = None,
+    model: Optional[str] = None,
+    owner: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """(현재 페이지 항목(본문 제외), 전체 건수). 최신순, 현재 기록 이름(없으면 공용)의 기록만."""
+    where, args = _history_where(owner or history_owner(), query, major, minor, model)
+    with db_conn() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM run_history{where}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {HISTORY_LIGHT_COLS} FROM run_history{where} ORDER BY id DESC LIMIT ? OFFSET ?",
+            args + [page_size, max(0, page - 1) * page_size],
+        ).fetchall()
+    return [dict(r) for r in rows], total
+
+
+def history_get(hist_id: int, owner: Optional[str] = None) -> Dict[str, Any]:
+    with db_conn() as conn:
+        row = conn.execute(
+            "SELECT * FROM run_history WHERE id = ? AND owner = ?", (hist_id, owner or history_owner())
+        ).fetchone()
+    if row is None:
+        return {}
+    item = dict(row)
+    item["data"] = json.loads(item.get("data") or "{}")
+    item["context"] = json.loads(item.get("context") or "{}")
+    return item
+
+
+def history_models(owner: Optional[str] = None) -> List[str]:
+    with db_conn() as conn:
+        return [r[0] for r in conn.execute(
+            "SELECT DISTINCT model FROM run_history WHERE owner = ? AND model IS NOT NULL ORDER BY model",
+            (owner or history_owner(),),
+        )]
+
+
+def history_clear(owner: Optional[str] = None):
+    """현재 기록 이름(없으면 공용)의 기록만 지운다. (다른 이름의 기록은 그대로)"""
+    owner = owner or history_owner()
+    with db_conn() as conn:
+        if db_has_table("run_history_fts"):
+            # external content FTS는 지우기 전 값으로 'delete' 명령을 넣어야 함
+            conn.execute(
+                "INSERT INTO run_history_fts (run_history_fts, rowid, original, rewritten) "
+                "SELECT 'delete', id, original, rewritten FROM run_history WHERE owner = ?",
+                (owner,),
+            )
+        conn.execute("DELETE FROM run_history WHERE owner = ?", (owner,))
 
 
-def render_library_label(it: Dict[str, Any]) -> str:
-    nm = it.get("name", "Untitled")
-    mn = it.get("minor", "")
-    return f"{nm}  ·  {mn}"
-# ============================================================
-# OpenAI call (유지)
-# ============================================================
-def call_openai(api_key, model, system_prompt, user_prompt, temperature):
-    from openai import OpenAI
-    client = OpenAI(api_key=api_key)
-    resp = client.responses.create(
-        model=model,
-        temperature=temperature,
-        input=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
-    )
-    return resp.output_text
+STREAM_UI_INTERVAL_S = 0.08  # 스트리밍 중 화면 갱신 최소 간격
+
 
 def run_transform(
     *,
@@ -899,60 +4199,583 @@ def run_transform(
     mode: str = "reference",  # "reference" | "template"
     template: Optional[Dict[str, Any]] = None,
     context: Optional[Dict[str, Any]] = None,
+    on_partial: Optional[Callable[[str], None]] = None,
 ) -> Tuple[Dict[str, Any], str]:
     """
     공용 변환 실행기.
     - mode="reference": build_prompt(payload)
     - mode="template": build_prompt_template_fill(payload, template)
+    - on_partial이 있으면 스트리밍으로 받아, 지금까지의 rewritten_text를 콜백으로 흘려줌
     실행 결과를 session_state에 일관되게 저장한다.
     """
-    if mode == "template":
-        ref_text = (payload.get("reference_text") or st.session_state.reference_text or "")
-        tpl = template or simple_structure_guess(ref_text)
-        sys, usr = build_prompt_template_fill(payload, tpl)
-    else:
-        sys, usr = build_prompt(payload)
-
-    raw = call_openai(api_key, model, sys, usr, temperature)
-    data = safe_json(raw)
-    val = data.get("rewritten_text", None)
-    rewritten = normalize_rewritten(val if val is not None else data)
+    ref_stats = None
+    with span("transform.prompt", mode=mode):
+        if mode == "template":
+            ref_text = (payload.get("reference_text") or st.session_state.reference_text or "")
+            tpl = template or template_for_reference(ref_text, model)
+            sys, usr = build_prompt_template_fill(payload, tpl)
+        else:
+            sys, usr = build_prompt(payload, model)
+            ref_text = (payload.get("reference_text") or "").strip()
+            if ref_text:
+                ref_stats = fit_reference(ref_text, ref_token_budget("reference"), model)[1]
+    token_report = prompt_token_report(sys, usr, model, ref_stats)
+    st.session_state.last_token_report = token_report
+
+    use_cache = st.session_state.get("use_llm_cache", True)
+    structured = bool(st.session_state.get("structured_output", False))
+    with span("transform.llm", model=model, stream=on_partial is not None):
+        if on_partial is None:
+            data, raw = call_openai_rewrite(api_key, model, sys, usr, temperature, use_cache=use_cache, structured=structured)
+        else:
+            raw = ""
+            shown, last_emit = "", 0.0
+            extractor = json_extractor_new()
+            text_format = structured_text_format() if structured else None
+            for delta in call_openai_stream(api_key, model, sys, usr, temperature, use_cache=use_cache, text_format=text_format):
+                raw += delta
+                json_extractor_feed(extractor, delta)
+                now = time.monotonic()
+                if now - last_emit < STREAM_UI_INTERVAL_S:
+                    continue
+                partial = partial_json_string_field(raw, "rewritten_text")
+                if partial != shown:
+                    shown, last_emit = partial, now
+                    on_partial(partial)
+            partial = partial_json_string_field(raw, "rewritten_text")
+            if partial != shown:
+                on_partial(partial)
+
+            # 스트리밍 중에 이미 스캔해 둔 결과 사용
+            with span("json.parse"):
+                data = json_extractor_finish(extractor)
+            if structured:
+                with span("json.validate"):
+                    data, raw = check_structured_result(api_key, model, sys, usr, temperature, raw, data)
+
+    with span("transform.normalize"):
+        val = data.get("rewritten_text", None)
+        rewritten = normalize_rewritten(val if val is not None else data)
 
     # ✅ 공용 저장 (어디서 실행해도 작성탭/다른 탭에서 동일하게 결과 접근 가능)
     st.session_state.last_raw = raw
     st.session_state.last_data = data
     st.session_state.last_rewritten = rewritten
     st.session_state.last_original = (payload.get("text") or "").strip()
-    st.session_state.last_run_context = context or {}
-    # ✅ 히스토리 저장(최근 10개)
-    hist_item = {
-        "ts": __import__("datetime").datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "major": payload.get("major"),
-        "minor": payload.get("minor"),
-        "mode": mode,
-        "model": model,
-        "temperature": temperature,
-        "original": st.session_state.last_original,
-        "rewritten": st.session_state.last_rewritten,
-        "data": st.session_state.last_data,
-        "context": st.session_state.last_run_context,
+    st.session_state.last_run_context = {**(context or {}), "tokens": token_report}
+    # ✅ 히스토리 저장(디스크, 전체 보관)
+    with span("history.write"):
+        history_add({
+            "major": payload.get("major"),
+            "minor": payload.get("minor"),
+            "mode": mode,
+            "model": model,
+            "temperature": temperature,
+            "original": st.session_state.last_original,
+            "rewritten": st.session_state.last_rewritten,
+            "data": st.session_state.last_data,
+            "context": st.session_state.last_run_context,
+        })
+
+    return data, rewritten
+
+def call_openai_stream(
+    api_key,
+    model,
+    system_prompt,
+    user_prompt,
+    temperature,
+    use_cache: bool = True,
+    text_format: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    call_openai의 스트리밍 버전. 텍스트 조각(delta)을 도착하는 대로 yield 한다.
+    캐시 적중 시에는 저장된 응답 전체를 한 번에 yield.
+    """
+    cache_key = llm_cache_key(model, temperature, system_prompt, user_prompt, text_format)
+    if use_cache:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            record_llm_call(model, cached=True)
+            yield cached
+            return
+
+    # 제너레이터는 yield 사이에 다른 span이 끼므로 span() 대신 끝날 때 직접 기록
+    t0 = time.perf_counter()
+    first_token_s = None
+    usage = (0, 0)
+    client = get_openai_client(api_key)
+    try:
+        stream = client.responses.create(
+            model=model,
+            temperature=temperature,
+            input=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=True,
+            **({"text": text_format} if text_format else {}),
+        )
+    except Exception:
+        record_llm_call(model, time.perf_counter() - t0, error=True)
+        raise
+    parts = []
+    status = None  # "completed" | "incomplete" (None = 완료 이벤트 없이 끊김)
+    try:
+        for event in stream:
+            etype = getattr(event, "type", "")
+            if etype == "response.output_text.delta":
+                if first_token_s is None:
+                    first_token_s = time.perf_counter() - t0
+                delta = event.delta or ""
+                parts.append(delta)
+                yield delta
+            elif etype == "response.completed":
+                status = "completed"
+                usage = _usage_tokens(getattr(event, "response", None))
+            elif etype == "response.incomplete":
+                # 출력 토큰 한도 등으로 잘림: 받은 만큼은 돌려주되 캐시에는 넣지 않음
+                status = "incomplete"
+                usage = _usage_tokens(getattr(event, "response", None))
+            elif etype in ("error", "response.failed"):
+                err = getattr(getattr(event, "response", None), "error", None) or event
+                raise RuntimeError(f"스트리밍 응답 실패: {getattr(err, 'message', None) or etype}")
+    except Exception:
+        # 실패 이벤트, 읽기 오류(httpx 등) 모두 오류 호출로 기록
+        record_llm_call(model, time.perf_counter() - t0, *usage, error=True)
+        raise
+    finally:
+        # 소비하는 쪽이 중간에 그만둬도(rerun/중지 → GeneratorExit) 연결을 바로 닫음
+        stream.close()
+
+    elapsed = time.perf_counter() - t0
+    record_llm_call(model, elapsed, *usage)
+    stack = getattr(_span_local, "stack", None)
+    _record_span(
+        "llm.stream", elapsed, stack[-1] if stack else None,
+        {"model": model, "ttft_ms": round((first_token_s or 0) * 1000, 1), "status": status or "cut"}, None,
+    )
+    raw = "".join(parts)
+    if raw and status == "completed" and json_is_complete(raw):
+        llm_cache_put(cache_key, model, raw)
+
+# ============================================================
+# Speculative prefetch (추천 변환 미리 실행, 옵트인)
+# - 작성 탭 변환이 끝나면 재활용 추천 상위 N개를 같은 설정으로 백그라운드 실행 → 응답 캐시에 저장
+# - 추천 버튼을 누르면 같은 프롬프트라 캐시 적중으로 바로 결과가 나옴
+# - 예산: 실행당 N개 + 프로세스 전역 시간당 토큰(입력+출력 예상치) 상한
+# - 프롬프트는 메인 스레드에서 만들고(session_state 사용), 워커는 API 호출만
+# ============================================================
+PREFETCH_MAX_PER_RUN = 2
+PREFETCH_WORKERS = 2
+PREFETCH_TOKEN_BUDGET_PER_HOUR = int(os.environ.get("REPURPOSE_PREFETCH_TOKENS_PER_HOUR", "60000"))
+PREFETCH_OUTPUT_TOKENS_EST = 1_500  # 응답 JSON 예상 토큰 (예산 계산용)
+
+
+@st.cache_resource(show_spinner=False)
+def _prefetch_registry() -> Dict[str, Any]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    return {
+        "executor": ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"),
+        "lock": threading.Lock(),
+        "status": {},  # cache key → "pending" | "ready" | "error"
+        "spent": collections.deque(),  # (ts, 예상 토큰) — 최근 1시간
+        "counters": {"scheduled": 0, "ready": 0, "failed": 0, "skipped_budget": 0, "skipped_cached": 0},
     }
 
-    st.session_state.history.insert(0, hist_item)   # 최신이 맨 위
-    st.session_state.history = st.session_state.history[:10]  # 10개만 유지
 
-    return data, rewritten
+def _prefetch_budget_left(reg: Dict[str, Any], now: float) -> int:
+    spent = reg["spent"]
+    while spent and now - spent[0][0] > 3600:
+        spent.popleft()
+    return PREFETCH_TOKEN_BUDGET_PER_HOUR - sum(n for _, n in spent)
+
+
+def _prefetch_run(api_key: str, model: str, temperature: float, system: str, user: str, structured: bool, key: str):
+    reg = _prefetch_registry()
+    with span("prefetch.llm", model=model):
+        try:
+            call_openai_rewrite(api_key, model, system, user, temperature, use_cache=True, structured=structured)
+            # 잘린/불완전 응답은 캐시에 안 들어감 → 실제로 저장됐을 때만 ready
+            status = "ready" if llm_cache_has(key) else "error"
+        except Exception:
+            status = "error"
+    with reg["lock"]:
+        reg["status"][key] = status
+        reg["counters"]["ready" if status == "ready" else "failed"] += 1
+
+
+def prefetch_suggestions(
+    api_key: str,
+    model: str,
+    temperature: float,
+    payload: Dict[str, Any],
+    suggestions: List[Dict[str, Any]],
+) -> Dict[str, str]:
+    """
+    추천(major/minor)별로 작성 탭과 같은 프롬프트를 만들어 백그라운드 실행.
+    {"major|minor": cache key} 반환 → 버튼에서 준비 상태 확인용.
+    """
+    reg = _prefetch_registry()
+    structured = bool(st.session_state.get("structured_output", False))
+    text_format = structured_text_format() if structured else None
+    keys: Dict[str, str] = {}
+    for sug in suggestions[:PREFETCH_MAX_PER_RUN]:
+        p = dict(payload, major=sug["major_purpose"], minor=sug["minor_purpose"])
+        system, user = build_prompt(p, model)
+        key = llm_cache_key(model, temperature, system, user, text_format)
+        keys[f"{p['major']}|{p['minor']}"] = key
+        cost = count_tokens(system + user, model) + PREFETCH_OUTPUT_TOKENS_EST
+        cached = llm_cache_has(key)  # 일반 실행으로 이미 캐시된 것도 건너뜀
+        now = time.time()
+        with reg["lock"]:
+            if cached:
+                reg["status"][key] = "ready"
+            if cached or reg["status"].get(key) == "pending":
+                reg["counters"]["skipped_cached"] += 1
+                continue
+            if cost > _prefetch_budget_left(reg, now):
+                reg["counters"]["skipped_budget"] += 1
+                continue
+            reg["spent"].append((now, cost))
+            reg["status"][key] = "pending"
+            reg["counters"]["scheduled"] += 1
+        reg["executor"].submit(_prefetch_run, api_key, model, temperature, system, user, structured, key)
+    return keys
+
+
+def prefetch_status(key: Optional[str]) -> Optional[str]:
+    if not key:
+        return None
+    reg = _prefetch_registry()
+    with reg["lock"]:
+        status = reg["status"].get(key)
+    if status == "ready" and not llm_cache_has(key):  # TTL 만료/축출
+        with reg["lock"]:
+            reg["status"].pop(key, None)
+        return None
+    return status
+
+
+def prefetch_stats() -> Dict[str, Any]:
+    reg = _prefetch_registry()
+    with reg["lock"]:
+        stats = dict(reg["counters"])
+        stats["budget_left"] = max(0, _prefetch_budget_left(reg, time.time()))
+    return stats
+
+
+def repurpose_targets(data: Dict[str, Any], major: str, minor: str) -> List[Dict[str, Any]]:
+    """재활용 추천 중 실제로 실행 가능한(대/소목적이 존재하는) 것만, 응답 추천 → 기본 추천 순."""
+    out, seen = [], {(major, minor)}
+    for r in list((data or {}).get("suggested_repurposes") or []) + derive_repurpose_suggestions(major, minor):
+        if not isinstance(r, dict):
+            continue
+        mj, mn = r.get("major_purpose"), r.get("minor_purpose")
+        if mn not in MAJOR_PURPOSES.get(mj, []) or (mj, mn) in seen:
+            continue
+        seen.add((mj, mn))
+        out.append({"major_purpose": mj, "minor_purpose": mn})
+    return out
+
+
+# ============================================================
+# A/B(N-way) 병렬 비교 엔진
+# - 같은 payload를 템플릿 N개에 동시에 채워 넣어 변환
+# - 스레드 풀 크기 = 동시 호출 상한, 각 레그는 개별 타임아웃
+# - 끝나는 순서대로 yield → UI가 바로 그려줌 (st.* 호출은 메인 스레드에서만)
+# ============================================================
+AB_MAX_LEGS = 6
+AB_MAX_CONCURRENCY = 4
+AB_LEG_TIMEOUT_S = 120.0
+
+
+def _run_fanout_leg(
+    api_key: str, model: str, temperature: float, system: str, user: str, timeout: float, use_cache: bool,
+    structured: bool = False,
+) -> Tuple[Dict[str, Any], str]:
+    data, _ = call_openai_rewrite(
+        api_key, model, system, user, temperature, timeout=timeout, use_cache=use_cache, structured=structured
+    )
+    val = data.get("rewritten_text", None)
+    return data, normalize_rewritten(val if val is not None else data)
+
+
+def iter_template_fanout(
+    api_key: str,
+    model: str,
+    temperature: float,
+    payload: Dict[str, Any],
+    templates: List[Dict[str, Any]],
+    max_concurrency: int = AB_MAX_CONCURRENCY,
+    leg_timeout: float = AB_LEG_TIMEOUT_S,
+):
+    """
+    templates[i]로 build_prompt_template_fill 한 프롬프트들을 병렬 실행.
+    완료되는 순서대로 {"index", "data", "text", "error", "elapsed"}를 yield 한다.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+
+    if not templates:
+        return
+    prompts = [build_prompt_template_fill(payload, tpl) for tpl in templates]
+    use_cache = bool(st.session_state.get("use_llm_cache", True))
+    structured = bool(st.session_state.get("structured_output", False))
+    workers = max(1, min(max_concurrency, len(prompts)))
+    # 상한보다 레그가 많으면 뒤 레그는 대기 후 시작 → 전체 대기 한도는 "라운드 수 × 레그 타임아웃"
+    rounds = -(-len(prompts) // workers)
+    started = time.monotonic()
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ab-leg")
+    futures = {
+        pool.submit(_run_fanout_leg, api_key, model, temperature, sys_p, usr_p, leg_timeout, use_cache, structured): i
+        for i, (sys_p, usr_p) in enumerate(prompts)
+    }
+    pending = set(futures)
+    try:
+        for fut in as_completed(futures, timeout=rounds * leg_timeout + 5):
+            pending.discard(fut)
+            i = futures[fut]
+            elapsed = round(time.monotonic() - started, 2)
+            try:
+                data, text = fut.result()
+                yield {"index": i, "data": data, "text": text, "error": None, "elapsed": elapsed}
+            except Exception as e:
+                yield {"index": i, "data": {}, "text": "", "error": str(e), "elapsed": elapsed}
+    except FuturesTimeout:
+        for fut in pending:
+            fut.cancel()
+            yield {"index": futures[fut], "data": {}, "text": "", "error": "timeout", "elapsed": round(time.monotonic() - started, 2)}
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ab_leg_label(i: int) -> str:
+    return chr(ord("A") + i)
+
+# ============================================================
+# Batch transform
+# - 원문 여러 개(CSV/JSONL) × 목적(대/소) 여러 개를 한 작업으로 실행
+# - 워커 수 상한 + 분당 요청 상한, 429(RateLimit)면 모든 워커가 같이 쉼
+# - 끝나는 대로 JSONL에 한 줄씩 기록 → 같은 입력/설정이면 같은 파일을 이어서(resume) 채움
+# ============================================================
+BATCH_DIR = os.path.join(DATA_DIR, "batch")
+BATCH_MAX_WORKERS = 4
+BATCH_DEFAULT_RPM = 60
+BATCH_RATE_RETRIES = 5
+
+
+def parse_batch_originals(file_name: str, raw_bytes: bytes) -> List[Dict[str, Any]]:
+    """
+    CSV(text/original 컬럼, 선택적으로 id) 또는 JSONL({"id", "text"})을 [{"id", "text"}]로.
+    id가 없으면 행 번호를 쓴다. 완전히 같은 행(id+본문)은 한 번만, id만 같은 행은 batch_duplicate_ids로 확인.
+    """
+    import csv
+    import io
+
+    content = raw_bytes.decode("utf-8-sig", errors="replace")
+    rows: List[Dict[str, Any]] = []
+    if file_name.lower().endswith((".jsonl", ".ndjson")):
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                rows.append(obj)
+            elif isinstance(obj, str):
+                rows.append({"text": obj})
+    else:
+        rows = list(csv.DictReader(io.StringIO(content)))
+
+    docs, seen = [], set()
+    for i, row in enumerate(rows, 1):
+        text = (row.get("text") or row.get("original") or "").strip()
+        doc = (str(row.get("id") or i), text)
+        if text and doc not in seen:
+            seen.add(doc)
+            docs.append({"id": doc[0], "text": text})
+    return docs
+
+
+def batch_duplicate_ids(docs: List[Dict[str, Any]]) -> List[str]:
+    """본문이 다른데 id가 겹치는 것들 (결과/이어하기가 id 기준이라 실행 전에 막음)."""
+    counts = collections.Counter(d["id"] for d in docs)
+    return [i for i, c in counts.items() if c > 1]
+
+
+def batch_job_id(docs: List[Dict[str, Any]], targets: List[Tuple[str, str]], settings: Dict[str, Any]) -> str:
+    blob = json.dumps([docs, targets, settings], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+
+def _batch_item_key(doc_id: str, major: str, minor: str) -> str:
+    return f"{doc_id}::{major}::{minor}"
+
+
+def batch_latest_records(out_path: str) -> Dict[str, Dict[str, Any]]:
+    """조합(doc_id, 대/소목적)별 마지막 레코드. 실패 후 재시도해 성공하면 성공 레코드가 남는다."""
+    latest: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(out_path):
+        return latest
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue  # 중단되며 잘린 마지막 줄
+            key = _batch_item_key(rec.get("doc_id"), rec.get("major"), rec.get("minor"))
+            latest.pop(key, None)  # 다시 넣어 파일 순서(마지막 기록 기준) 유지
+            latest[key] = rec
+    return latest
+
+
+def batch_done_keys(out_path: str) -> set:
+    return {k for k, rec in batch_latest_records(out_path).items() if not rec.get("error")}
+
+
+def _rate_gate(gate: Dict[str, Any]):
+    """분당 요청 상한 + 429 이후 공용 쿨다운을 지키도록 호출 직전에 대기."""
+    while True:
+        with gate["lock"]:
+            now = time.monotonic()
+            wait = max(gate["cooldown_until"] - now, gate["next_slot"] - now)
+            if wait <= 0:
+                gate["next_slot"] = max(gate["next_slot"], now) + gate["interval"]
+                return
+        time.sleep(min(wait, 1.0))
+
+
+def _batch_leg(
+    api_key: str, model: str, temperature: float, system: str, user: str, gate: Dict[str, Any], use_cache: bool,
+    structured: bool = False,
+) -> Tuple[Dict[str, Any], str]:
+    from openai import RateLimitError
+
+    text_format = structured_text_format() if structured else None
+    delay = 2.0
+    for attempt in range(BATCH_RATE_RETRIES + 1):
+        _rate_gate(gate)
+        try:
+            raw = call_openai(api_key, model, system, user, temperature, use_cache=use_cache, text_format=text_format)
+            break
+        except RateLimitError as e:
+            if attempt == BATCH_RATE_RETRIES:
+                raise
+            retry_after = None
+            try:
+                retry_after = float(e.response.headers.get("retry-after"))
+            except Exception:
+                pass
+            with gate["lock"]:
+                gate["cooldown_until"] = max(gate["cooldown_until"], time.monotonic() + (retry_after or delay))
+            delay = min(delay * 2, 60.0)
+    data = safe_json(raw)
+    if structured and validate_rewrite_result(data):
+        _rate_gate(gate)  # 보정 재요청도 같은 속도 제한 안에서
+        data, raw = check_structured_result(api_key, model, system, user, temperature, raw, data)
+    val = data.get("rewritten_text", None)
+    return data, normalize_rewritten(val if val is not None else data)
+
+
+def iter_batch_transform(
+    api_key: str,
+    model: str,
+    temperature: float,
+    docs: List[Dict[str, Any]],
+    targets: List[Tuple[str, str]],
+    settings: Dict[str, Any],
+    out_path: str,
+    mode: str = "reference",
+    template: Optional[Dict[str, Any]] = None,
+    max_workers: int = BATCH_MAX_WORKERS,
+    rpm: int = BATCH_DEFAULT_RPM,
+):
+    """
+    docs × targets 조합을 병렬 실행하고 결과를 out_path(JSONL)에 바로 append.
+    이미 성공한 조합은 건너뛴다. 완료된 레코드를 하나씩 yield.
+    settings: tone/style/audience/length/edit/reference_text (+ company/role)
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    done = batch_done_keys(out_path)
+    doc_texts = {doc["id"]: doc["text"] for doc in docs}
+    jobs = []
+    for doc in docs:
+        for major_t, minor_t in targets:
+            if _batch_item_key(doc["id"], major_t, minor_t) in done:
+                continue
+            payload = dict(settings, text=doc["text"], major=major_t, minor=minor_t)
+            if mode == "template":
+                tpl = template or template_for_reference(settings.get("reference_text") or "", model)
+                prompts = build_prompt_template_fill(payload, tpl)
+            else:
+                prompts = build_prompt(payload, model)
+            jobs.append((doc["id"], major_t, minor_t, prompts))
+    if not jobs:
+        return
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    use_cache = bool(st.session_state.get("use_llm_cache", True))
+    structured = bool(st.session_state.get("structured_output", False))
+    gate = {"lock": threading.Lock(), "interval": 60.0 / max(1, rpm), "next_slot": 0.0, "cooldown_until": 0.0}
+    # with 블록 대신 직접 종료: 위젯 rerun으로 제너레이터가 닫히면 대기 중 작업은 취소하고 바로 반환
+    # (이미 돌던 호출은 응답 캐시에 남으므로 이어서 실행할 때 다시 비용이 들지 않음)
+    pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="batch")
+    try:
+        with open(out_path, "a", encoding="utf-8") as out:
+            futures = {
+                pool.submit(_batch_leg, api_key, model, temperature, sys_p, usr_p, gate, use_cache, structured): (doc_id, major_t, minor_t)
+                for doc_id, major_t, minor_t, (sys_p, usr_p) in jobs
+            }
+            for fut in as_completed(futures):
+                doc_id, major_t, minor_t = futures[fut]
+                rec = {
+                    "doc_id": doc_id,
+                    "major": major_t,
+                    "minor": minor_t,
+                    "mode": mode,
+                    "model": model,
+                    "ts": __import__("datetime").datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                try:
+                    data, text = fut.result()
+                    rec.update({"rewritten": text, "data": data, "error": None})
+                except Exception as e:
+                    rec.update({"rewritten": "", "data": {}, "error": str(e)})
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+                if not rec["error"]:
+                    history_add({
+                        "ts": rec["ts"],
+                        "major": major_t,
+                        "minor": minor_t,
+                        "mode": mode,
+                        "model": model,
+                        "temperature": temperature,
+                        "original": doc_texts.get(doc_id, ""),
+                        "rewritten": rec["rewritten"],
+                        "data": rec["data"],
+                        "context": {"where": "batch", "mode": mode, "doc_id": doc_id, "batch_file": os.path.basename(out_path)},
+                    })
+                yield rec
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 # ============================================================
 # Prompt Builder (레퍼런스 기반 유지)
 # ============================================================
-def build_prompt(p: Dict[str, Any]):
+def build_prompt(p: Dict[str, Any], model: str = "gpt-4o-mini"):
     template = STRUCTURE_TEMPLATES.get(p["minor"], "논리적 구조로 구성")
 
     ref_text = (p.get("reference_text") or "").strip()
     ref_block = ""
     if ref_text:
-        ref_short = ref_text[:6000]
+        ref_short, _ = fit_reference(ref_text, ref_token_budget("reference"), model)
         ref_block = f"""
 [참고 레퍼런스(템플릿)]
 - 아래 레퍼런스의 '구조/문단 길이/문장 톤/헤딩 스타일/불릿 패턴'을 강하게 모사하되,
@@ -1039,8 +4862,8 @@ with st.sidebar:
 
     st.markdown("---")
     st.markdown("### 🎯 목적 설정")
-    major = st.selectbox("대목적", list(MAJOR_PURPOSES.keys()))
-    minor = st.selectbox("소목적", MAJOR_PURPOSES[major])
+    major = st.selectbox("대목적", list(MAJOR_PURPOSES.keys()), key="purpose_major")
+    minor = st.selectbox("소목적", MAJOR_PURPOSES[major], key="purpose_minor")
 
     tone = st.selectbox("톤", TONE)
     style = st.selectbox("스타일", STYLE)
@@ -1050,16 +4873,308 @@ with st.sidebar:
     edit_level = st.select_slider("편집 강도", list(EDIT_INTENSITY.keys()))
     temperature = st.slider("창의성", 0.0, 1.0, 0.5)
 
+    st.markdown("---")
+    ss_init("prompt_ref_tokens", REF_TOKEN_BUDGET_DEFAULT)
+    st.slider(
+        "레퍼런스 토큰 예산",
+        500,
+        min(REF_TOKEN_BUDGET_MAX, MODEL_CONTEXT_TOKENS.get(model, 128_000) - OUTPUT_TOKEN_RESERVE),
+        step=250,
+        key="prompt_ref_tokens",
+        help="레퍼런스가 이보다 길면 정보량 높은 문단 위주로 골라 넣습니다. (템플릿 추출은 1.35배, SNS는 1.1배)",
+    )
+    st.checkbox(
+        "구조화 출력 (JSON 스키마)",
+        key="structured_output",
+        help="API의 JSON 스키마 모드로 응답 형태를 고정하고, 어긋난 응답만 제한적으로 다시 요청합니다.",
+    )
+    if st.session_state.structured_output:
+        ss_stats = structured_stats()
+        st.caption(f"스키마 통과 {ss_stats['valid']} · 로컬 보정 {ss_stats['coerced']} · 재요청 {ss_stats['retried']} · 실패 {ss_stats['failed']}")
+    st.checkbox("응답 캐시 사용", key="use_llm_cache", help="같은 원문/설정/레퍼런스로 다시 실행하면 저장된 응답을 바로 돌려줍니다.")
+    cache_stats = llm_cache_stats()
+    st.caption(
+        f"캐시 적중 {cache_stats['hits']} · 미스 {cache_stats['misses']} · "
+        f"저장 {cache_stats['entries']}건 ({cache_stats['bytes'] // 1024}KB)"
+    )
+    if st.button("캐시 비우기", key="llm_cache_clear"):
+        llm_cache_clear()
+        st.success("응답 캐시를 비웠어.")
+    st.checkbox(
+        "추천 변환 미리 실행",
+        key="speculative_prefetch",
+        disabled=not st.session_state.use_llm_cache,
+        help=f"작성 탭 변환이 끝나면 재활용 추천 상위 {PREFETCH_MAX_PER_RUN}개를 백그라운드에서 미리 돌려 캐시에 넣습니다. "
+        f"(시간당 약 {PREFETCH_TOKEN_BUDGET_PER_HOUR:,} 토큰까지)",
+    )
+    if st.session_state.speculative_prefetch:
+        pf = prefetch_stats()
+        st.caption(f"미리 실행 {pf['scheduled']} · 준비 {pf['ready']} · 실패 {pf['failed']} · 예산 초과 {pf['skipped_budget']} · 남은 예산 {pf['budget_left']:,} 토큰")
+
+    ss_init("template_extractor", "auto")
+    st.selectbox(
+        "템플릿 추출",
+        list(TEMPLATE_EXTRACTORS),
+        key="template_extractor",
+        format_func=lambda k: TEMPLATE_EXTRACTORS[k],
+        help="자동: 헤딩/역할 단서가 뚜렷한 레퍼런스는 로컬에서 바로 뽑고, 애매한 것만 LLM으로 분석합니다.",
+    )
+    pending_tpl = template_precompute_pending()
+    st.caption(f"저장된 템플릿 {template_store_count()}건" + (f" · 백그라운드 분석 {pending_tpl}건" if pending_tpl else ""))
+    if st.button("템플릿 저장소 비우기", key="template_store_clear"):
+        template_store_invalidate()
+        st.success("저장된 템플릿을 모두 지웠어.")
+
+    st.markdown("---")
+    # 트레이스는 프로세스 전역: 체크박스는 현재 상태를 보여주고, 바꿀 때(on_change)만 전역 값을 고침
+    st.session_state.trace_jsonl = bool(_metrics_registry()["trace_path"])
+    ss_init("debug_panel", False)
+    st.checkbox(
+        "트레이스 기록 (JSONL, 전체 프로세스)",
+        key="trace_jsonl",
+        on_change=lambda: set_trace_enabled(st.session_state.trace_jsonl),
+        help=f"단계별 소요 시간을 {TRACE_PATH_DEFAULT}에 한 줄씩 남깁니다. 모든 세션에 적용됩니다.",
+    )
+    st.checkbox("디버그 패널", key="debug_panel", help="단계별 지연(p50/p95)과 모델별 호출/토큰 집계를 표시합니다.")
+    if METRICS_PORT:
+        st.caption(f"Prometheus: {METRICS_HOST}:{METRICS_PORT}/metrics")
+
     st.markdown("---")
     st.caption("레퍼런스/템플릿 설정은 '대목적'에 따라 메인 화면에서만 표시됩니다.")
 
 
+# ============================================================
+# Fragments
+# - 히스토리/라이브러리/A·B는 각자 fragment로 분리: 안에서 위젯을 건드려도
+#   해당 영역만 다시 실행 (앱 전체 재실행 X)
+# - 다른 영역에 영향을 주는 동작(복원/로드)만 st.rerun()으로 전체 갱신
+# ============================================================
+@st.fragment
+def render_history_browser():
+    st.text_input(
+        "기록 이름 (선택)",
+        key="history_key",
+        on_change=_history_key_changed,
+        placeholder="비워 두면 공용 기록",
+        help="이름을 정하면 같은 이름으로 연 세션끼리만 기록을 보고 지웁니다. 주소(?hist=…)에 남아 새로고침 후에도 유지됩니다. 비밀번호가 아닙니다.",
+    )
+    hf1, hf2, hf3, hf4 = st.columns([2, 1, 1, 1])
+    with hf1:
+        h_query = st.text_input("검색(원문/결과)", key="history_query")
+    with hf2:
+        h_major = st.selectbox("대목적", ["전체"] + list(MAJOR_PURPOSES.keys()), key="history_major")
+    with hf3:
+        h_minor = st.selectbox(
+            "소목적",
+            ["전체"] + (MAJOR_PURPOSES.get(h_major, []) if h_major != "전체" else []),
+            key="history_minor"
+        )
+    with hf4:
+        h_model = st.selectbox("모델", ["전체"] + history_models(), key="history_model")
+
+    filters = dict(
+        query=h_query,
+        major=None if h_major == "전체" else h_major,
+        minor=None if h_minor == "전체" else h_minor,
+        model=None if h_model == "전체" else h_model,
+    )
+    _, h_total = history_page(page=1, page_size=1, **filters)
+    n_pages = max(1, -(-h_total // HISTORY_PAGE_SIZE))
+    if st.session_state.history_page > n_pages:
+        st.session_state.history_page = n_pages
+    h_page = st.number_input(f"페이지 (총 {h_total}건, {n_pages}쪽)", 1, n_pages, key="history_page")
+    hist, _ = history_page(page=int(h_page), **filters)
+
+    if hist:
+        labels = []
+        for h in hist:
+            labels.append(
+                f"[{h['ts']}] {h.get('major','')}·{h.get('minor','')} | "
+                f"{h.get('mode','')} | {h.get('model','')} | temp={h.get('temperature','')}"
+            )
+
+        if st.session_state.history_pick >= len(hist):
+            st.session_state.history_pick = 0
+        pick = st.radio(
+            "복원할 실행 선택",
+            options=list(range(len(hist))),
+            format_func=lambda i: labels[i],
+            key="history_pick"
+        )
+
+        c1, c2 = st.columns(2)
+        with c1:
+            if st.button("이 결과로 복원", key="history_restore"):
+                chosen = history_get(hist[pick]["id"])
+                st.session_state.pending_restore = chosen
+                st.rerun()
+        with c2:
+            if st.button("히스토리 비우기", key="history_clear"):
+                history_clear()
+                name = (st.session_state.get("history_key") or "").strip()
+                st.success(f"'{name}' 기록을 비웠어." if name else "공용 히스토리를 비웠어.")
+    else:
+        st.caption("조건에 맞는 실행 기록이 없습니다.")
+
+
+def _library_delete_clicked(item_id: int, key: str):
+    library_delete(item_id)
+    st.session_state[f"{key}_deleted"] = True
+
+
+@st.fragment
+def render_library_manager(lib_major: str, key: str, empty_caption: str):
+    if st.session_state.pop(f"{key}_deleted", False):
+        st.success("삭제했습니다.")
+    items = library_items_for_major(lib_major)
+    if not items:
+        st.caption(empty_caption)
+        return
+    base_text = (st.session_state.get("original_text") or "").strip()
+    scores: Dict[int, float] = {}
+    if st.toggle("원문과 비슷한 순", key=f"{key}_by_sim", disabled=not base_text, help="작성 탭 원문과 본문/구조가 비슷한 레퍼런스를 위로 올립니다."):
+        sim_index_ready()
+        scores = {h["id"]: h["score"] for h in sim_search(base_text, major=lib_major)}
+        items = sorted(items, key=lambda it: -scores.get(it["id"], -1.0))
+    # 선택값은 위치가 아니라 항목 id → 정렬이 바뀌어도 같은 항목을 가리킴
+    by_id = {it["id"]: it for it in items}
+    pick_id = st.selectbox(
+        "저장된 템플릿",
+        list(by_id),
+        format_func=lambda i: render_library_label(by_id[i]) + (
+            f"  ·  유사도 {scores[i]:.0%}" if i in scores else ""
+        ),
+        key=f"{key}_pick"
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("로드", key=f"{key}_load"):
+            try:
+                it = library_get(pick_id)
+            except LookupError as e:
+                st.error(str(e))
+                return
+            st.session_state.reference_text = it.get("text", "")
+            st.session_state.reference_meta = it.get("meta") or {}
+            st.session_state.reference_template = it.get("template") or {}
+            st.toast("라이브러리 템플릿을 로드했습니다.")
+            st.rerun()  # 레퍼런스 미리보기 등 다른 영역도 갱신
+    with col2:
+        # 콜백은 fragment 본문보다 먼저 실행 → 다시 그릴 때 목록이 바로 갱신됨
+        st.button("삭제", key=f"{key}_delete", on_click=_library_delete_clicked, args=(pick_id, key))
+
+    if not template_matrix_ready(lib_major):
+        st.caption("템플릿 구조 비교를 백그라운드에서 계산 중…")
+        return
+    dups = template_near_duplicates(lib_major)
+    if dups:
+        with st.expander(f"구조·본문이 거의 같은 템플릿 {len(dups)}쌍", expanded=False):
+            for d in dups:
+                st.caption(
+                    f"{render_library_label(d['a'])}  ≈  {render_library_label(d['b'])}  "
+                    f"(구조 거리 {d['dist']:.2f} · 본문 유사도 {d['text_sim']:.0%})"
+                )
+
+
+def _ab_pick_diverse(items: List[Dict[str, Any]], n: int):
+    ids = pick_diverse_templates("자소서/면접", n)
+    pos = {it["id"]: i for i, it in enumerate(items)}
+    st.session_state.ab_resume_picks = [pos[i] for i in ids if i in pos]
+
+
+@st.fragment
+def render_resume_ab(api_key: str, model: str, temperature: float, settings: Dict[str, Any]):
+    """자소서 A/B(N-way) 비교. settings: major/minor/tone/style/audience/length/edit."""
+    items = library_items_for_major("자소서/면접")
+    if len(items) < 2:
+        st.info("A/B 비교를 하려면 2단계에서 템플릿을 2개 이상 저장해줘.")
+    else:
+        # "구조가 다른 조합" 콜백이 선택을 바꾸므로 기본값은 session_state로 (삭제로 줄어든 인덱스는 정리)
+        ss_init("ab_resume_picks", [0, 1])
+        st.session_state.ab_resume_picks = [i for i in st.session_state.ab_resume_picks if i < len(items)]
+        colPick, colRun = st.columns([2, 1])
+        with colPick:
+            picks = st.multiselect(
+                "비교할 템플릿 (2개 이상)",
+                list(range(len(items))),
+                format_func=lambda i: render_library_label(items[i]),
+                max_selections=AB_MAX_LEGS,
+                key="ab_resume_picks"
+            )
+        with colRun:
+            ab_btn = st.button("A/B 실행", key="ab_resume_run")
+            st.button(
+                "구조가 다른 조합",
+                key="ab_resume_diverse",
+                on_click=_ab_pick_diverse,
+                args=(items, max(2, len(st.session_state.get("ab_resume_picks") or []))),
+                help="템플릿 구조 거리가 가장 먼 조합으로 고릅니다. (LLM 호출 없음)",
+            )
+
+        if ab_btn:
+            base_text = st.session_state.get("original_text", "").strip()
+            if not api_key.strip():
+                st.error("API Key를 입력해줘.")
+            elif not base_text:
+                st.error("작성 탭의 원본 텍스트를 먼저 입력해줘.")
+            elif len(picks) < 2:
+                st.error("비교할 템플릿을 2개 이상 선택해줘.")
+            else:
+                payload = dict(
+                    settings,
+                    text=base_text,
+                    company=st.session_state.company_target,
+                    role=st.session_state.role_target,
+                )
+                legs = [items[i] for i in picks]
+                templates = [
+                    library_get_template(it["id"]) or template_for_reference(library_get(it["id"]).get("text", ""), model)
+                    for it in legs
+                ]
+
+                # 레그별 자리를 먼저 잡아두고, 끝나는 순서대로 채운다
+                slots = []
+                n_cols = min(3, len(legs))
+                for row_start in range(0, len(legs), n_cols):
+                    cols = st.columns(n_cols, gap="large")
+                    for j, it in enumerate(legs[row_start:row_start + n_cols]):
+                        i = row_start + j
+                        with cols[j]:
+                            with st.container(border=True):
+                                st.markdown(f"**{ab_leg_label(i)} 결과 ({it.get('name', 'Untitled')})**")
+                                slots.append(st.empty())
+                for slot in slots:
+                    slot.caption("변환 중...")
+
+                for res in iter_template_fanout(api_key, model, temperature, payload, templates):
+                    i = res["index"]
+                    label = ab_leg_label(i)
+                    with slots[i].container():
+                        if res["error"]:
+                            st.error(f"{label} 실패: {res['error']}")
+                        else:
+                            history_add({
+                                "major": settings["major"],
+                                "minor": settings["minor"],
+                                "mode": "ab",
+                                "model": model,
+                                "temperature": temperature,
+                                "original": base_text,
+                                "rewritten": res["text"],
+                                "data": res["data"],
+                                "context": {"where": "resume_ab", "mode": "template", "leg": label, "template_name": legs[i].get("name")},
+                            })
+                            st.text_area(label, res["text"], height=280, label_visibility="collapsed", key=f"ab_resume_out_{i}")
+                            st.caption(f"{res['elapsed']}s")
+                            st.download_button(f"{label} 다운로드", res["text"], file_name=f"result_{label}.txt", on_click="ignore", key=f"ab_resume_dl_{i}")
+
+
 # ============================================================
 # Main Layout: 탭 2개로 단순화
 # - [작성] 원문 입력 + 결과
 # - [레퍼런스] (자소서/논문/SNS일 때만) 관련 설정 노출
 # ============================================================
-tab_write, tab_ref = st.tabs(["✍️ 작성", "📚 레퍼런스/템플릿"])
+tab_write, tab_ref, tab_batch = st.tabs(["✍️ 작성", "📚 레퍼런스/템플릿", "📦 배치 변환"])
 
 # ============================================================
 # Tab: 작성
@@ -1072,6 +5187,7 @@ with tab_write:
             st.subheader("🧾 원본 텍스트")
             typed_text = st.text_area("원본", height=320, key="original_text", label_visibility="collapsed")
             run = st.button("변환 실행")
+            run = run or st.session_state.pop("suggest_run", False)  # 재활용 추천 버튼에서 넘어온 실행
 
             st.divider()
             st.caption("💡 팁) 레퍼런스를 설정하면 결과가 더 '합격 자소서/논문' 결에 가까워져요.")
@@ -1079,34 +5195,9 @@ with tab_write:
     with right:
         with st.container(border=True):
             st.subheader("✅ 변환 결과")
-                        # ✅ 최근 결과 히스토리(복원)
-            hist = st.session_state.history or []
-            if hist:
-                with st.expander("🕘 최근 결과(최대 10개) — 클릭해서 복원", expanded=False):
-                    labels = []
-                    for h in hist:
-                        labels.append(
-                            f"[{h['ts']}] {h.get('major','')}·{h.get('minor','')} | "
-                            f"{h.get('mode','')} | {h.get('model','')} | temp={h.get('temperature','')}"
-                        )
-
-                    pick = st.radio(
-                        "복원할 실행 선택",
-                        options=list(range(len(hist))),
-                        format_func=lambda i: labels[i],
-                        key="history_pick"
-                    )
-
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        if st.button("이 결과로 복원", key="history_restore"):
-                            chosen = hist[pick]
-                            st.session_state.pending_restore = chosen
-                            st.rerun()
-                    with c2:
-                        if st.button("히스토리 비우기", key="history_clear"):
-                            st.session_state.history = []
-                            st.success("히스토리를 비웠어.")
+            # ✅ 실행 히스토리(검색/복원) — 보이는 페이지만 읽음
+            with st.expander("🕘 실행 히스토리 — 검색해서 복원", expanded=False):
+                render_history_browser()
 
             if run:
                 if not api_key.strip():
@@ -1126,6 +5217,7 @@ with tab_write:
                         "reference_text": st.session_state.reference_text
                     }
 
+                    live = st.empty()
                     with st.spinner("변환 중..."):
                         data, rewritten = run_transform(
                             api_key=api_key,
@@ -1138,7 +5230,13 @@ with tab_write:
                                 "mode": "reference",
                                 "major": major,
                                 "minor": minor
-                            }
+                            },
+                            on_partial=live.markdown
+                        )
+                    live.empty()
+                    if st.session_state.speculative_prefetch and st.session_state.use_llm_cache:
+                        st.session_state.prefetch_keys = prefetch_suggestions(
+                            api_key, model, temperature, payload, repurpose_targets(data, major, minor)
                         )
 
             data = st.session_state.last_data or {}
@@ -1148,61 +5246,16 @@ with tab_write:
 
             original_for_view = restored_original if restored_original else typed_original
 
-            if isinstance(rewritten, str) and rewritten.strip() and original_for_view.strip():
-                st.markdown("**하이라이트(변경점 표시)**")
-                st.markdown(render_diff_html(original_for_view, rewritten), unsafe_allow_html=True)
-
-                st.divider()
-
-                highlight_reasons = data.get("highlight_reasons") or data.get("change_points", [])
-                st.markdown("**하이라이트 이유**")
-                if highlight_reasons:
-                    for reason in highlight_reasons:
-                        st.write("-", reason)
-                else:
-                    st.caption("표시할 이유가 없습니다.")
-
-                st.divider()
-
-                st.markdown("**🔍 변경 포인트**")
-                change_points = data.get("change_points") or derive_change_points(original_for_view, rewritten)
-                for c in change_points:
-                    if isinstance(c, dict):
-                        st.markdown(
-                            f"**원문:** {c.get('original','')}\n\n"
-                            f"➡️ **변경:** {c.get('rewritten','')}"
-                        )
-                    else:
-                        st.write("•", c)
-
-                st.divider()
-
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.markdown("**💡 재활용 추천**")
-                    suggested = data.get("suggested_repurposes") or derive_repurpose_suggestions(major, minor)
-                    for r in suggested:
-                        if isinstance(r, dict):
-                            st.write(f"{r.get('major_purpose','기타')} → {r.get('minor_purpose','기타')}")
-                        else:
-                            st.write(r)
-
-                with col2:
-                    st.markdown("**📈 품질 점수**")
-                    score = min(95, 60 + len(rewritten)//200)
-                    st.progress(score/100)
-                    st.write(f"{score}/100")
-
-                st.divider()
-
-                d1, d2 = st.columns(2)
-                with d1:
-                    st.download_button("TXT 다운로드", rewritten, file_name="result.txt")
-                with d2:
-                    st.download_button("MD 다운로드", rewritten, file_name="result.md")
-
-            else:
-                st.caption("변환 실행 후 결과가 표시됩니다.")
+            render_result_panel(
+                original_text=original_for_view,
+                rewritten=rewritten if isinstance(rewritten, str) else normalize_rewritten(rewritten),
+                data=data,
+                major=major,
+                minor=minor,
+                key_prefix="write",
+                tokens=(st.session_state.last_run_context or {}).get("tokens"),
+                suggest_actions=True,
+            )
 
 
 # ============================================================
@@ -1245,10 +5298,10 @@ with tab_ref:
                     ref_mode = st.radio("방식", ["URL", "PDF", "직접 붙여넣기"], horizontal=True)
 
                     if ref_mode == "URL":
-                        url = st.text_input("합격 자소서 URL", placeholder="공개된 합격 자소서/블로그 글 URL")
+                        url = st.text_area("합격 자소서 URL (여러 개면 줄바꿈)", placeholder="공개된 합격 자소서/블로그 글 URL", height=90)
                         if st.button("가져오기", key="resume_ref_url"):
                             with st.spinner("추출 중..."):
-                                txt, meta = fetch_url_text(url.strip())
+                                txt, meta = ingest_reference_urls(url)
                             if txt.strip():
                                 st.session_state.reference_text = txt
                                 st.session_state.reference_meta = meta
@@ -1257,9 +5310,9 @@ with tab_ref:
                                 st.warning("추출 실패(차단/로그인 가능). PDF 업로드나 직접 붙여넣기를 추천.")
                     elif ref_mode == "PDF":
                         pdf = st.file_uploader("PDF 업로드", type=["pdf"], key="resume_pdf")
+                        st.text_input("페이지 범위", placeholder="예: 1-12, 15, 20-40 (비우면 전체)", key="resume_pdf_pages")
                         if st.button("PDF 텍스트 추출", key="resume_pdf_extract") and pdf is not None:
-                            with st.spinner("PDF 추출 중..."):
-                                txt = extract_pdf_text(pdf.read())
+                            txt = render_pdf_extract(pdf, "resume_pdf_pages")
                             if txt.strip():
                                 st.session_state.reference_text = txt
                                 st.session_state.reference_meta = {"source": "pdf", "name": pdf.name}
@@ -1301,9 +5354,10 @@ with tab_ref:
                     a, b = st.columns([1, 1], gap="large")
                     with a:
                         st.markdown("#### 템플릿 생성")
+                        refresh_tpl = st.checkbox("저장된 템플릿 무시하고 다시 분석", key="resume_tpl_refresh")
                         if st.button("레퍼런스로 템플릿 만들기", key="resume_make_tpl"):
                             with st.spinner("템플릿 분석 중..."):
-                                tpl = extract_template(api_key, model, st.session_state.reference_text)
+                                tpl = extract_template(api_key, model, st.session_state.reference_text, refresh=refresh_tpl)
                             st.session_state.reference_template = tpl or {}
                             st.success("템플릿을 생성했습니다.")
 
@@ -1320,40 +5374,25 @@ with tab_ref:
 
                         if save_btn:
                             if not st.session_state.reference_template:
-                                tpl = simple_structure_guess(st.session_state.reference_text)
+                                tpl = template_for_reference(st.session_state.reference_text, model)
                             else:
                                 tpl = st.session_state.reference_template
 
-                            library_add(
-                                name=lib_name.strip() or f"자소서 템플릿 {len(st.session_state.reference_library)+1}",
+                            saved_id = library_add(
+                                name=lib_name.strip() or f"자소서 템플릿 {library_count('자소서/면접')+1}",
                                 major="자소서/면접",
                                 minor=minor,
                                 ref_text=st.session_state.reference_text,
                                 ref_meta=st.session_state.reference_meta,
-                                template=tpl
+                                template=tpl,
+                                api_key=api_key,
+                                model=model,
                             )
                             st.success("라이브러리에 저장했습니다.")
+                            render_library_duplicates_notice(saved_id)
 
                         st.divider()
-                        items = library_items_for_major("자소서/면접")
-                        if items:
-                            idx = st.selectbox("저장된 템플릿", list(range(len(items))), format_func=lambda i: render_library_label(items[i]), key="resume_pick")
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                if st.button("로드", key="resume_load"):
-                                    it = items[idx]
-                                    st.session_state.reference_text = it.get("text","")
-                                    st.session_state.reference_meta = it.get("meta") or {}
-                                    st.session_state.reference_template = it.get("template") or {}
-                                    st.success("라이브러리 템플릿을 로드했습니다.")
-                            with col2:
-                                if st.button("삭제", key="resume_delete"):
-                                    # 실제 저장 리스트에서 제거
-                                    target = items[idx]
-                                    st.session_state.reference_library.remove(target)
-                                    st.success("삭제했습니다.")
-                        else:
-                            st.caption("저장된 자소서 레퍼런스가 없습니다.")
+                        render_library_manager("자소서/면접", "resume", "저장된 자소서 레퍼런스가 없습니다.")
 
         # -----------------------------
         # Step 3: run + A/B
@@ -1390,7 +5429,7 @@ with tab_ref:
 
                         with st.spinner("변환 중..."):
                             if mode == "템플릿 채움(안정적)":
-                                tpl = st.session_state.reference_template or simple_structure_guess(st.session_state.reference_text)
+                                tpl = st.session_state.reference_template or template_for_reference(st.session_state.reference_text, model)
                                 data, rewritten = run_transform(
                                     api_key=api_key,
                                     model=model,
@@ -1428,79 +5467,34 @@ with tab_ref:
                             rewritten=st.session_state.last_rewritten,
                             data=st.session_state.last_data,
                             major=major,
-                            minor=minor
+                            minor=minor,
+                            key_prefix=f"{major}_run",
                         )
 
                 st.divider()
                 st.markdown("#### A/B 비교 (라이브러리 2개 이상 필요)")
                 st.info(
-    "A/B 비교는 **'원본 텍스트는 동일하게 두고'**, 라이브러리에서 선택한 **템플릿 A vs 템플릿 B**를 각각 적용해 "
-    "결과를 나란히 보여주는 기능입니다.\n\n"
+    "A/B 비교는 **'원본 텍스트는 동일하게 두고'**, 라이브러리에서 선택한 **템플릿 A vs 템플릿 B(최대 "
+    f"{AB_MAX_LEGS}개)**를 각각 적용해 결과를 나란히 보여주는 기능입니다.\n\n"
     "- 즉, **템플릿 구조/문체 규칙 차이**가 결과에 어떤 영향을 주는지 '템플릿 자체를 정확히 비교'할 수 있습니다.\n"
-    "- 설정(톤/스타일/독자/분량/편집강도/temperature)은 동일하게 유지됩니다."
+    "- 설정(톤/스타일/독자/분량/편집강도/temperature)은 동일하게 유지됩니다.\n"
+    "- 템플릿들은 동시에 실행되며, 먼저 끝난 결과부터 표시됩니다."
 )
-                items = library_items_for_major("자소서/면접")
-                if len(items) < 2:
-                    st.info("A/B 비교를 하려면 2단계에서 템플릿을 2개 이상 저장해줘.")
-                else:
-                    colA, colB, colRun = st.columns([1, 1, 1])
-                    with colA:
-                        idxA = st.selectbox("A", list(range(len(items))), format_func=lambda i: render_library_label(items[i]), key="abA_resume")
-                    with colB:
-                        idxB = st.selectbox("B", list(range(len(items))), format_func=lambda i: render_library_label(items[i]), key="abB_resume")
-                    with colRun:
-                        ab_btn = st.button("A/B 실행", key="ab_resume_run")
-
-                    if ab_btn:
-                        base_text = st.session_state.get("original_text", "").strip()
-                        if not api_key.strip():
-                            st.error("API Key를 입력해줘.")
-                        elif not base_text:
-                            st.error("작성 탭의 원본 텍스트를 먼저 입력해줘.")
-                        else:
-                            payload = {
-                                "text": base_text,
-                                "major": major,
-                                "minor": minor,
-                                "tone": tone,
-                                "style": style,
-                                "audience": audience,
-                                "length": LENGTH_PRESET[length_key],
-                                "edit": edit_level,
-                                "company": st.session_state.company_target,
-                                "role": st.session_state.role_target
-                            }
-                            itA, itB = items[idxA], items[idxB]
-                            tplA = itA.get("template") or simple_structure_guess(itA.get("text",""))
-                            tplB = itB.get("template") or simple_structure_guess(itB.get("text",""))
-
-                            sysA, usrA = build_prompt_template_fill(payload, tplA)
-                            sysB, usrB = build_prompt_template_fill(payload, tplB)
-
-                            with st.spinner("A/B 변환 중..."):
-                                rawA = call_openai(api_key, model, sysA, usrA, temperature)
-                                rawB = call_openai(api_key, model, sysB, usrB, temperature)
-
-                            dataA, dataB = safe_json(rawA), safe_json(rawB)
-
-                            A_val = dataA.get("rewritten_text", None)
-                            B_val = dataB.get("rewritten_text", None)
-
-                            A_txt = normalize_rewritten(A_val if A_val is not None else dataA)
-                            B_txt = normalize_rewritten(B_val if B_val is not None else dataB)
-                            
-                            ca, cb = st.columns(2, gap="large")
-                            with ca:
-                                with st.container(border=True):
-                                    st.markdown("**A 결과 (템플릿 A 적용)**")
-                                    st.text_area("A", A_txt, height=280, label_visibility="collapsed")
-                                    st.download_button("A 다운로드", A_txt, file_name="result_A.txt")
-                            with cb:
-                                with st.container(border=True):
-                                    st.markdown("**B 결과 (템플릿 B 적용)**")
-                                    st.text_area("B", B_txt, height=280, label_visibility="collapsed")
-                                    st.download_button("B 다운로드", B_txt, file_name="result_B.txt")
-                                
+                render_resume_ab(
+                    api_key,
+                    model,
+                    temperature,
+                    {
+                        "major": major,
+                        "minor": minor,
+                        "tone": tone,
+                        "style": style,
+                        "audience": audience,
+                        "length": LENGTH_PRESET[length_key],
+                        "edit": edit_level,
+                    },
+                )
+
             st.divider()
             st.subheader("📌 현재 레퍼런스 미리보기")
             if st.session_state.reference_text.strip():
@@ -1537,10 +5531,10 @@ with tab_ref:
                 ref_mode = st.radio("방식", ["URL", "PDF", "직접 붙여넣기"], horizontal=True, key="paper_ref_mode")
 
                 if ref_mode == "URL":
-                    url = st.text_input("논문 URL", placeholder="arXiv/오픈 논문 페이지/학회 페이지", key="paper_url")
+                    url = st.text_area("논문 URL (여러 개면 줄바꿈)", placeholder="arXiv/오픈 논문 페이지/학회 페이지", key="paper_url", height=90)
                     if st.button("가져오기", key="paper_ref_url"):
                         with st.spinner("추출 중..."):
-                            txt, meta = fetch_url_text(url.strip())
+                            txt, meta = ingest_reference_urls(url)
                         if txt.strip():
                             st.session_state.reference_text = txt
                             st.session_state.reference_meta = meta
@@ -1550,9 +5544,9 @@ with tab_ref:
 
                 elif ref_mode == "PDF":
                     pdf = st.file_uploader("PDF 업로드", type=["pdf"], key="paper_pdf")
+                    st.text_input("페이지 범위", placeholder="예: 1-12, 15, 20-40 (비우면 전체)", key="paper_pdf_pages")
                     if st.button("PDF 텍스트 추출", key="paper_pdf_extract") and pdf is not None:
-                        with st.spinner("PDF 추출 중..."):
-                            txt = extract_pdf_text(pdf.read())
+                        txt = render_pdf_extract(pdf, "paper_pdf_pages")
                         if txt.strip():
                             st.session_state.reference_text = txt
                             st.session_state.reference_meta = {"source": "pdf", "name": pdf.name}
@@ -1592,9 +5586,10 @@ with tab_ref:
 
                     with a:
                         st.markdown("#### 템플릿 생성")
+                        refresh_tpl = st.checkbox("저장된 템플릿 무시하고 다시 분석", key="paper_tpl_refresh")
                         if st.button("레퍼런스로 템플릿 만들기", key="paper_make_tpl"):
                             with st.spinner("템플릿 분석 중..."):
-                                tpl = extract_template(api_key, model, st.session_state.reference_text)
+                                tpl = extract_template(api_key, model, st.session_state.reference_text, refresh=refresh_tpl)
                             st.session_state.reference_template = tpl or {}
                             st.success("템플릿을 생성했습니다.")
 
@@ -1610,41 +5605,22 @@ with tab_ref:
                         save_btn = st.button("현재 레퍼런스 저장", key="paper_lib_save")
 
                         if save_btn:
-                            tpl = st.session_state.reference_template or simple_structure_guess(st.session_state.reference_text)
-                            library_add(
-                                name=lib_name.strip() or f"논문 템플릿 {len(st.session_state.reference_library)+1}",
+                            tpl = st.session_state.reference_template or template_for_reference(st.session_state.reference_text, model)
+                            saved_id = library_add(
+                                name=lib_name.strip() or f"논문 템플릿 {library_count('학술/논문')+1}",
                                 major="학술/논문",
                                 minor=minor,
                                 ref_text=st.session_state.reference_text,
                                 ref_meta=st.session_state.reference_meta,
-                                template=tpl
+                                template=tpl,
+                                api_key=api_key,
+                                model=model,
                             )
                             st.success("라이브러리에 저장했습니다.")
+                            render_library_duplicates_notice(saved_id)
 
                         st.divider()
-                        items = library_items_for_major("학술/논문")
-                        if items:
-                            idx = st.selectbox(
-                                "저장된 템플릿",
-                                list(range(len(items))),
-                                format_func=lambda i: render_library_label(items[i]),
-                                key="paper_pick"
-                            )
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                if st.button("로드", key="paper_load"):
-                                    it = items[idx]
-                                    st.session_state.reference_text = it.get("text", "")
-                                    st.session_state.reference_meta = it.get("meta") or {}
-                                    st.session_state.reference_template = it.get("template") or {}
-                                    st.success("라이브러리 템플릿을 로드했습니다.")
-                            with col2:
-                                if st.button("삭제", key="paper_delete"):
-                                    target = items[idx]
-                                    st.session_state.reference_library.remove(target)
-                                    st.success("삭제했습니다.")
-                        else:
-                            st.caption("저장된 논문 레퍼런스가 없습니다.")
+                        render_library_manager("학술/논문", "paper", "저장된 논문 레퍼런스가 없습니다.")
 
         # -----------------------------
         # Step 3: run transform
@@ -1684,7 +5660,7 @@ with tab_ref:
 
                         with st.spinner("변환 중..."):
                             if mode == "템플릿 채움(안정적)":
-                                tpl = st.session_state.reference_template or simple_structure_guess(st.session_state.reference_text)
+                                tpl = st.session_state.reference_template or template_for_reference(st.session_state.reference_text, model)
                                 data, rewritten = run_transform(
                                     api_key=api_key,
                                     model=model,
@@ -1723,7 +5699,8 @@ with tab_ref:
                             rewritten=st.session_state.last_rewritten,
                             data=st.session_state.last_data,
                             major=major,
-                            minor=minor
+                            minor=minor,
+                            key_prefix=f"{major}_run",
                         )
 
             st.divider()
@@ -1766,9 +5743,10 @@ with tab_ref:
                 ref_mode = st.radio("가져오기 방식", ["URL 붙여넣기", "직접 붙여넣기"], horizontal=True)
 
                 if ref_mode == "URL 붙여넣기":
-                    ref_url = st.text_input(
-                        "레퍼런스 URL",
+                    ref_url = st.text_area(
+                        "레퍼런스 URL (여러 개면 줄바꿈)",
                         placeholder="예: 맛집 블로그 글 링크 / 공개 인스타 캡션 페이지 링크",
+                        height=90,
                     )
                     c1, c2 = st.columns(2)
                     with c1:
@@ -1778,7 +5756,7 @@ with tab_ref:
 
                     if load_ref and ref_url.strip():
                         with st.spinner("레퍼런스 추출 중..."):
-                            txt, meta = fetch_url_text(ref_url.strip())
+                            txt, meta = ingest_reference_urls(ref_url)
                         if txt.strip():
                             st.session_state.reference_text = txt
                             st.session_state.reference_meta = meta
@@ -1831,6 +5809,32 @@ with tab_ref:
                 else:
                     st.info("레퍼런스를 설정하면 자동으로 스타일 프로필을 뽑아줍니다.")
 
+                with st.expander("📊 코퍼스 프로파일 (캡션/글 여러 개)", expanded=False):
+                    st.caption("여러 레퍼런스의 분포(분위수)를 생성 프롬프트에 함께 넣습니다. 붙여넣기는 '---' 한 줄로 구분, 파일은 CSV/JSONL(text 컬럼).")
+                    corpus_raw = st.text_area("코퍼스 붙여넣기", height=140, key="sns_corpus_paste")
+                    corpus_file = st.file_uploader("또는 파일", type=["csv", "jsonl", "ndjson", "txt"], key="sns_corpus_file")
+                    k1, k2 = st.columns(2)
+                    with k1:
+                        if st.button("코퍼스 분석", key="sns_corpus_run"):
+                            corpus = split_corpus_text(corpus_raw)
+                            if corpus_file is not None:
+                                if corpus_file.name.lower().endswith(".txt"):
+                                    corpus += split_corpus_text(corpus_file.getvalue().decode("utf-8", errors="replace"))
+                                else:
+                                    corpus += [d["text"] for d in parse_batch_originals(corpus_file.name, corpus_file.getvalue())]
+                            st.session_state.reference_corpus_profile = analyze_sns_corpus(corpus)
+                    with k2:
+                        if st.button("코퍼스 해제", key="sns_corpus_clear"):
+                            st.session_state.reference_corpus_profile = {}
+
+                    cp = st.session_state.reference_corpus_profile or {}
+                    if cp.get("n_docs"):
+                        q1, q2, q3 = st.columns(3)
+                        q1.metric("문서 수", cp["n_docs"])
+                        q2.metric("문장 길이 p50", cp["sentence_len"]["p50"])
+                        q3.metric("해시태그 p50", cp["hashtag_count"]["p50"])
+                        st.json(cp, expanded=False)
+
             st.divider()
 
             # --- 3) 생성 옵션 + 실행 ---
@@ -1914,9 +5918,24 @@ with tab_ref:
                     st.session_state.last_data = data
                     st.session_state.last_rewritten = rewritten
                     st.session_state.last_original = base_text
-                    st.session_state.last_run_context = {"where": "sns_generate", "mode": "sns", "major": major, "minor": minor}
+                    st.session_state.last_run_context = {
+                        "where": "sns_generate", "mode": "sns", "major": major, "minor": minor,
+                        "tokens": st.session_state.get("last_token_report") or {},
+                    }
+                    history_add({
+                        "major": major,
+                        "minor": minor,
+                        "mode": "sns",
+                        "model": model,
+                        "temperature": temperature,
+                        "original": base_text,
+                        "rewritten": rewritten,
+                        "data": data,
+                        "context": st.session_state.last_run_context,
+                    })
 
                     st.success("생성 완료! 작성 탭의 '✅ 변환 결과'에서도 확인할 수 있어요.")
+                    render_token_report(st.session_state.last_run_context.get("tokens"))
                     st.text_area("생성 결과 미리보기", rewritten, height=240)
 
                     # 다운로드 빠른 제공
@@ -1943,3 +5962,179 @@ with tab_ref:
             st.caption("현재 대목적에서는 레퍼런스 기능이 필수는 아니어서 숨겨져 있어요.")
             st.info("대목적을 '자소서/면접', '학술/논문', 'SNS/콘텐츠'로 바꾸면 해당 전용 화면이 나타납니다.")
 
+
+# ============================================================
+# Tab: 배치 변환
+# - 원문 파일(CSV/JSONL) × 목적 매트릭스를 한 번에 실행
+# - 같은 파일/설정으로 다시 실행하면 끝난 조합은 건너뛰고 이어서 진행
+# ============================================================
+with tab_batch:
+    with st.container(border=True):
+        st.subheader("📦 배치 변환")
+        st.caption("CSV(text 또는 original 컬럼, 선택적으로 id) 또는 JSONL({\"id\", \"text\"}) 파일의 원문들을 여러 목적으로 한 번에 변환합니다.")
+
+        batch_file = st.file_uploader("원문 파일", type=["csv", "jsonl", "ndjson"], key="batch_file")
+
+        purpose_options = [(mj, mn) for mj, mns in MAJOR_PURPOSES.items() for mn in mns]
+        batch_targets = st.multiselect(
+            "목적 매트릭스 (대목적 → 소목적)",
+            purpose_options,
+            default=[(major, minor)],
+            format_func=lambda t: f"{t[0]} → {t[1]}",
+            key="batch_targets"
+        )
+
+        bc1, bc2, bc3 = st.columns(3)
+        with bc1:
+            batch_mode = st.radio("변환 방식", ["레퍼런스 모사(기존)", "템플릿 채움(안정적)"], key="batch_mode")
+        with bc2:
+            batch_workers = st.slider("동시 실행 수", 1, 8, BATCH_MAX_WORKERS, key="batch_workers")
+        with bc3:
+            batch_rpm = st.number_input("분당 최대 요청 수", 1, 600, BATCH_DEFAULT_RPM, key="batch_rpm")
+
+        st.caption("톤/스타일/독자/분량/편집 강도/모델은 사이드바 설정을 사용하고, 레퍼런스가 설정돼 있으면 함께 반영됩니다.")
+        batch_btn = st.button("배치 실행 / 이어서 실행", key="batch_run")
+
+        if batch_file is not None:
+            docs = parse_batch_originals(batch_file.name, batch_file.getvalue())
+            dup_ids = batch_duplicate_ids(docs)
+            mode_key = "template" if batch_mode == "템플릿 채움(안정적)" else "reference"
+            settings = {
+                "tone": tone,
+                "style": style,
+                "audience": audience,
+                "length": LENGTH_PRESET[length_key],
+                "edit": edit_level,
+                "reference_text": st.session_state.reference_text,
+                "company": st.session_state.company_target,
+                "role": st.session_state.role_target,
+            }
+            job_id = batch_job_id(
+                docs,
+                [list(t) for t in batch_targets],
+                dict(settings, mode=mode_key, model=model, temperature=temperature, template=st.session_state.reference_template),
+            )
+            out_path = os.path.join(BATCH_DIR, f"{job_id}.jsonl")
+            total = len(docs) * len(batch_targets)
+            done_n = len(batch_done_keys(out_path))
+            st.write(f"원문 {len(docs)}개 × 목적 {len(batch_targets)}개 = **{total}건** (완료 {done_n}건)")
+
+            if batch_btn:
+                if not api_key.strip():
+                    st.error("API Key를 입력해줘.")
+                elif not docs or not batch_targets:
+                    st.error("원문과 목적을 하나 이상 선택해줘.")
+                elif dup_ids:
+                    st.error(f"id가 겹치는 원문이 있어: {', '.join(dup_ids[:10])} — id를 고유하게 바꿔서 다시 올려줘.")
+                else:
+                    prog = st.progress(done_n / max(1, total))
+                    status = st.empty()
+                    failed = 0
+                    for rec in iter_batch_transform(
+                        api_key, model, temperature, docs, batch_targets, settings, out_path,
+                        mode=mode_key,
+                        template=st.session_state.reference_template or None,
+                        max_workers=batch_workers,
+                        rpm=int(batch_rpm),
+                    ):
+                        if rec["error"]:
+                            failed += 1
+                        else:
+                            done_n += 1
+                        prog.progress(min(1.0, done_n / max(1, total)))
+                        status.caption(f"완료 {done_n}/{total} · 실패 {failed} · 최근: {rec['doc_id']} → {rec['major']}·{rec['minor']}")
+                    if failed:
+                        st.warning(f"{failed}건 실패. 같은 파일/설정으로 다시 실행하면 실패한 건만 이어서 처리합니다.")
+                    else:
+                        st.success("배치 완료!")
+
+            if os.path.exists(out_path):
+                # 조합별 마지막 기록만 (재시도로 성공한 건의 예전 실패 줄은 빠짐)
+                latest = batch_latest_records(out_path).values()
+                st.download_button(
+                    "결과 JSONL 다운로드",
+                    "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in latest),
+                    file_name=f"batch_{job_id}.jsonl",
+                    key="batch_download",
+                )
+
+
+
+# ============================================================
+# Warm-up + startup profile
+# - 첫 화면을 다 그린 뒤(스크립트 끝) 백그라운드로 무거운 모듈/토크나이저를 미리 로드
+# - REPURPOSE_STARTUP_PROFILE=1이면 사이드바에 시작 프로파일 표시
+# ============================================================
+@st.cache_resource(show_spinner=False)
+def _startup_profile() -> Dict[str, Any]:
+    return {"process_start": time.time(), "first_run_s": None, "last_run_s": None, "runs": 0, "warmup_s": None}
+
+
+def _warmup(profile: Dict[str, Any]):
+    t0 = time.perf_counter()
+    for name in WARMUP_MODULES:
+        lazy_import(name)
+    try:
+        _tiktoken_encoding("gpt-4o-mini")
+    except Exception:
+        pass
+    profile["warmup_s"] = time.perf_counter() - t0
+
+
+@st.cache_resource(show_spinner=False)
+def start_background_warmup() -> bool:
+    threading.Thread(target=_warmup, args=(_startup_profile(),), name="warmup", daemon=True).start()
+    return True
+
+
+_profile = _startup_profile()
+_run_s = time.perf_counter() - _SCRIPT_T0
+if _profile["first_run_s"] is None:
+    _profile["first_run_s"] = _run_s
+_profile["last_run_s"] = _run_s
+_profile["runs"] += 1
+start_background_warmup()
+
+if os.environ.get("REPURPOSE_STARTUP_PROFILE"):
+    with st.sidebar:
+        with st.expander("⏱ 시작 프로파일", expanded=False):
+            st.caption(
+                f"첫 실행 {_profile['first_run_s'] * 1000:.0f}ms · 이번 실행 {_run_s * 1000:.0f}ms · 실행 {_profile['runs']}회"
+            )
+            warm = _profile["warmup_s"]
+            st.caption("백그라운드 예열: " + (f"{warm * 1000:.0f}ms" if warm is not None else "진행 중"))
+            reg = _lazy_module_registry()
+            st.json(
+                {
+                    name: {"loaded": reg["modules"].get(name) is not None, "import_ms": round(secs * 1000, 1)}
+                    for name, secs in sorted(reg["import_s"].items(), key=lambda kv: -kv[1])
+                },
+                expanded=False,
+            )
+
+# 디버그 패널은 스크립트 끝에서 그려야 이번 실행의 단계까지 포함됨
+if st.session_state.get("debug_panel"):
+    with st.sidebar:
+        with st.expander("🩺 디버그: 단계별 지연 / 모델 사용량", expanded=True):
+            snap = metrics_snapshot()
+            if snap["stages"]:
+                st.dataframe(
+                    [
+                        {"단계": name, "횟수": v["count"], "오류": v["errors"], "평균ms": v["avg_ms"],
+                         "p50ms": v["p50_ms"], "p95ms": v["p95_ms"], "최대ms": v["max_ms"]}
+                        for name, v in snap["stages"].items()
+                    ],
+                    hide_index=True,
+                )
+            else:
+                st.caption("아직 기록된 단계가 없습니다.")
+            for m_name, m in snap["models"].items():
+                live = m["calls"] - m["cache_hits"]
+                st.caption(
+                    f"{m_name}: 호출 {m['calls']} (캐시 {m['cache_hits']}) · 오류 {m['errors']} · "
+                    f"토큰 in {m['input_tokens']:,} / out {m['output_tokens']:,} · "
+                    f"평균 지연 {m['latency_s'] / max(1, live) * 1000:.0f}ms"
+                )
+            if st.button("집계 초기화", key="metrics_reset"):
+                metrics_reset()
+                st.rerun()
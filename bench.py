@@ -0,0 +1,456 @@
+"""
+REPURPOSE 벤치마크
+- OpenAI Responses API를 흉내 내는 로컬 서버(지연 설정 가능)를 띄우고, app.py를 bare 모드로 불러와 핵심 경로를 반복 측정
+- 항목: run_transform(일반/스트리밍/구조화 출력/잘린 스트리밍), A/B fan-out, SNS 생성, render_diff_html, analyze_sns_style, simple_structure_guess
+- 결과: p50/p95/평균 지연, 처리량(ops/s), 메모리(tracemalloc 최대 할당, 프로세스 최대 RSS), 단계별 span 집계
+
+    python bench.py                       # 기본: 지연 300ms, 20회
+    python bench.py --latency 800 --iterations 50 --concurrency 4
+    python bench.py --only diff_paper sns_style --json bench_output.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+# ============================================================
+# Corpora (결정적 생성: 같은 seed면 같은 텍스트)
+# ============================================================
+SENTENCES = [
+    "데이터 파이프라인의 병목을 찾기 위해 단계별 처리 시간을 측정했습니다.",
+    "팀원들과 매주 회고를 진행하며 배포 주기를 2주에서 3일로 줄였습니다.",
+    "사용자 인터뷰 30건을 정리해 핵심 불편 요소 다섯 가지를 도출했습니다.",
+    "그 과정에서 가장 크게 배운 점은 가설을 작게 쪼개 빠르게 검증하는 습관이었습니다.",
+    "본 연구는 소규모 표본에서도 안정적인 추정이 가능한 방법을 제안한다.",
+    "실험 결과 제안 기법은 기존 대비 평균 오차를 18% 줄였다.",
+    "이러한 결과는 데이터 분포가 치우친 경우에도 일관되게 나타났다.",
+    "오늘은 성수동에서 찾은 작은 카페를 소개해요!",
+    "창가 자리에 앉으면 햇살이 정말 예쁘게 들어와요 ☀️",
+    "디저트는 무화과 타르트가 제일 맛있었어요 🍰",
+    "저장해두고 주말에 꼭 가보세요!",
+    "고객 이탈률을 낮추기 위해 온보딩 흐름을 세 단계로 단순화했습니다.",
+    "결과적으로 첫 주 잔존율이 12%p 상승했습니다.",
+    "앞으로는 이 경험을 바탕으로 더 큰 규모의 문제를 해결하고 싶습니다.",
+]
+HEADINGS = ["## 지원 동기", "## 핵심 경험", "## 직무 역량", "## 입사 후 목표", "1. 서론", "2. 방법", "3. 결과", "4. 결론"]
+HASHTAGS = ["#카페", "#성수카페", "#디저트", "#주말나들이", "#서울카페", "#카페투어", "#데일리"]
+
+
+def make_text(chars: int, seed: int, headings: bool = False, sns: bool = False) -> str:
+    """목표 글자 수만큼 문단(3~5문장)을 이어 붙인 텍스트."""
+    rng = random.Random(seed)
+    paras: List[str] = []
+    total = 0
+    while total < chars:
+        if headings and rng.random() < 0.25:
+            paras.append(rng.choice(HEADINGS))
+        para = " ".join(rng.choice(SENTENCES) for _ in range(rng.randint(3, 5)))
+        paras.append(para)
+        total += len(para) + 2
+    if sns:
+        paras.append(" ".join(rng.sample(HASHTAGS, 5)))
+    return "\n\n".join(paras)[: chars + 200]
+
+
+def make_corpora(seed: int) -> Dict[str, str]:
+    return {
+        "resume": make_text(1_200, seed, headings=True),           # 자소서 한 문항
+        "reference": make_text(6_000, seed + 1, headings=True),    # 레퍼런스 글
+        "paper": make_text(40_000, seed + 2, headings=True),       # 논문 본문(PDF 추출 수준)
+        "sns": make_text(2_500, seed + 3, sns=True),               # SNS 레퍼런스
+    }
+
+
+# ============================================================
+# Fake Responses API
+# - POST /v1/responses: latency 후 응답. stream=True면 SSE로 조각 전송
+# - "구조 분석가" 프롬프트(템플릿 추출)에는 템플릿 JSON, 나머지는 재작성 결과 JSON
+# - 입력에 TRUNCATE_MARKER가 있으면 스트리밍을 절반에서 끊고 response.incomplete로 끝냄(출력 토큰 한도 흉내)
+# ============================================================
+TRUNCATE_MARKER = "[bench:truncate]"
+
+
+def _fake_response_body(text: str, input_tokens: int, output_tokens: int, status: str = "completed") -> Dict[str, Any]:
+    return {
+        "id": "resp_bench", "object": "response", "created_at": 0, "model": "bench", "status": status,
+        "incomplete_details": {"reason": "max_output_tokens"} if status == "incomplete" else None,
+        "output": [{
+            "type": "message", "id": "msg_bench", "role": "assistant", "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": True, "tool_choice": "auto", "tools": [],
+        "usage": {
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens,
+            "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+def _fake_output(request: Dict[str, Any], response_chars: int, seed: int) -> str:
+    prompt = json.dumps(request.get("input", ""), ensure_ascii=False)
+    if "구조 분석가" in prompt:
+        return json.dumps({
+            "type": "resume",
+            "sections": [{"heading": h, "slot": f"s{i}", "guidance": "핵심 경험 중심"} for i, h in enumerate(HEADINGS[:4])],
+            "style_rules": {"heading_style": "##", "bullets": False},
+        }, ensure_ascii=False)
+    return json.dumps({
+        "rewritten_text": make_text(response_chars, seed, headings=True),
+        "change_points": ["도입 문장을 결론형으로 교체", "경험 문단 순서 재배치"],
+        "highlight_reasons": ["핵심 성과를 앞쪽에 배치"],
+        "detected_original_traits": ["나열식 서술"],
+        "suggested_repurposes": [
+            {"major_purpose": "자소서/면접", "minor_purpose": "면접 답변"},
+            {"major_purpose": "SNS/콘텐츠", "minor_purpose": "링크드인 소개"},
+        ],
+    }, ensure_ascii=False)
+
+
+def start_fake_server(latency_ms: float, jitter_ms: float, stream_ms: float, response_chars: int, seed: int):
+    """(server, base_url). 응답 본문은 요청마다 seed를 바꿔 diff 비용이 매번 비슷하게."""
+    counter = {"n": 0}
+    lock = threading.Lock()
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # 헤더/본문 분리 전송 시 지연 ACK로 ~40ms가 붙는 것 방지
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+            with lock:
+                counter["n"] += 1
+                n = counter["n"]
+            delay = latency_ms + (random.uniform(-jitter_ms, jitter_ms) if jitter_ms else 0.0)
+            time.sleep(max(0.0, delay) / 1000)
+            text = _fake_output(req, response_chars, seed + n)
+            in_tok = len(json.dumps(req.get("input", ""), ensure_ascii=False)) // 3
+            out_tok = len(text) // 3
+            if req.get("stream"):
+                truncate = TRUNCATE_MARKER in json.dumps(req.get("input", ""), ensure_ascii=False)
+                self._stream(text, in_tok, out_tok, truncate)
+                return
+            body = json.dumps(_fake_response_body(text, in_tok, out_tok)).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, text: str, in_tok: int, out_tok: int, truncate: bool = False):
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("connection", "close")
+            self.end_headers()
+            if truncate:
+                text, out_tok = text[: len(text) // 2], out_tok // 2
+            chunk = 24
+            n_chunks = max(1, -(-len(text) // chunk))
+            pause = stream_ms / 1000 / n_chunks
+            seq = 0
+
+            def ev(d):
+                self.wfile.write(f"event: {d['type']}\ndata: {json.dumps(d)}\n\n".encode())
+                self.wfile.flush()
+
+            ev({"type": "response.created", "sequence_number": seq,
+                "response": {**_fake_response_body("", 0, 0), "status": "in_progress", "output": []}})
+            for i in range(0, len(text), chunk):
+                seq += 1
+                ev({"type": "response.output_text.delta", "sequence_number": seq, "item_id": "msg_bench",
+                    "output_index": 0, "content_index": 0, "delta": text[i:i + chunk], "logprobs": []})
+                if pause:
+                    time.sleep(pause)
+            status = "incomplete" if truncate else "completed"
+            ev({"type": f"response.{status}", "sequence_number": seq + 1,
+                "response": _fake_response_body(text, in_tok, out_tok, status)})
+            self.close_connection = True
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="fake-llm", daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}/v1"
+
+
+# ============================================================
+# App 로딩 (bare 모드)
+# - streamlit run 없이 import → 위젯은 기본값, session_state는 프로세스 로컬
+# - 환경 변수는 import 전에 설정해야 적용됨(DATA_DIR, OpenAI base URL)
+# ============================================================
+def load_app(base_url: str, data_dir: str):
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["REPURPOSE_DATA_DIR"] = data_dir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # bare 모드 경고(ScriptRunContext 없음 등)가 매 호출마다 찍히지 않도록
+    # (설정 파일을 읽을 때 로그 레벨이 되돌아가므로 먼저 읽게 한 뒤 낮춤)
+    import streamlit.logger
+    from streamlit import config as st_config
+
+    st_config.get_config_options()
+    streamlit.logger.set_log_level("error")
+    import app  # noqa: E402
+
+    return app
+
+
+def base_payload(app, text: str, major: str = "자소서/면접") -> Dict[str, Any]:
+    return {
+        "text": text,
+        "major": major,
+        "minor": app.MAJOR_PURPOSES[major][0],
+        "tone": app.TONE[0],
+        "style": app.STYLE[0],
+        "audience": app.AUDIENCE[0],
+        "length": app.LENGTH_PRESET["보통"],
+        "edit": list(app.EDIT_INTENSITY)[1],
+    }
+
+
+def build_cases(app, corpora: Dict[str, str], use_cache: bool) -> Dict[str, Callable[[int], Any]]:
+    """이름 → fn(i). i는 반복 번호: 캐시를 끈 측정에서도 프롬프트가 매번 달라지도록 원문에 섞는다."""
+    ss = app.st.session_state
+    ss["use_llm_cache"] = use_cache
+    ss["structured_output"] = False
+    ss["reference_text"] = corpora["reference"]
+    ss["reference_corpus_profile"] = {}
+    api_key, model = "sk-bench", "gpt-4o-mini"
+    resume, reference = corpora["resume"], corpora["reference"]
+    templates = [app.simple_structure_guess(make_text(4_000, 100 + k, headings=True)) for k in range(3)]
+    revised = make_text(len(resume), 7, headings=True)
+    paper_revised = make_text(len(corpora["paper"]), 8, headings=True)
+
+    def _text(i: int) -> str:
+        return f"{resume}\n\n(#{i})"
+
+    def transform(i: int):
+        p = dict(base_payload(app, _text(i)), reference_text=reference)
+        return app.run_transform(api_key=api_key, model=model, temperature=0.3, payload=p, mode="reference")
+
+    def transform_stream(i: int):
+        p = dict(base_payload(app, _text(i)), reference_text=reference)
+        return app.run_transform(
+            api_key=api_key, model=model, temperature=0.3, payload=p, mode="reference", on_partial=lambda _s: None
+        )
+
+    def transform_structured(i: int):
+        p = dict(base_payload(app, _text(i)), reference_text=reference)
+        return app.run_transform(api_key=api_key, model=model, temperature=0.3, payload=p, mode="reference")
+
+    def transform_stream_truncated(i: int):
+        # 잘린 JSON 복구 경로 (캐시에 저장되지 않아야 함)
+        p = dict(base_payload(app, f"{_text(i)} {TRUNCATE_MARKER}"), reference_text=reference)
+        data, rewritten = app.run_transform(
+            api_key=api_key, model=model, temperature=0.3, payload=p, mode="reference", on_partial=lambda _s: None
+        )
+        if not rewritten:
+            raise RuntimeError("truncated stream produced no text")
+        return data, rewritten
+
+    def transform_template(i: int):
+        p = dict(base_payload(app, _text(i)), reference_text=reference)
+        return app.run_transform(
+            api_key=api_key, model=model, temperature=0.3, payload=p, mode="template", template=templates[0]
+        )
+
+    def ab(i: int):
+        legs = list(app.iter_template_fanout(api_key, model, 0.3, base_payload(app, _text(i)), templates))
+        failed = [r["error"] for r in legs if r["error"]]
+        if failed:
+            raise RuntimeError(failed[0])
+        return legs
+
+    def sns(i: int):
+        constraints = {
+            "length_mode": "보통", "emoji_level": "중간", "cta_mode": "가볍게",
+            "hashtag_mode": "자동(추천)", "hashtag_count": 10, "custom_hashtags": "",
+        }
+        ss["reference_text"] = corpora["sns"]
+        try:
+            return app.run_sns_generation(
+                api_key=api_key, model=model, temperature=0.7,
+                base_payload=base_payload(app, _text(i), "SNS/콘텐츠"),
+                platform="Instagram", niche="카페", goal="저장 유도", output_type="caption", constraints=constraints,
+            )
+        finally:
+            ss["reference_text"] = reference
+
+    def plain(fn: Callable[[int], Any], structured: bool = False) -> Callable[[int], Any]:
+        # 구조화 출력 여부는 session_state로 읽힘 → case마다 명시적으로 설정(이전 case 설정이 남지 않게)
+        def run(i: int):
+            ss["structured_output"] = structured
+            return fn(i)
+
+        return run
+
+    return {
+        "transform": plain(transform),
+        "transform_stream": plain(transform_stream),
+        "transform_structured": plain(transform_structured, structured=True),
+        "transform_stream_structured": plain(transform_stream, structured=True),
+        "transform_stream_truncated": plain(transform_stream_truncated),
+        "transform_template": plain(transform_template),
+        "ab_3legs": plain(ab),
+        "sns_generate": plain(sns),
+        # diff/스타일 분석은 앱에서 내용 기준으로 캐시됨 → 입력을 매번 바꿔 실제 계산 비용을 잰다
+        "diff_resume": lambda i: app.render_diff_html(resume, f"{revised}\n(#{i})"),
+        "diff_paper": lambda i: app.render_diff_html(corpora["paper"], f"{paper_revised}\n(#{i})"),
+        "sns_style": lambda i: app.analyze_sns_style(f"{corpora['sns']}\n(#{i})"),
+        "structure_guess": lambda i: app.simple_structure_guess(corpora["paper"]),
+    }
+
+
+# ============================================================
+# 측정
+# ============================================================
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+def run_case(fn: Callable[[int], Any], iterations: int, warmup: int, concurrency: int) -> Dict[str, Any]:
+    """
+    warmup 회 버린 뒤 iterations 회 측정. concurrency>1이면 스레드 N개가 나눠 실행(처리량 측정).
+    메모리는 측정과 분리해 tracemalloc으로 1회 더 실행한 최대 할당량.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    for k in range(warmup):
+        fn(-1 - k)
+
+    durations: List[float] = []
+    errors: List[str] = []
+
+    def _one(i: int):
+        t0 = time.perf_counter()
+        try:
+            fn(i)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            return
+        durations.append(time.perf_counter() - t0)
+
+    wall0 = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(_one, range(iterations)))
+    else:
+        for i in range(iterations):
+            _one(i)
+    wall = time.perf_counter() - wall0
+
+    tracemalloc.start()
+    try:
+        fn(iterations)
+    except Exception:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    vals = sorted(durations)
+    return {
+        "n": len(vals),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_ms": round(_percentile(vals, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(vals, 0.95) * 1000, 3),
+        "mean_ms": round(statistics.fmean(vals) * 1000, 3) if vals else 0.0,
+        "max_ms": round(vals[-1] * 1000, 3) if vals else 0.0,
+        "ops_per_s": round(len(vals) / wall, 2) if wall > 0 else 0.0,
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def format_table(results: Dict[str, Dict[str, Any]]) -> str:
+    cols = ["n", "errors", "p50_ms", "p95_ms", "mean_ms", "max_ms", "ops_per_s", "peak_alloc_kb"]
+    width = max(len(k) for k in results) if results else 4
+    lines = [f"{'case':<{width}}  " + "  ".join(f"{c:>13}" for c in cols)]
+    for name, r in results.items():
+        lines.append(f"{name:<{width}}  " + "  ".join(f"{r[c]:>13}" for c in cols))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="REPURPOSE benchmark (local fake LLM)")
+    ap.add_argument("--latency", type=float, default=300.0, help="가짜 API 응답 지연(ms, 첫 바이트까지)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="지연 ±jitter(ms) 균등 분포")
+    ap.add_argument("--stream-ms", type=float, default=200.0, help="스트리밍 응답 전체를 흘려보내는 시간(ms)")
+    ap.add_argument("--response-chars", type=int, default=1_200, help="재작성 결과 길이(글자)")
+    ap.add_argument("--iterations", type=int, default=20)
+    ap.add_argument("--warmup", type=int, default=2)
+    ap.add_argument("--concurrency", type=int, default=1, help="LLM 경로를 동시에 실행할 스레드 수")
+    ap.add_argument("--cache", action="store_true", help="응답 캐시를 켠 채 측정(기본: 끔)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--only", nargs="*", help="측정할 case 이름만")
+    ap.add_argument("--json", dest="json_path", help="결과를 JSON으로 저장할 경로")
+    args = ap.parse_args(argv)
+
+    corpora = make_corpora(args.seed)
+    srv, base_url = start_fake_server(args.latency, args.jitter, args.stream_ms, args.response_chars, args.seed)
+    data_dir = tempfile.mkdtemp(prefix="repurpose-bench-")
+    t0 = time.perf_counter()
+    app = load_app(base_url, data_dir)
+    import_s = time.perf_counter() - t0
+
+    cases = build_cases(app, corpora, args.cache)
+    names = args.only or list(cases)
+    unknown = [n for n in names if n not in cases]
+    if unknown:
+        ap.error(f"unknown case(s): {', '.join(unknown)} (choose from {', '.join(cases)})")
+
+    print(
+        f"latency={args.latency:.0f}ms jitter={args.jitter:.0f}ms stream={args.stream_ms:.0f}ms "
+        f"iterations={args.iterations} concurrency={args.concurrency} cache={'on' if args.cache else 'off'}"
+    )
+    print("corpora: " + ", ".join(f"{k}={len(v):,}ch" for k, v in corpora.items()))
+    print(f"app import: {import_s * 1000:.0f}ms\n")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in names:
+        llm_case = name.startswith(("transform", "ab_", "sns_generate"))
+        results[name] = run_case(
+            cases[name], args.iterations, args.warmup, args.concurrency if llm_case else 1
+        )
+        if results[name]["first_error"]:
+            print(f"[{name}] {results[name]['errors']} error(s): {results[name]['first_error']}", file=sys.stderr)
+
+    print(format_table(results))
+    stages = app.metrics_snapshot()["stages"]
+    if stages:
+        print("\nstages (app spans, warmup 포함):")
+        for name, v in stages.items():
+            print(f"  {name:<20} n={v['count']:<5} p50={v['p50_ms']:>9.2f}ms  p95={v['p95_ms']:>9.2f}ms")
+    print(f"\nmax RSS: {_max_rss_mb()}MB")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"args": vars(args), "import_ms": round(import_s * 1000, 1), "max_rss_mb": _max_rss_mb(),
+                 "cases": results, "stages": stages},
+                f, ensure_ascii=False, indent=2,
+            )
+    srv.shutdown()
+    return 1 if any(r["errors"] for r in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+# ============================================================
+# PDF 페이지 추출 워커 (프로세스 풀에서 실행)
+# - 자식 프로세스가 이 함수를 쓰려면 모듈을 import해야 함 → app.py는 import만 해도 Streamlit 스크립트 전체가
+#   실행되므로 워커 함수만 부작용 없는 이 모듈에 둔다 (st.* 사용 금지, app import 금지)
+# - 부모의 __main__(app.py)을 자식이 다시 실행하지 않게 하는 처리는 app.py의 _pdf_spawn_guard 참고
+# ============================================================
+from typing import List, Tuple
+
+
+def extract_chunk(path: str, page_indices: List[int]) -> List[Tuple[int, str]]:
+    import pdfplumber
+
+    out = []
+    with pdfplumber.open(path) as pdf:
+        for i in page_indices:
+            out.append((i, (pdf.pages[i].extract_text() or "").strip()))
+    return out